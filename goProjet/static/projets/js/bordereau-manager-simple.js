@@ -150,6 +150,7 @@ class LineManager {
         this.lines = new Map(); // Map<id, Line>
         this.flatIndex = new Map(); // Map<id, index>
         this.cachedFlatList = null;
+        this.supprimees = new Set(); // Lignes supprimées, et leurs descendants pas encore chargés
         if (data && data.length > 0) {
             this.buildTree(data);
         }
@@ -333,6 +334,35 @@ class LineManager {
         // Mettre à jour l'index plat
         this.updateFlatIndex();
     }
+    /**
+     * Ajoute à l'arbre une plage de lignes chargée après coup, sans reconstruire les lignes
+     * déjà présentes (et leurs modifications non enregistrées). Chaque ligne est rattachée à
+     * son parent par parent_id; les descendants d'une ligne supprimée entre-temps sont ignorés.
+     */
+    ajouterLignes(data) {
+        data.forEach(row => {
+            if (!row || row.id === null || row.id === undefined || this.lines.has(row.id)) return;
+            if (row.parent_id && this.supprimees.has(row.parent_id)) {
+                this.supprimees.add(row.id);
+                return;
+            }
+            const line = new Line(
+                row.id,
+                row.numero || "",
+                row.designation || "Nouvelle ligne",
+                row.unite || "",
+                parseFloat(row.quantite) || 0,
+                parseFloat(row.prix_unitaire) || 0,
+                null,
+                row._expanded !== undefined ? row._expanded : true
+            );
+            this.lines.set(row.id, line);
+            const parent = row.parent_id ? this.lines.get(row.parent_id) : null;
+            (parent || this.root).addChild(line);
+        });
+        this.invalidateCache();
+    }
+
     getFlatList() {
         if (this.cachedFlatList) return this.cachedFlatList;
         
@@ -376,6 +406,8 @@ class LineManager {
                 const line = flatList[rowIndex + i];
 
                 if (line && line.parent) {
+                    this.supprimees.add(line.id);
+                    line.descendantIds.forEach(id => this.supprimees.add(id));
                     line.parent.removeChild(line);
                     this.flatIndex.delete(line.id);
                 }
@@ -539,6 +571,19 @@ class BordereauManager {
         this.lotNom = options.lotNom || 'Bordereau';
         this.csrfToken = options.csrfToken || '';
         this.saveUrl = options.saveUrl || '';
+        this.patchUrl = options.patchUrl || '';
+        this.revision = options.revision ?? null;
+        
+        // Chargement par plages des grands bordereaux (seule la première plage est dans la page)
+        this.plageUrl = options.plageUrl || '';
+        this.lignesTotal = options.lignesTotal || 0;
+        this.taillePlage = options.taillePlage || 500;
+        this.lignesChargees = 0;
+        this.chargementEnCours = null; // Promesse de la plage en cours de chargement
+        
+        // Journal des modifications de cellules (envoyé via le protocole de patch)
+        this.operations = [];
+        this.structureModifiee = false;
         
         // Initialisation
         this.hot = null;
@@ -560,6 +605,82 @@ class BordereauManager {
         
         // Configurer les raccourcis clavier
         this.setupKeyboardShortcuts();
+        
+        // Seule la première plage est dans la page: la suite est chargée au défilement
+        this.lignesChargees = (window.bordereauData || []).length;
+        if (!this.complet) {
+            window.addEventListener('scroll', () => this.chargerPlageSiNecessaire(), {passive: true});
+            this.chargerPlageSiNecessaire();
+        }
+    }
+
+    // ============================================================================
+    // CHARGEMENT PAR PLAGES
+    // ============================================================================
+
+    get complet() {
+        return !this.plageUrl || this.lignesChargees >= this.lignesTotal;
+    }
+
+    /**
+     * Vrai lorsque la fin des lignes chargées approche de la zone affichée
+     * (défilement interne de la grille ou de la page, la grille ayant une hauteur automatique)
+     */
+    procheDeLaFin() {
+        const view = this.hot.view;
+        const derniere = view && view.getLastFullyVisibleRow ? view.getLastFullyVisibleRow() : -1;
+        if (derniere >= this.lineManager.nbLines - this.taillePlage / 5) return true;
+        const bas = this.hot.rootElement.getBoundingClientRect().bottom;
+        return bas - window.innerHeight < 2 * window.innerHeight;
+    }
+
+    chargerPlageSiNecessaire() {
+        if (!this.hot || this.complet || this.chargementEnCours || !this.procheDeLaFin()) return;
+        this.chargerPlage().catch(error => {
+            console.error('Erreur:', error);
+            alert("Erreur de chargement du bordereau : " + error.message);
+        });
+    }
+
+    /**
+     * Charge la plage suivante et l'ajoute à l'arbre: la grille reste modifiable pendant le
+     * chargement, les modifications de cellules partant par le protocole de patch (par ligne).
+     * Une modification du bordereau par un autre utilisateur décale les plages: la page est rechargée.
+     */
+    chargerPlage() {
+        if (this.chargementEnCours) return this.chargementEnCours;
+        const debut = this.lignesChargees;
+        const url = `${this.plageUrl}?debut=${debut}&fin=${debut + this.taillePlage}`;
+        this.chargementEnCours = fetch(url, {headers: {'Accept': 'application/json'}})
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'ok') {
+                    throw new Error(data.message);
+                }
+                if (this.revision !== null && data.revision !== this.revision) {
+                    alert("Le bordereau a été modifié par ailleurs. La page va être rechargée.");
+                    window.location.reload();
+                    throw new Error("Bordereau modifié");
+                }
+                this.lignesTotal = data.lignes.length ? data.total : debut;
+                this.lignesChargees = debut + data.lignes.length;
+                this.lineManager.ajouterLignes(data.lignes);
+                this.refreshTable();
+            })
+            .finally(() => {
+                this.chargementEnCours = null;
+            });
+        return this.chargementEnCours.then(() => this.chargerPlageSiNecessaire());
+    }
+
+    /**
+     * Charge toutes les plages restantes: nécessaire avant une sauvegarde complète (qui supprimerait
+     * les lignes absentes de la grille) et avant un export
+     */
+    async chargerTout() {
+        while (!this.complet) {
+            await (this.chargementEnCours || this.chargerPlage());
+        }
     }
 
     initHandsontable() {
@@ -610,6 +731,7 @@ class BordereauManager {
             rowHeights: 40,
             manualColumnResize: true,
             outsideClickDeselects: false,
+            afterScrollVertically: () => this.chargerPlageSiNecessaire(),
             afterRemoveRow: this.handleAfterRemoveRow.bind(this),
             // Gestion des changements
             // afterChange: this.handleAfterChange.bind(this),
@@ -671,6 +793,7 @@ class BordereauManager {
     processPastedData(excelData, startRow) {
         // 1. Traiter les données dans le LineManager
         const newIndices = this.lineManager.processExcelPaste(excelData, startRow);
+        this.structureModifiee = true;
         
         // 2. Mettre à jour le tableau en une seule opération
         this.refreshTable();
@@ -729,14 +852,31 @@ class BordereauManager {
                 break;
         }
         
+        if (['numero', 'designation', 'unite', 'quantite', 'prix_unitaire'].includes(property)) {
+            this.journaliser(line, property, line[property]);
+        }
+        
         // Mettre à jour le montant affiché
         if (property === 'quantite' || property === 'prix_unitaire') {
             this.hot.setDataAtRowProp(row, 'montant', line.amount);
         }
     }
 
+    /**
+     * Enregistre une modification de cellule dans le journal des opérations.
+     * Les lignes pas encore enregistrées passent par la sauvegarde complète.
+     */
+    journaliser(line, property, value) {
+        if (typeof line.id !== 'number') {
+            this.structureModifiee = true;
+            return;
+        }
+        this.operations.push({op: 'update', id: line.id, valeurs: {[property]: value}});
+    }
+
     handleAfterRemoveRow(index, amount, source) {
         // console.log(`Removing line at index ${index} (${source}) (amount: ${amount})`);
+        this.structureModifiee = true;
         this.lineManager.removeLineByIndex(index, amount);
         this.updateTotal();
         this.dataChanged = true;
@@ -947,6 +1087,7 @@ class BordereauManager {
                 if (!selected || selected.length === 0) return;
                 
                 const startRow = selected[0][0];
+                this.structureModifiee = true;
                 
                 if (e.shiftKey) {
                     // Désindenter
@@ -975,6 +1116,7 @@ class BordereauManager {
         }
         
         const startRow = selected[0][0];
+        this.structureModifiee = true;
         const newLine = this.lineManager.insertOrUpdateLineAt(startRow + 1, {
             numero: '',
             designation: 'Nouvelle ligne',
@@ -995,6 +1137,7 @@ class BordereauManager {
         }
         
         const startRow = selected.startRow;
+        this.structureModifiee = true;
         const result = this.lineManager.indentLine(startRow, selected.nbRows);
         if (result > 0) {
             console.log('indentation successful. Inserted ' + result + ' lines.');
@@ -1013,6 +1156,7 @@ class BordereauManager {
         }
         
         const startRow = selected.startRow;
+        this.structureModifiee = true;
         const result = this.lineManager.desindentLine(startRow, selected.nbRows);
         if (result > 0) {
             console.log('desindentation successful. Desindented ' + result + ' lines.');
@@ -1024,7 +1168,21 @@ class BordereauManager {
         
     }
 
-    saveData() {
+    async saveData() {
+        // Seules des cellules ont changé: n'envoyer que les opérations, sans la grille complète
+        if (this.patchUrl && !this.structureModifiee) {
+            return this.savePatch();
+        }
+        
+        // La sauvegarde complète remplace le bordereau: toutes les lignes doivent être chargées
+        try {
+            await this.chargerTout();
+        } catch (error) {
+            console.error('Erreur:', error);
+            alert("Erreur de chargement du bordereau : " + error.message);
+            return;
+        }
+        
         const saveBtn = document.getElementById('save-btn');
         if (saveBtn) {
             saveBtn.disabled = true;
@@ -1051,12 +1209,18 @@ class BordereauManager {
                 'Content-Type': 'application/json',
                 'X-CSRFToken': this.csrfToken
             },
-            body: JSON.stringify(finalData)
+            body: JSON.stringify({revision: this.revision, lignes: finalData})
         })
         .then(response => response.json())
         .then(data => {
-            if (data.status === 'ok') {
+            if (data.status === 'conflit') {
+                alert(data.message + " La page va être rechargée.");
+                window.location.reload();
+            } else if (data.status === 'ok') {
                 saveBtn.innerHTML = '<i class="fas fa-save"></i>';
+                this.revision = data.revision ?? this.revision;
+                this.operations = [];
+                this.structureModifiee = false;
                 alert(data.message);
                 // window.location.reload();
                 // Si le backend a créé de nouveaux IDs, les mettre à jour dans lineManager
@@ -1093,7 +1257,57 @@ class BordereauManager {
         });
     }
 
-    exportExcel() {
+    savePatch() {
+        if (this.operations.length === 0) {
+            alert("Aucune modification à enregistrer");
+            return;
+        }
+        
+        const saveBtn = document.getElementById('save-btn');
+        if (saveBtn) {
+            saveBtn.disabled = true;
+            saveBtn.innerHTML = '<i class="fa-solid fa-spinner fa-spin"></i> Enregistrement...';
+        }
+        
+        const operations = this.operations;
+        this.operations = [];
+        
+        fetch(this.patchUrl, {
+            method: "POST",
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': this.csrfToken
+            },
+            body: JSON.stringify({revision: this.revision, operations: operations})
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.status === 'ok') {
+                this.revision = data.revision;
+                alert('Lignes sauvegardées avec succès.');
+            } else if (data.status === 'conflit') {
+                alert(data.message + " La page va être rechargée.");
+                window.location.reload();
+            } else {
+                throw new Error(data.message);
+            }
+        })
+        .catch(error => {
+            // Remettre les opérations dans le journal pour une nouvelle tentative
+            this.operations = operations.concat(this.operations);
+            console.error('Erreur:', error);
+            alert("Erreur d'enregistrement : " + error.message);
+        })
+        .finally(() => {
+            if (saveBtn) {
+                saveBtn.disabled = false;
+                saveBtn.innerHTML = '<i class="fas fa-save"></i>';
+            }
+        });
+    }
+
+    async exportExcel() {
+        await this.chargerTout();
         const exportData = this.hot.getData().filter(row => row && row[1] !== null && row[1] !== '');
         const wb = XLSX.utils.book_new();
         const wsData = [
@@ -1105,7 +1319,8 @@ class BordereauManager {
         XLSX.writeFile(wb, `bordereau_${this.lotNom.replace(/[^a-z0-9]/gi, '_').toLowerCase()}.xlsx`);
     }
 
-    exportPDF() {
+    async exportPDF() {
+        await this.chargerTout();
         const { jsPDF } = window.jspdf;
         const doc = new jsPDF();
         const exportData = this.hot.getData().filter(row => row && row[1] !== null && row[1] !== '');
@@ -1152,7 +1367,12 @@ document.addEventListener('DOMContentLoaded', function() {
                 containerId: 'hot',
                 lotNom: window.lotNom || 'Bordereau',
                 csrfToken: window.csrfToken || '',
-                saveUrl: window.saveUrl || ''
+                saveUrl: window.saveUrl || '',
+                patchUrl: window.patchUrl || '',
+                revision: window.lotRevision ?? null,
+                plageUrl: window.plageUrl || '',
+                lignesTotal: window.lignesTotal || 0,
+                taillePlage: window.taillePlage || 500
             });
         }, 100);
     }
@@ -3,8 +3,9 @@ from django.contrib import admin
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
 from .models.profile import Profile
-# from .models.revision import ConfigRevisionProjet, IndiceRevision, RevisionPrix, ValeurIndice
+from .models.revision import ConfigRevisionProjet, IndiceRevision, ValeurIndice
 from .models import Attachement, Decompte, DocumentAdministratif, OrdreService, Projet, Entreprise, AppelOffre, SuiviExecution, Tache, Notification, TypeOrdreService
+from .services.decompte_service import generer_decomptes_portefeuille
 class ProfileInline(admin.StackedInline):
     model = Profile
     can_delete = False
@@ -42,6 +43,14 @@ class ProjetAdmin(admin.ModelAdmin):
     list_per_page = 20
     date_hierarchy = 'date_creation'
 
+    # Action pour générer les décomptes des attachements validés sans décompte
+    actions = ['generer_decomptes']
+
+    def generer_decomptes(self, request, queryset):
+        resultats = generer_decomptes_portefeuille(list(queryset.values_list('id', flat=True)))
+        self.message_user(request, f"{sum(resultats.values())} décompte(s) créé(s) sur {len(resultats)} projet(s).")
+    generer_decomptes.short_description = "Générer les décomptes des attachements validés sans décompte"
+
 # ------------------------ Admin Attachement ------------------------
 @admin.register(Attachement)
 class AttachementAdmin(admin.ModelAdmin):
@@ -138,3 +147,25 @@ class SuiviExecutionAdmin(admin.ModelAdmin):
     date_hierarchy = 'date'
     list_per_page = 20
     
+
+# ------------------------ Admin Indices de révision ------------------------
+@admin.register(IndiceRevision)
+class IndiceRevisionAdmin(admin.ModelAdmin):
+    list_display = ('code', 'libelle', 'unite')
+    search_fields = ('code', 'libelle')
+
+
+@admin.register(ValeurIndice)
+class ValeurIndiceAdmin(admin.ModelAdmin):
+    list_display = ('indice', 'mois', 'valeur', 'date_publication')
+    list_filter = ('indice',)
+    list_select_related = ('indice',)
+    date_hierarchy = 'mois'
+    list_per_page = 50
+
+
+@admin.register(ConfigRevisionProjet)
+class ConfigRevisionProjetAdmin(admin.ModelAdmin):
+    list_display = ('projet', 'partie_fixe', 'mois_base', 'coefficient_K', 'marge_variation', 'date_modification')
+    search_fields = ('projet__nom',)
+    list_select_related = ('projet',)
@@ -0,0 +1,203 @@
+# arbre.py
+# Noyau commun des structures hiérarchiques (bordereaux, attachements)
+# Noeuds à __slots__, parcours itératifs (pas de limite de récursion), profondeur mise en cache
+
+
+class Noeud:
+    """
+    Noeud d'arbre minimal: identifiant, parent, enfants ordonnés et profondeur en cache.
+    Les sous-classes déclarent leurs propres __slots__ pour ne pas réintroduire de __dict__.
+    """
+    __slots__ = ('id', 'parent', 'children', '_profondeur')
+
+    def __init__(self, id=None, parent=None):
+        self.id = id
+        self.parent = None
+        self.children = []
+        self._profondeur = 0
+        if parent is not None:
+            parent.ajouter_enfant(self)
+
+    # ------------------ Structure ------------------
+    def ajouter_enfant(self, enfant, index=None):
+        """Rattache un enfant (à la fin ou à la position index) et met à jour les profondeurs"""
+        if enfant is self or enfant in self.ancetres():
+            raise ValueError("Un noeud ne peut pas devenir son propre descendant")
+        if enfant.parent is not None:
+            enfant.parent.children.remove(enfant)
+        if index is None:
+            self.children.append(enfant)
+        else:
+            self.children.insert(index, enfant)
+        enfant.parent = self
+        enfant._mettre_a_jour_profondeurs(self._profondeur + 1)
+        return enfant
+
+    def retirer_enfant(self, enfant):
+        """Détache un enfant; il devient la racine de son sous-arbre"""
+        if enfant not in self.children:
+            return False
+        self.children.remove(enfant)
+        enfant.parent = None
+        enfant._mettre_a_jour_profondeurs(0)
+        return True
+
+    def _mettre_a_jour_profondeurs(self, profondeur):
+        decalage = profondeur - self._profondeur
+        if decalage:
+            for noeud in self.parcourir():
+                noeud._profondeur += decalage
+
+    def position(self):
+        """Index parmi les frères (-1 pour une racine)"""
+        if self.parent is None:
+            return -1
+        return self.parent.children.index(self)
+
+    @property
+    def profondeur(self):
+        return self._profondeur
+
+    @property
+    def est_feuille(self):
+        return not self.children
+
+    # ------------------ Parcours itératifs ------------------
+    def parcourir(self):
+        """Le noeud puis tous ses descendants, en ordre préfixe"""
+        pile = [self]
+        while pile:
+            noeud = pile.pop()
+            yield noeud
+            pile.extend(reversed(noeud.children))
+
+    def descendants(self):
+        """Tous les descendants en ordre préfixe (le noeud lui-même exclu)"""
+        parcours = self.parcourir()
+        next(parcours)
+        return parcours
+
+    def ancetres(self):
+        """Du parent jusqu'à la racine"""
+        noeud = self.parent
+        while noeud is not None:
+            yield noeud
+            noeud = noeud.parent
+
+    def taille(self):
+        """Nombre de noeuds du sous-arbre, noeud compris"""
+        return sum(1 for _ in self.parcourir())
+
+    def trouver(self, noeud_id):
+        for noeud in self.parcourir():
+            if noeud.id == noeud_id:
+                return noeud
+        return None
+
+    def totaux(self, valeur_feuille):
+        """
+        Cumule valeur_feuille(noeud) des feuilles sur chaque noeud du sous-arbre en un parcours
+        postfixe itératif. Retourne {noeud: total}.
+        """
+        totaux = {}
+        for noeud in reversed(list(self.parcourir())):
+            if noeud.children:
+                totaux[noeud] = sum(totaux[enfant] for enfant in noeud.children)
+            else:
+                totaux[noeud] = valeur_feuille(noeud)
+        return totaux
+
+
+class Arbre:
+    """
+    Racine, index des noeuds par id (accès O(1)) et liste à plat en ordre préfixe
+    maintenue par insertion/suppression de tranches plutôt que reconstruite à chaque modification.
+    """
+    __slots__ = ('racine', 'noeuds', '_ordre', '_positions')
+
+    def __init__(self, racine):
+        self.racine = racine
+        self.noeuds = {}
+        self._ordre = None
+        self._positions = None
+
+    @classmethod
+    def construire(cls, racine, noeuds, parent_id):
+        """Rattache les noeuds à leur parent (parent_id(noeud)) ou à la racine s'il est introuvable"""
+        arbre = cls(racine)
+        for noeud in noeuds:
+            arbre.noeuds[noeud.id] = noeud
+        for noeud in noeuds:
+            parent = arbre.noeuds.get(parent_id(noeud))
+            # Parent introuvable ou cycle de parents: rattachement à la racine
+            if parent is None or parent is noeud or noeud in parent.ancetres():
+                parent = racine
+            parent.ajouter_enfant(noeud)
+        return arbre
+
+    def get(self, noeud_id):
+        return self.noeuds.get(noeud_id)
+
+    # ------------------ Liste à plat ------------------
+    def liste_plate(self):
+        if self._ordre is None:
+            self._ordre = list(self.racine.descendants())
+            self._positions = None
+        return self._ordre
+
+    def _indexer(self, debut=0):
+        ordre = self.liste_plate()
+        if self._positions is None:
+            self._positions, debut = {}, 0
+        for index in range(debut, len(ordre)):
+            self._positions[ordre[index]] = index
+
+    def index(self, noeud):
+        """Position du noeud dans la liste à plat (-1 s'il n'y figure pas, notamment la racine)"""
+        if self._positions is None:
+            self._indexer()
+        return self._positions.get(noeud, -1)
+
+    def invalider(self):
+        self._ordre = None
+        self._positions = None
+
+    # ------------------ Modifications incrémentales ------------------
+    def inserer(self, noeud, parent, index=None):
+        """Insère un noeud (et son sous-arbre) sous parent, à la position index parmi ses frères"""
+        self.retirer(noeud)
+        if self._ordre is not None:
+            freres = parent.children
+            if index is None or index >= len(freres):
+                # Juste après le dernier descendant du parent (la racine est à l'index -1)
+                debut = self.index(parent) + parent.taille()
+            else:
+                debut = self.index(freres[max(index, 0)])
+        parent.ajouter_enfant(noeud, index)
+        for element in noeud.parcourir():
+            self.noeuds[element.id] = element
+        if self._ordre is not None:
+            self._ordre[debut:debut] = list(noeud.parcourir())
+            self._indexer(debut)
+        return noeud
+
+    def retirer(self, noeud):
+        """Détache un noeud et son sous-arbre de l'arbre"""
+        if noeud.parent is None:
+            return noeud
+        if self._ordre is not None:
+            debut = self.index(noeud)
+            if debut >= 0:
+                fin = debut + noeud.taille()
+                for element in self._ordre[debut:fin]:
+                    self._positions.pop(element, None)
+                del self._ordre[debut:fin]
+                self._indexer(debut)
+        noeud.parent.retirer_enfant(noeud)
+        for element in noeud.parcourir():
+            self.noeuds.pop(element.id, None)
+        return noeud
+
+    def deplacer(self, noeud, parent, index=None):
+        self.retirer(noeud)
+        return self.inserer(noeud, parent, index)
@@ -6,6 +6,7 @@ import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 from datetime import datetime
+from projets.services.montants_service import ArbreMontants
 
 class ExcelExporter:
     def __init__(self, projet, lots):
@@ -95,22 +96,26 @@ class ExcelExporter:
         headers = ["N°", "Désignation", "Unité", "Quantité", "PU (MAD)", "Montant (MAD)"]
         ws.append(headers)
         
-        # Données
-        for ligne in lot.lignes.all():
-            indentation = "    " * ligne.level
+        # Données (montants cumulés en une passe vectorisée)
+        arbre = ArbreMontants.charger(lot)
+        montants = arbre.montants_marche().tolist()
+        niveaux = arbre.profondeur.tolist()
+        for i, (_, _, numero, designation, unite, quantite, prix_unitaire, _) in enumerate(arbre.lignes):
+            indentation = "    " * niveaux[i]
             row = [
-                ligne.numero or "",
-                indentation + ligne.designation,
-                ligne.unite or "",
-                ligne.quantite or 0,
-                ligne.prix_unitaire or 0,
-                ligne.montant or 0
+                numero or "",
+                indentation + designation,
+                unite or "",
+                quantite or 0,
+                prix_unitaire or 0,
+                montants[i]
             ]
             ws.append(row)
         
         # Total
-        ws.append(["", "", "", "", "Total HT:", lot.montant_total_ht])
-        ws.append(["", "", "", "", "Total TTC:", lot.montant_total_ttc])  # Exemple TVA
+        total_ht = arbre.montant_total()
+        ws.append(["", "", "", "", "Total HT:", total_ht])
+        ws.append(["", "", "", "", "Total TTC:", total_ht * 1.2])  # Exemple TVA
         
         # Appliquer les styles
         self.apply_styles(ws)
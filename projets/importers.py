@@ -0,0 +1,413 @@
+# importers.py
+# Import d'un bordereau de prix depuis un fichier Excel (lecture en flux, hiérarchie déduite de la numérotation),
+# import en bloc des valeurs d'indices de révision (CSV ou XLSX)
+import csv
+import io
+import itertools
+import re
+import unicodedata
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from zipfile import BadZipFile
+
+import openpyxl
+from django.db import transaction
+from django.db.models import CharField, F, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Cast, Coalesce, Concat
+from openpyxl.utils.exceptions import InvalidFileException
+
+from projets.models import (IndiceRevision, LigneAttachement, LigneBordereau, LotProjet, ValeurIndice,
+                            calculer_hierarchie, calculer_sous_totaux)
+from projets.services.bordereau_service import decimal_or_zero
+from projets.services.indices_service import CacheIndices
+
+
+def normaliser(texte):
+    """Minuscules, sans accents ni espaces superflus (comparaison des en-têtes)"""
+    texte = unicodedata.normalize('NFKD', str(texte or ''))
+    texte = ''.join(c for c in texte if not unicodedata.combining(c))
+    return ' '.join(texte.lower().replace('°', ' ').split())
+
+
+def nombre(valeur):
+    """Cellule numérique ou texte saisi à la française ("1 234,50") -> Decimal (None si vide ou invalide)"""
+    if valeur is None or valeur == '':
+        return None
+    if isinstance(valeur, (int, float, Decimal)):
+        return Decimal(str(valeur))
+    texte = str(valeur).replace('\xa0', '').replace(' ', '').replace(',', '.')
+    try:
+        return Decimal(texte)
+    except InvalidOperation:
+        return None
+
+
+class ExcelImporter:
+    """
+    Importe un bordereau (BPU/DQE) depuis un classeur Excel dans un lot.
+    Le fichier est lu en mode read_only (ligne par ligne, mémoire bornée). La hiérarchie est déduite
+    de la numérotation (1, 1.1, 1.1.2) et des lignes de titre (sans quantité ni prix); bornes, niveaux
+    et sous-totaux sont calculés en mémoire puis les lignes sont insérées par lots (bulk_create).
+    """
+    EN_TETES = {
+        'numero': ('n', 'no', 'num', 'numero', 'n prix', 'numero prix', 'art', 'article'),
+        'designation': ('designation', 'designation des ouvrages', 'libelle', 'description', 'nature des prestations'),
+        'unite': ('u', 'unite', 'unites'),
+        'quantite': ('q', 'qte', 'quantite', 'quantites'),
+        'prix_unitaire': ('pu', 'p.u', 'p.u.', 'pu (mad)', 'pu (dh)', 'prix unitaire', 'prix unitaire ht', 'prix'),
+    }
+    # Colonnes de l'export (ExcelExporter): N°, Désignation, Unité, Quantité, PU
+    COLONNES_DEFAUT = {'numero': 0, 'designation': 1, 'unite': 2, 'quantite': 3, 'prix_unitaire': 4}
+    LIGNES_EN_TETE_MAX = 30
+    TAILLE_LOT = 1000
+    NUMERO = re.compile(r'^\d+(?:[.\-]\d+)*$')
+    REMPLACEMENT_IMPOSSIBLE = ("des attachements ont déjà des quantités saisies sur les lignes de ce lot; "
+                               "le remplacement les supprimerait. Importez les lignes à la suite ou supprimez "
+                               "d'abord ces saisies.")
+
+    def __init__(self, lot, remplacer=False):
+        self.lot = lot
+        self.remplacer = remplacer
+        self.lignes = []
+        self.titres_deduits = 0
+
+    # ------------------ Lecture ------------------
+    def detecter_colonnes(self, valeurs):
+        """Retourne {champ: index de colonne} si la ligne ressemble à une ligne d'en-têtes, sinon None"""
+        colonnes = {}
+        for index, valeur in enumerate(valeurs):
+            texte = normaliser(valeur)
+            for champ, libelles in self.EN_TETES.items():
+                if champ not in colonnes and (texte in libelles or (champ == 'designation' and texte.startswith('designation'))):
+                    colonnes[champ] = index
+                    break
+        if 'designation' in colonnes and len(colonnes) >= 3:
+            return colonnes
+        return None
+
+    def lire(self, fichier, feuille=None):
+        """Parcourt la feuille en flux et retourne les lignes brutes (dicts) du bordereau"""
+        try:
+            classeur = openpyxl.load_workbook(fichier, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile, KeyError, OSError) as e:
+            raise ValueError(f"Fichier Excel illisible: {e}")
+
+        try:
+            if feuille:
+                if feuille not in classeur.sheetnames:
+                    raise ValueError(f"Feuille '{feuille}' introuvable")
+                ws = classeur[feuille]
+            else:
+                ws = classeur.active
+
+            colonnes = None
+            lignes = []
+            for rang, valeurs in enumerate(ws.iter_rows(values_only=True)):
+                if colonnes is None:
+                    colonnes = self.detecter_colonnes(valeurs) if rang < self.LIGNES_EN_TETE_MAX else None
+                    if colonnes is not None:
+                        continue
+                    if rang < self.LIGNES_EN_TETE_MAX:
+                        continue
+                    # Pas d'en-têtes reconnus: disposition de l'export, relecture depuis le début
+                    return self.lire_sans_en_tetes(ws)
+                ligne = self.extraire(valeurs, colonnes)
+                if ligne is not None:
+                    lignes.append(ligne)
+            if colonnes is None:
+                return self.lire_sans_en_tetes(ws)
+            return lignes
+        finally:
+            classeur.close()
+
+    def lire_sans_en_tetes(self, ws):
+        lignes = []
+        for valeurs in ws.iter_rows(values_only=True):
+            ligne = self.extraire(valeurs, self.COLONNES_DEFAUT)
+            if ligne is not None:
+                lignes.append(ligne)
+        return lignes
+
+    def extraire(self, valeurs, colonnes):
+        """Ligne du fichier -> dict, ou None pour une ligne vide ou de total"""
+        def cellule(champ):
+            index = colonnes.get(champ)
+            return valeurs[index] if index is not None and index < len(valeurs) else None
+
+        numero = str(cellule('numero') or '').strip().rstrip('.')
+        designation = str(cellule('designation') or '').strip()
+        if not designation:
+            return None
+        if not numero and normaliser(designation).startswith(('total', 'sous-total', 'sous total', 'montant')):
+            return None
+        quantite = nombre(cellule('quantite'))
+        prix_unitaire = nombre(cellule('prix_unitaire'))
+        unite = str(cellule('unite') or '').strip()
+        return {
+            'numero': numero[:20],
+            'designation': designation,
+            'unite': unite[:10],
+            'quantite': quantite,
+            'prix_unitaire': prix_unitaire,
+            'est_titre': not quantite and not prix_unitaire and not unite,
+        }
+
+    # ------------------ Hiérarchie ------------------
+    def deduire_hierarchie(self, lignes):
+        """
+        Affecte à chaque ligne une clé et la clé de son parent:
+        - numérotation décimale: parent = plus long préfixe déjà rencontré (1.1.2 -> 1.1 -> 1);
+        - numérotation non décimale ou absente: un titre ouvre une section racine,
+          un article est rattaché au dernier titre ouvert.
+        Une ligne qui reçoit des enfants devient un titre.
+        """
+        par_numero = {}
+        par_cle = {}
+        titre_courant = None
+        for index, ligne in enumerate(lignes):
+            cle = f"import_{index}"
+            ligne['id'] = cle
+            par_cle[cle] = ligne
+            numero = ligne['numero'].replace('-', '.')
+            parent = None
+            if self.NUMERO.match(numero):
+                segments = numero.split('.')
+                for taille in range(len(segments) - 1, 0, -1):
+                    parent = par_numero.get('.'.join(segments[:taille]))
+                    if parent is not None:
+                        break
+                if parent is None and titre_courant is not None and not self.NUMERO.match(
+                        titre_courant['numero'].replace('-', '.')):
+                    # Section non numérotée (ex: "A - TERRASSEMENTS") contenant des prix numérotés
+                    parent = titre_courant
+                par_numero[numero] = ligne
+            elif not ligne['est_titre']:
+                parent = titre_courant
+            ligne['parent_id'] = parent['id'] if parent is not None else None
+            if ligne['est_titre']:
+                titre_courant = ligne
+
+        for ligne in lignes:
+            parent = par_cle.get(ligne['parent_id'])
+            if parent is not None and not parent['est_titre']:
+                parent['est_titre'] = True
+                self.titres_deduits += 1
+        return lignes
+
+    # ------------------ Écriture ------------------
+    def instancier(self, lignes):
+        """
+        Instances non enregistrées, identifiées provisoirement par des ids négatifs afin de calculer
+        bornes, niveaux et sous-totaux avant l'insertion (ils ne dépendent pas des ids définitifs)
+        """
+        ids = {ligne['id']: -(index + 1) for index, ligne in enumerate(lignes)}
+        instances = []
+        for index, ligne in enumerate(lignes):
+            instance = LigneBordereau(
+                id=ids[ligne['id']],
+                lot=self.lot,
+                parent_id=ids.get(ligne['parent_id']),
+                numero=ligne['numero'],
+                designation=ligne['designation'],
+                unite=ligne['unite'],
+                quantite=decimal_or_zero(ligne['quantite']),
+                prix_unitaire=decimal_or_zero(ligne['prix_unitaire']),
+                est_titre=ligne['est_titre'],
+                ordre_affichage=index,
+            )
+            instance.montant_calcule = instance.quantite * instance.prix_unitaire
+            instances.append(instance)
+        calculer_hierarchie(instances)
+        calculer_sous_totaux(instances, {})
+        return instances
+
+    def saisies_existantes(self):
+        """Vrai si des attachements ont des quantités sur les lignes du lot (supprimées en cascade par un remplacement)"""
+        return LigneAttachement.objects.filter(ligne_lot__lot=self.lot).exists()
+
+    def enregistrer(self, lignes):
+        """
+        Insère les lignes niveau par niveau (les parents avant leurs enfants, donc parent_id connu à l'insertion),
+        puis complète le chemin de chaque niveau en une requête. Nombre de requêtes proportionnel à la profondeur.
+        """
+        instances = self.instancier(lignes)
+        with transaction.atomic():
+            LotProjet.objects.select_for_update().filter(pk=self.lot.pk).first()
+            existantes = LigneBordereau.objects.filter(lot=self.lot)
+            if self.remplacer:
+                if self.saisies_existantes():
+                    raise ValueError(self.REMPLACEMENT_IMPOSSIBLE)
+                existantes.delete()
+                decalages = {'ordre': None, 'borne': None}
+            else:
+                # Les lignes importées sont ajoutées après les lignes existantes
+                decalages = existantes.aggregate(ordre=Max('ordre_affichage'), borne=Max('borne_droite'))
+            decalage_ordre = (decalages['ordre'] or 0) + 1 if decalages['ordre'] is not None else 0
+            decalage_borne = decalages['borne'] or 0
+
+            par_id = {instance.id: instance for instance in instances}
+            par_niveau = {}
+            for instance in instances:
+                instance.ordre_affichage += decalage_ordre
+                instance.borne_gauche += decalage_borne
+                instance.borne_droite += decalage_borne
+                instance.chemin = ''
+                if instance.has_children:
+                    instance.montant_calcule = instance.sous_total_marche
+                par_niveau.setdefault(instance.niveau, []).append((instance, par_id.get(instance.parent_id)))
+
+            chemin_parent = Subquery(LigneBordereau.objects.filter(pk=OuterRef('parent_id')).values('chemin')[:1])
+            for niveau in sorted(par_niveau):
+                for instance, parent in par_niveau[niveau]:
+                    instance.id = None
+                    instance.parent_id = parent.id if parent is not None else None
+                LigneBordereau.objects.bulk_create([instance for instance, _ in par_niveau[niveau]],
+                                                   batch_size=self.TAILLE_LOT)
+                LigneBordereau.objects.filter(lot=self.lot, niveau=niveau, chemin='').update(
+                    chemin=Concat(Coalesce(chemin_parent, Value('')), Cast('id', CharField()), Value('/'))
+                )
+
+            LotProjet.objects.filter(pk=self.lot.pk).update(revision=F('revision') + 1)
+        return instances
+
+    def importer(self, fichier, feuille=None):
+        """Lit, structure et enregistre le bordereau. Retourne le nombre de lignes importées"""
+        lignes = self.deduire_hierarchie(self.lire(fichier, feuille))
+        if not lignes:
+            raise ValueError("Aucune ligne de bordereau trouvée dans le fichier")
+        self.lignes = self.enregistrer(lignes)
+        return len(self.lignes)
+
+
+def jour(valeur):
+    """Cellule date ou texte (AAAA-MM-JJ, JJ/MM/AAAA, AAAA-MM, MM/AAAA) -> date (None si vide ou invalide)"""
+    if isinstance(valeur, datetime):
+        return valeur.date()
+    if isinstance(valeur, date):
+        return valeur
+    texte = str(valeur or '').strip()[:10]
+    for motif in ('%Y-%m-%d', '%d/%m/%Y', '%Y-%m', '%m/%Y', '%Y/%m'):
+        try:
+            return datetime.strptime(texte, motif).date()
+        except ValueError:
+            continue
+    return None
+
+
+def mois(valeur):
+    """Cellule date ou texte -> premier jour du mois (None si vide ou invalide)"""
+    valeur = jour(valeur)
+    return valeur.replace(day=1) if valeur else None
+
+
+class IndicesImporter:
+    """
+    Importe des valeurs officielles d'indices de révision depuis un fichier CSV ou XLSX
+    (colonnes code, mois, valeur, et facultativement date_publication et libelle).
+    Le fichier est lu en flux; les valeurs sont écrites par lots de TAILLE_LOT par un bulk_create
+    en upsert sur (indice, mois), les indices inconnus étant créés au passage.
+    Les lignes illisibles sont ignorées et comptées dans self.erreurs.
+    """
+    EN_TETES = {
+        'code': ('code', 'indice', 'code indice'),
+        'mois': ('mois', 'periode', 'date', 'mois de valeur'),
+        'valeur': ('valeur', 'valeur indice', 'indice valeur'),
+        'date_publication': ('date publication', 'date_publication', 'publication', 'date de publication'),
+        'libelle': ('libelle', 'designation', 'intitule'),
+    }
+    LIGNES_EN_TETE_MAX = 30
+    TAILLE_LOT = 2000
+
+    def __init__(self):
+        self.indices = {}
+        self.importees = 0
+        self.erreurs = []
+
+    # ------------------ Lecture ------------------
+    def rangees_csv(self, fichier):
+        if isinstance(fichier, (str, bytes)) or hasattr(fichier, '__fspath__'):
+            flux = open(fichier, encoding='utf-8-sig', newline='')
+        else:
+            flux = io.TextIOWrapper(fichier, encoding='utf-8-sig', newline='')
+        with flux:
+            debut = flux.readline()
+            delimiteur = ';' if debut.count(';') >= debut.count(',') else ','
+            yield from csv.reader(itertools.chain([debut], flux), delimiter=delimiteur)
+
+    def rangees_xlsx(self, fichier, feuille=None):
+        try:
+            classeur = openpyxl.load_workbook(fichier, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile, KeyError, OSError) as e:
+            raise ValueError(f"Fichier Excel illisible: {e}")
+        try:
+            if feuille and feuille not in classeur.sheetnames:
+                raise ValueError(f"Feuille '{feuille}' introuvable")
+            yield from (classeur[feuille] if feuille else classeur.active).iter_rows(values_only=True)
+        finally:
+            classeur.close()
+
+    def lire(self, fichier, feuille=None):
+        """Génère les valeurs (code, mois, valeur, date_publication, libelle) du fichier, en flux"""
+        nom = str(getattr(fichier, 'name', fichier)).lower()
+        rangees = self.rangees_csv(fichier) if nom.endswith(('.csv', '.txt')) else self.rangees_xlsx(fichier, feuille)
+        colonnes = None
+        for rang, valeurs in enumerate(rangees, start=1):
+            if colonnes is None:
+                # Les lignes de titre précédant les en-têtes sont ignorées
+                trouvees = {champ: index for index, valeur in enumerate(valeurs)
+                            for champ, libelles in self.EN_TETES.items() if normaliser(valeur) in libelles}
+                if {'code', 'mois', 'valeur'} <= trouvees.keys():
+                    colonnes = trouvees
+                elif rang >= self.LIGNES_EN_TETE_MAX:
+                    raise ValueError("En-têtes attendus: code, mois, valeur (date_publication et libelle facultatifs)")
+                continue
+
+            def cellule(champ):
+                index = colonnes.get(champ)
+                return valeurs[index] if index is not None and index < len(valeurs) else None
+
+            code = str(cellule('code') or '').strip().upper()
+            if not code:
+                continue
+            valeur, periode = nombre(cellule('valeur')), mois(cellule('mois'))
+            if valeur is None or periode is None:
+                self.erreurs.append(f"Ligne {rang}: mois ou valeur invalide pour {code}")
+                continue
+            yield (code, periode, valeur, jour(cellule('date_publication')), str(cellule('libelle') or '').strip())
+
+    # ------------------ Écriture ------------------
+    def resoudre_indices(self, lot):
+        """Ids des indices du lot, ceux inconnus étant créés (deux requêtes au plus par lot)"""
+        inconnus = {code: libelle for code, _, _, _, libelle in lot if code not in self.indices}
+        if not inconnus:
+            return
+        IndiceRevision.objects.bulk_create(
+            [IndiceRevision(code=code, libelle=libelle) for code, libelle in inconnus.items()], ignore_conflicts=True
+        )
+        self.indices.update(IndiceRevision.objects.filter(code__in=list(inconnus)).values_list('code', 'id'))
+
+    def enregistrer(self, lot):
+        self.resoudre_indices(lot)
+        # Une seule valeur par (indice, mois) dans un même upsert: la dernière du fichier l'emporte
+        valeurs = {
+            (code, periode): ValeurIndice(indice_id=self.indices[code], mois=periode, valeur=valeur,
+                                          date_publication=publication)
+            for code, periode, valeur, publication, _ in lot
+        }
+        ValeurIndice.objects.bulk_create(
+            list(valeurs.values()), update_conflicts=True, unique_fields=['indice', 'mois'],
+            update_fields=['valeur', 'date_publication'],
+        )
+        self.importees += len(valeurs)
+
+    def importer(self, fichier, feuille=None):
+        """Lit et enregistre les valeurs par lots. Retourne le nombre de valeurs importées"""
+        self.indices = dict(IndiceRevision.objects.values_list('code', 'id'))
+        with transaction.atomic():
+            valeurs = self.lire(fichier, feuille)
+            while lot := list(itertools.islice(valeurs, self.TAILLE_LOT)):
+                self.enregistrer(lot)
+        if not self.importees:
+            raise ValueError("Aucune valeur d'indice trouvée dans le fichier")
+        CacheIndices.invalider()
+        return self.importees
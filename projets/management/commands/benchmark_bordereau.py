@@ -0,0 +1,160 @@
+# projets/management/commands/benchmark_bordereau.py
+import json
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from projets.exporters import ExcelExporter
+from projets.manager import LigneHierarchique, LineManager
+from projets.models import Attachement, LigneBordereau, LotProjet
+from projets.services.controle_service import FicheControle
+from projets.services.generateur_service import GenerateurProjet
+from projets.views.views import fiche_controle
+
+
+class Command(BaseCommand):
+    """
+    Mesure les chemins critiques du bordereau et des attachements sur des projets synthétiques de tailles croissantes:
+    temps (meilleur de N répétitions), nombre de requêtes SQL et pic mémoire Python (tracemalloc).
+    Les résultats peuvent être enregistrés en JSON et comparés à une référence pour détecter les régressions.
+    Les projets sont générés dans la base de test (test_<nom>, créée puis détruite comme par le lanceur de tests),
+    jamais dans la base configurée.
+    """
+
+    help = 'Mesure temps, requêtes et mémoire des chemins critiques bordereau/attachement à plusieurs tailles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tailles', type=int, nargs='+', default=[1000, 10000, 30000],
+                            help='Nombres de lignes par lot à mesurer (défaut: 1000 10000 30000)')
+        parser.add_argument('--lots', type=int, default=2, help='Nombre de lots par projet (défaut: 2)')
+        parser.add_argument('--attachements', type=int, default=24, help="Nombre d'attachements (défaut: 24)")
+        parser.add_argument('--repetitions', type=int, default=3, help='Répétitions par mesure (défaut: 3)')
+        parser.add_argument('--graine', type=int, default=42, help='Graine aléatoire (défaut: 42)')
+        parser.add_argument('--sortie', type=str, help='Fichier JSON où enregistrer les résultats')
+        parser.add_argument('--reference', type=str, help='Résultats JSON de référence à comparer')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Écart relatif toléré sur le temps et la mémoire avant de signaler une régression (défaut: 0.25)')
+        parser.add_argument('--garder', action='store_true',
+                            help='Conserve la base de test et les projets générés (réutilisés au prochain lancement)')
+
+    def chemins(self, projet):
+        """Chemins critiques mesurés: {nom: fonction sans argument}"""
+        lots = list(LotProjet.objects.filter(projet=projet).order_by('id'))
+        lot = lots[0]
+        dernier = Attachement.objects.filter(projet=projet).order_by('-date_etablissement').first()
+        requete = RequestFactory().get(f"/projet/{projet.id}/fiche-contrle/",
+                                       {'attachement_id': dernier.id} if dernier else {})
+        requete.user = User(username='benchmark', is_staff=True, is_superuser=True)
+        # Clé de la fiche en cache (rien ne la modifie pendant les mesures): seule cette entrée est supprimée
+        cle_fiche = FicheControle(projet, dernier, dernier.get_previous_attachement()).cle(lots) if dernier else None
+
+        def line_manager():
+            manager = LineManager(lot.nom)
+            manager.set_model_data(lot)
+            return manager.get_cached_flat_list()
+
+        def fiche():
+            # Le résultat est mis en cache: on mesure le calcul, pas la lecture du cache
+            if cle_fiche:
+                cache.delete(cle_fiche)
+            return fiche_controle(requete, projet.id)
+
+        def ligne_hierarchique():
+            racine = LigneHierarchique({'id': 0, 'designation': lot.nom})
+            racine.build_tree(LigneBordereau.objects.filter(lot=lot).order_by('id'), racine)
+            return racine.export_to_table()
+
+        return {
+            'LineManager.set_model_data': line_manager,
+            'LotProjet.to_line_tree': lot.to_line_tree,
+            'LigneHierarchique.build_tree': ligne_hierarchique,
+            'fiche_controle': fiche,
+            'ExcelExporter.export': lambda: ExcelExporter(projet, lots).export(),
+        }
+
+    def mesurer(self, fonction, repetitions):
+        """Meilleur temps sur les répétitions, requêtes et pic mémoire de la première exécution"""
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as requetes:
+            debut = time.perf_counter()
+            fonction()
+            temps = [time.perf_counter() - debut]
+        _, pic = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Les répétitions suivantes sont chronométrées sans tracemalloc, qui ralentit les allocations
+        for _ in range(repetitions - 1):
+            debut = time.perf_counter()
+            fonction()
+            temps.append(time.perf_counter() - debut)
+        return {'temps_ms': round(min(temps) * 1000, 1), 'requetes': len(requetes), 'memoire_ko': round(pic / 1024)}
+
+    def comparer(self, resultats, reference, tolerance):
+        """Liste des mesures dégradées par rapport à la référence"""
+        regressions = []
+        for cle, mesure in resultats.items():
+            ancienne = reference.get(cle)
+            if not ancienne:
+                continue
+            if mesure['requetes'] > ancienne['requetes']:
+                regressions.append(f"{cle}: requêtes {ancienne['requetes']} -> {mesure['requetes']}")
+            for champ in ('temps_ms', 'memoire_ko'):
+                if ancienne[champ] and mesure[champ] > ancienne[champ] * (1 + tolerance):
+                    regressions.append(f"{cle}: {champ} {ancienne[champ]} -> {mesure[champ]}")
+        return regressions
+
+    def mesurer_tailles(self, options):
+        """Génère un projet par taille et mesure ses chemins critiques: {chemin@taille: mesure}"""
+        resultats = {}
+        for taille in options['tailles']:
+            self.stdout.write(f"🔍 {options['lots']} lot(s) x {taille} ligne(s), {options['attachements']} attachement(s)")
+            generateur = GenerateurProjet(lots=options['lots'], lignes=taille, attachements=options['attachements'],
+                                          graine=options['graine'])
+            debut = time.perf_counter()
+            projet = generateur.generer()
+            self.stdout.write(f"   Génération: {time.perf_counter() - debut:.1f} s")
+            try:
+                for nom, fonction in self.chemins(projet).items():
+                    mesure = self.mesurer(fonction, options['repetitions'])
+                    resultats[f"{nom}@{taille}"] = mesure
+                    self.stdout.write(f"   {nom:<32} {mesure['temps_ms']:>10.1f} ms {mesure['requetes']:>6} requête(s) "
+                                      f"{mesure['memoire_ko']:>10} Ko")
+            finally:
+                if not options['garder']:
+                    projet.delete()
+        return resultats
+
+    def handle(self, *args, **options):
+        if options['repetitions'] < 1:
+            raise CommandError("--repetitions doit être positif")
+        reference = None
+        if options['reference']:
+            with open(options['reference'], encoding='utf-8') as fichier:
+                reference = json.load(fichier)
+
+        # Base de test: les projets synthétiques n'écrivent jamais dans la base configurée
+        nom_base = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False, keepdb=options['garder'])
+        try:
+            resultats = self.mesurer_tailles(options)
+        finally:
+            if not options['garder']:
+                connection.creation.destroy_test_db(nom_base, verbosity=0)
+
+        if options['sortie']:
+            with open(options['sortie'], 'w', encoding='utf-8') as fichier:
+                json.dump(resultats, fichier, indent=2, ensure_ascii=False)
+            self.stdout.write(f"Résultats enregistrés dans {options['sortie']}")
+
+        if reference is not None:
+            regressions = self.comparer(resultats, reference, options['tolerance'])
+            for regression in regressions:
+                self.stdout.write(self.style.ERROR(f"❌ {regression}"))
+            if regressions:
+                raise CommandError(f"{len(regressions)} régression(s) par rapport à {options['reference']}")
+            self.stdout.write(self.style.SUCCESS("✅ Aucune régression par rapport à la référence"))
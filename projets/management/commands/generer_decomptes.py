@@ -0,0 +1,52 @@
+# projets/management/commands/generer_decomptes.py
+import os
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from projets.services.decompte_service import generer_decomptes_portefeuille
+
+
+class Command(BaseCommand):
+    """Crée les décomptes de fin de mois de tous les attachements validés qui n'en ont pas encore"""
+
+    help = 'Génère en masse les décomptes des attachements validés sans décompte, projet par projet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projet',
+            type=int,
+            action='append',
+            help='Identifiant du projet à traiter (répétable, tout le portefeuille par défaut)'
+        )
+        parser.add_argument(
+            '--date-emission',
+            type=str,
+            help="Date d'émission des décomptes, AAAA-MM-JJ (défaut: aujourd'hui)"
+        )
+        parser.add_argument(
+            '--processus',
+            type=int,
+            default=min(4, os.cpu_count() or 1),
+            help='Nombre de processus traitant les projets en parallèle (défaut: min(4, nombre de CPU))'
+        )
+
+    def handle(self, *args, **options):
+        date_emission = None
+        if options['date_emission']:
+            try:
+                date_emission = date.fromisoformat(options['date_emission'])
+            except ValueError:
+                raise CommandError("--date-emission doit être au format AAAA-MM-JJ")
+
+        self.stdout.write("🔍 Génération des décomptes des attachements validés sans décompte")
+        debut = time.perf_counter()
+        resultats = generer_decomptes_portefeuille(options['projet'], date_emission, options['processus'])
+        for projet_id, nombre in resultats.items():
+            self.stdout.write(f"   Projet {projet_id}: {nombre} décompte(s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {sum(resultats.values())} décompte(s) créé(s) sur {len(resultats)} projet(s) "
+            f"en {time.perf_counter() - debut:.1f} s"
+        ))
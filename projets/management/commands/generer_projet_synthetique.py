@@ -0,0 +1,41 @@
+# projets/management/commands/generer_projet_synthetique.py
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from projets.models import Projet
+from projets.services.generateur_service import GenerateurProjet
+
+
+class Command(BaseCommand):
+    """Génère un projet synthétique (lots, bordereaux profonds, attachements) pour les mesures de performance"""
+
+    help = 'Génère un projet synthétique: N lots, arbres de profondeur fixe, série d\'attachements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lots', type=int, default=3, help='Nombre de lots (défaut: 3)')
+        parser.add_argument('--lignes', type=int, default=10000, help='Nombre de lignes par lot (défaut: 10000)')
+        parser.add_argument('--profondeur', type=int, default=5, help="Profondeur des arbres (défaut: 5)")
+        parser.add_argument('--attachements', type=int, default=24, help="Nombre d'attachements (défaut: 24)")
+        parser.add_argument('--graine', type=int, help='Graine aléatoire (génération reproductible)')
+        parser.add_argument('--numero', type=str, help='Numéro de marché du projet créé')
+        parser.add_argument('--utilisateur', type=str, help="Nom d'utilisateur rattaché au projet créé")
+
+    def handle(self, *args, **options):
+        if options['lignes'] < 1 or options['lots'] < 1:
+            raise CommandError("--lots et --lignes doivent être positifs")
+        if options['numero'] and Projet.objects.filter(numero=options['numero']).exists():
+            raise CommandError(f"Le numéro de marché '{options['numero']}' existe déjà")
+        utilisateur = None
+        if options['utilisateur']:
+            utilisateur = User.objects.filter(username=options['utilisateur']).first()
+            if utilisateur is None:
+                raise CommandError(f"Utilisateur '{options['utilisateur']}' introuvable")
+
+        self.stdout.write(
+            f"🔍 Génération: {options['lots']} lot(s) x {options['lignes']} ligne(s), "
+            f"profondeur {options['profondeur']}, {options['attachements']} attachement(s)"
+        )
+        generateur = GenerateurProjet(lots=options['lots'], lignes=options['lignes'], profondeur=options['profondeur'],
+                                      attachements=options['attachements'], graine=options['graine'])
+        projet = generateur.generer(options['numero'], utilisateur=utilisateur)
+        self.stdout.write(self.style.SUCCESS(f"✅ Projet {projet.numero} créé (id {projet.id})"))
@@ -1,29 +1,58 @@
 # management/commands/import_indices.py
-from django.core.management.base import BaseCommand
-from projets.models import IndiceRevision, ValeurIndice
-import csv
-from datetime import datetime
+from django.core.management.base import BaseCommand, CommandError
+from projets.importers import IndicesImporter
+from projets.models import IndiceRevision
+from projets.services.revision_service import MoteurRevision
+
 
 class Command(BaseCommand):
-    help = 'Importe les indices de révision officiels'
-    
-    def handle(self, *args, **kwargs):
-        # Indices officiels marocains (exemples)
-        indices = [
-            {'code': 'BT01', 'libelle': 'Bâtiment gros œuvre', 'unite': 'Index'},
-            {'code': 'BT02', 'libelle': 'Bâtiment second œuvre', 'unite': 'Index'},
-            {'code': 'TP01', 'libelle': 'Travaux publics terrassement', 'unite': 'Index'},
-            {'code': 'MA01', 'libelle': 'Main d\'œuvre bâtiment', 'unite': 'Heure'},
-            {'code': 'AC01', 'libelle': 'Acier de construction', 'unite': 'Tonne'},
-            {'code': 'CM01', 'libelle': 'Ciment', 'unite': 'Tonne'},
-        ]
-        
-        for data in indices:
-            indice, created = IndiceRevision.objects.update_or_create(
-                code=data['code'],
-                defaults=data
-            )
-            if created:
-                self.stdout.write(f"Créé: {indice}")
-            else:
-                self.stdout.write(f"Mis à jour: {indice}")
\ No newline at end of file
+    help = 'Importe les indices de révision officiels et, depuis un fichier CSV ou XLSX, leurs valeurs mensuelles'
+
+    # Indices officiels marocains (exemples)
+    INDICES = [
+        {'code': 'BT01', 'libelle': 'Bâtiment gros œuvre', 'unite': 'Index'},
+        {'code': 'BT02', 'libelle': 'Bâtiment second œuvre', 'unite': 'Index'},
+        {'code': 'TP01', 'libelle': 'Travaux publics terrassement', 'unite': 'Index'},
+        {'code': 'MA01', 'libelle': 'Main d\'œuvre bâtiment', 'unite': 'Heure'},
+        {'code': 'AC01', 'libelle': 'Acier de construction', 'unite': 'Tonne'},
+        {'code': 'CM01', 'libelle': 'Ciment', 'unite': 'Tonne'},
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'fichier',
+            nargs='?',
+            help='Fichier CSV ou XLSX des valeurs (colonnes code, mois, valeur, date_publication, libelle)'
+        )
+        parser.add_argument(
+            '--feuille',
+            help='Feuille du classeur XLSX (feuille active par défaut)'
+        )
+        parser.add_argument(
+            '--reviser',
+            action='store_true',
+            help='Recalcule ensuite la révision des prix des décomptes des projets configurés'
+        )
+
+    def handle(self, *args, **options):
+        indices = IndiceRevision.objects.bulk_create(
+            [IndiceRevision(**data) for data in self.INDICES],
+            update_conflicts=True, unique_fields=['code'], update_fields=['libelle', 'unite'],
+        )
+        self.stdout.write(f"✅ {len(indices)} indice(s) de référence créé(s) ou mis à jour")
+
+        if not options['fichier']:
+            return
+        importer = IndicesImporter()
+        try:
+            importees = importer.importer(options['fichier'], options['feuille'])
+        except (ValueError, OSError) as e:
+            raise CommandError(str(e))
+        for erreur in importer.erreurs:
+            self.stdout.write(self.style.WARNING(f"   {erreur}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {importees} valeur(s) importée(s), {len(importer.erreurs)} ligne(s) ignorée(s)"
+        ))
+        if options['reviser']:
+            modifies = MoteurRevision().enregistrer()
+            self.stdout.write(self.style.SUCCESS(f"✅ {len(modifies)} décompte(s) révisé(s)"))
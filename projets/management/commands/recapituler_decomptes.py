@@ -0,0 +1,39 @@
+# projets/management/commands/recapituler_decomptes.py
+from django.core.management.base import BaseCommand
+
+from projets.models import Decompte
+from projets.services.recapitulatif_service import RecapitulatifDecomptes
+
+
+class Command(BaseCommand):
+    """Recalcule et enregistre le résumé (HT, TVA, TTC, acompte) des décomptes à partir de leurs lignes"""
+
+    help = 'Recalcule les récapitulatifs des décomptes en requêtes groupées et enregistre les résumés en bloc'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projet',
+            type=int,
+            action='append',
+            help='Identifiant du projet à traiter (répétable, tous les projets par défaut)'
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='Affiche le résumé de chaque décompte'
+        )
+
+    def handle(self, *args, **options):
+        decomptes = Decompte.objects.all()
+        if options['projet']:
+            decomptes = decomptes.filter(attachement__projet_id__in=options['projet'])
+
+        self.stdout.write("🔍 Calcul des récapitulatifs des décomptes")
+        recapitulatifs = RecapitulatifDecomptes(decomptes).enregistrer()
+        if options['verbose']:
+            for decompte_id, recapitulatif in recapitulatifs.items():
+                resume = recapitulatif['resume']
+                self.stdout.write(f"   Décompte {decompte_id}: {len(recapitulatif['lignes'])} ligne(s), "
+                                  f"HT {resume.total_ht}, TTC {resume.total_ttc}, acompte {resume.acompte_ttc}")
+
+        self.stdout.write(self.style.SUCCESS(f"✅ {len(recapitulatifs)} résumé(s) enregistré(s)"))
@@ -0,0 +1,39 @@
+# projets/management/commands/reconstruire_cumuls.py
+from django.core.management.base import BaseCommand
+
+from projets.models import Projet
+from projets.services.cumuls_service import RegistreCumuls
+
+
+class Command(BaseCommand):
+    """Reconstruit le registre des cumuls (S-1, partiel, S) des lignes d'attachement"""
+
+    help = 'Reconstruit le registre des quantités et montants cumulés par ligne de bordereau et par attachement'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projet',
+            type=int,
+            action='append',
+            help='Identifiant du projet à reconstruire (répétable, tous les projets par défaut)'
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='Affiche le détail par projet'
+        )
+
+    def handle(self, *args, **options):
+        projets = Projet.objects.order_by('id')
+        if options['projet']:
+            projets = projets.filter(id__in=options['projet'])
+
+        self.stdout.write("🔍 Reconstruction du registre des cumuls")
+        total = 0
+        for projet_id in projets.values_list('id', flat=True).iterator():
+            entrees = RegistreCumuls(projet_id).reconstruire()
+            total += entrees
+            if options['verbose']:
+                self.stdout.write(f"   Projet {projet_id}: {entrees} entrée(s)")
+
+        self.stdout.write(self.style.SUCCESS(f"✅ {total} entrée(s) enregistrée(s)"))
@@ -0,0 +1,34 @@
+# projets/management/commands/reconstruire_situations.py
+from django.core.management.base import BaseCommand
+
+from projets.services.situation_service import GrandLivreProjet
+
+
+class Command(BaseCommand):
+    """Reconstruit la situation financière (grand livre des décomptes) des projets"""
+
+    help = 'Reconstruit les cumuls facturés, retenus, payés et restant à payer de chaque projet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projet',
+            type=int,
+            action='append',
+            help='Identifiant du projet à reconstruire (répétable, tous les projets par défaut)'
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='Affiche le détail par projet'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write("🔍 Reconstruction des situations financières")
+        situations = GrandLivreProjet.reconstruire(options['projet'])
+        if options['verbose']:
+            for situation in situations:
+                self.stdout.write(f"   Projet {situation.projet_id}: {situation.nb_decomptes} décompte(s), "
+                                  f"net {situation.net_a_payer_cumule}, payé {situation.montant_paye}, "
+                                  f"reste {situation.montant_restant}")
+
+        self.stdout.write(self.style.SUCCESS(f"✅ {len(situations)} situation(s) enregistrée(s)"))
@@ -0,0 +1,51 @@
+# projets/management/commands/reindexer_bordereaux.py
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from projets.models import LigneBordereau, LotProjet
+
+
+class Command(BaseCommand):
+    """
+    Reconstruit le chemin, le niveau et les bornes hiérarchiques des lignes de bordereau, puis leurs sous-totaux
+    marché et réalisé. À lancer une fois sur une base existante: les montants des lots, des titres, de la fiche
+    de contrôle et du tableau de bord sont lus dans sous_total_marche / sous_total_realise.
+    """
+
+    help = ('Reconstruit la hiérarchie matérialisée (chemin, niveau, bornes) et les sous-totaux '
+            '(sous_total_marche, sous_total_realise) des lignes de bordereau')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lot',
+            type=int,
+            action='append',
+            help='Identifiant du lot à reconstruire (répétable, tous les lots par défaut)'
+        )
+        parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='Affiche le détail par lot'
+        )
+
+    def handle(self, *args, **options):
+        lots = LotProjet.objects.order_by('id')
+        if options['lot']:
+            lots = lots.filter(id__in=options['lot'])
+
+        self.stdout.write("🔍 Reconstruction de la hiérarchie et des sous-totaux des bordereaux")
+        total, total_sous_totaux = 0, 0
+        for lot_id in lots.values_list('id', flat=True).iterator():
+            with transaction.atomic():
+                modifiees = LigneBordereau.reindexer_lot(lot_id)
+                # Les sous-totaux se calculent sur la hiérarchie reconstruite
+                sous_totaux = LigneBordereau.recalculer_sous_totaux(lot_id)
+            total += modifiees
+            total_sous_totaux += sous_totaux
+            if options['verbose']:
+                self.stdout.write(f"   Lot {lot_id}: {modifiees} ligne(s) reindexée(s), "
+                                  f"{sous_totaux} sous-total(aux) recalculé(s)")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {total} ligne(s) reindexée(s), {total_sous_totaux} sous-total(aux) recalculé(s)"
+        ))
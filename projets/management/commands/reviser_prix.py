@@ -0,0 +1,40 @@
+# projets/management/commands/reviser_prix.py
+from django.core.management.base import BaseCommand
+
+from projets.services.revision_service import MoteurRevision, reporter_revisions_manuelles
+
+
+class Command(BaseCommand):
+    """Recalcule la révision des prix des décomptes des projets configurés"""
+
+    help = 'Recalcule en bloc la révision des prix (montant_revision_prix) des décomptes des projets configurés'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projet',
+            type=int,
+            action='append',
+            help='Identifiant du projet à réviser (répétable, tous les projets configurés par défaut)'
+        )
+        parser.add_argument(
+            '--simulation',
+            action='store_true',
+            help="Affiche la révision de chaque décompte sans l'enregistrer"
+        )
+
+    def handle(self, *args, **options):
+        moteur = MoteurRevision(options['projet'])
+        if options['simulation']:
+            for resultat in moteur.resultats():
+                decompte = resultat['decompte']
+                self.stdout.write(f"   Projet {decompte.attachement.projet_id} {decompte.numero}: "
+                                  f"variation {resultat['variation']:+.4%}, période {resultat['revision_periode']}, "
+                                  f"cumul {resultat['montant_revision_prix']} (actuel {decompte.montant_revision_prix})")
+            return
+
+        reprises = reporter_revisions_manuelles(options['projet'])
+        if reprises:
+            self.stdout.write(f"   {reprises} révision(s) saisie(s) à la main reportée(s) sur la période")
+        self.stdout.write("🔍 Révision des prix des décomptes")
+        modifies = moteur.enregistrer()
+        self.stdout.write(self.style.SUCCESS(f"✅ {len(modifies)} décompte(s) révisé(s)"))
@@ -1,7 +1,8 @@
 # managers.py
 # Class Line, LineManager - version python
 
-from projets.models import LigneBordereau
+from projets.arbre import Arbre, Noeud
+from projets.models import LigneAttachement, LigneBordereau
 
 
 def float_or_zero(value):
@@ -13,25 +14,55 @@ def float_or_zero(value):
 def convert_lot_to_table(lot):
     """Convertit un les donnees d'un model django en données tabulaires"""
     
-    lignes = lot.lignes.all()
+    lignes = lot.lignes.values('id', 'parent_id', 'numero', 'designation', 'unite', 'quantite', 'prix_unitaire')
     table = []
     for ligne in lignes:
         table.append({
-            'id': ligne.id,
-            'parent_id': ligne.parent.id if ligne.parent else None,
-            'numero': ligne.numero,
-            'designation': ligne.designation,
-            'unite': ligne.unite,
-            'quantite': float_or_zero(ligne.quantite),
-            'prix_unitaire': float_or_zero(ligne.prix_unitaire),
+            'id': ligne['id'],
+            'parent_id': ligne['parent_id'],
+            'numero': ligne['numero'],
+            'designation': ligne['designation'],
+            'unite': ligne['unite'],
+            'quantite': float_or_zero(ligne['quantite']),
+            'prix_unitaire': float_or_zero(ligne['prix_unitaire']),
         })
     return table
+
+class LineAttachement:
+    """Valeurs d'une ligne d'attachement utiles à l'arbre, sans instancier de modèle Django"""
+    __slots__ = ('id', 'attachement_id', 'ligne_lot_id', 'quantite_realisee', 'quantite_cumulee', 'prix_unitaire')
+    
+    def __init__(self, id, attachement_id, ligne_lot_id, quantite_realisee, quantite_cumulee, prix_unitaire):
+        self.id = id
+        self.attachement_id = attachement_id
+        self.ligne_lot_id = ligne_lot_id
+        self.quantite_realisee = quantite_realisee
+        self.quantite_cumulee = quantite_cumulee
+        self.prix_unitaire = prix_unitaire
+    
+    @property
+    def montant_ligne_realise(self):
+        return self.quantite_realisee * self.prix_unitaire
+
+def charger_lot(lot):
+    """
+    Charge les lignes d'un lot et toutes leurs lignes d'attachement en deux requêtes.
+    Retourne (table, index) avec index = {(ligne_id, attachement_id): LineAttachement}
+    """
+    table = convert_lot_to_table(lot)
+    lignes_attachement = LigneAttachement.objects.filter(ligne_lot__lot=lot).values_list(
+        'id', 'attachement_id', 'ligne_lot_id', 'quantite_realisee', 'quantite_cumulee', 'prix_unitaire'
+    )
+    index = {}
+    for valeurs in lignes_attachement.iterator(chunk_size=5000):
+        index[(valeurs[2], valeurs[1])] = LineAttachement(*valeurs)
+    return table, index
+    
+class Line(Noeud):
+    __slots__ = ('numero', 'designation', 'unite', 'quantite', 'prix_unitaire', '_expanded', 'lines_attachement')
     
-class Line:
     def __init__(self, id = None, numero = "N°", designation = "Désignation", unite = "U", quantite = 1, pu = 0, parent = None, _expanded = False):
-            self.id = id
-            self.parent = parent
-            self.children = []
+            super().__init__(id=id, parent=parent)
             self.numero = numero
             self.designation = designation
             self.unite = unite
@@ -49,23 +80,25 @@ class Line:
    
     def set_line_attachement(self, line_attachement):
         if line_attachement:
-            self.lignes_attachement[line_attachement.id] = line_attachement
+            self.lines_attachement[line_attachement.attachement_id] = line_attachement
             return True
         return False
     
     def amount_attachement(self, attachement):
-        line_attachement = self.lines_attachement.get(attachement.id)
-        if line_attachement:
-            if not self.hasChildren():
-                return line_attachement.quantite_realisee * self.prix_unitaire
-            amount = 0.0
-            for child in self.children:
-                amount += child.amount_attachement(attachement)
-            return amount
-        return 0.0
+        """Montant réalisé du sous-arbre (un titre sans ligne d'attachement vaut zéro)"""
+        montants = {}
+        for line in reversed(list(self.parcourir())):
+            line_attachement = line.lines_attachement.get(attachement.id)
+            if not line_attachement:
+                montants[line] = 0.0
+            elif line.children:
+                montants[line] = sum(montants[child] for child in line.children)
+            else:
+                montants[line] = float(line_attachement.quantite_realisee) * line.prix_unitaire
+        return montants[self]
     
     def get_line_attachement(self, attachement_id):
-        return self.lignes_attachement.get(attachement_id)
+        return self.lines_attachement.get(attachement_id)
     
     def __str__(self):
         level = self.level()
@@ -73,16 +106,11 @@ class Line:
         return '|' + esp + f"{self.numero} | {self.designation} | {self. unite} | {self.quantite} | {self.prix_unitaire} | {self.amount()}"
     
     def level(self):
-            level = 0
-            currentNode = self
-            while (currentNode.parent):
-                level += 1
-                currentNode = currentNode.parent
-            
-            return level
+            return self.profondeur
     
     def forEachChild(self, callback):
-            self.children.forEach(callback)
+            for child in self.children:
+                callback(child)
         
     def getChildIndex(self, child):
         try:
@@ -104,7 +132,7 @@ class Line:
 
     def getNextSibling(self, child):
         index = self.getChildIndex(child)
-        return self.children[index + 1]  if index < len(self.children) else None
+        return self.children[index + 1] if 0 <= index < len(self.children) - 1 else None
     
     def getChildren(self):
             return self.children
@@ -123,26 +151,23 @@ class Line:
 
     def addChild(self, child):
         if not child or child is self or child in self.children: return
-        child.parent = self
-        self.children.append(child)
+        self.ajouter_enfant(child)
 
     def insertChildAt(self, child, index):
         if not child or child is self or child in self.children: return
         if 0 <= index <= len(self.children):
-            child.parent = self
-            self.children.insert(index, child)
+            self.ajouter_enfant(child, index)
 
     def removeChild(self, child):
         """Supprime un enfant par référence"""
-        if child in self.children:
-            self.children.remove(child)
-            child.parent = None
-            return True
-        return False
+        return self.retirer_enfant(child)
 
     def isExpanded(self):
         return self._expanded
 
+    def setExpanded(self, expanded):
+        self._expanded = expanded
+
     def toggleExpanded(self):
         self._expanded = not self._expanded
         
@@ -154,7 +179,6 @@ class Line:
         if currentIndex == 0: return False
         
         previousSibling:Line = parent.children[currentIndex - 1]
-        parent.removeChild(self)
         previousSibling.addChild(self)
         
         return True
@@ -163,37 +187,37 @@ class Line:
         parent:Line = self.parent
         if not parent: return False
         # si cette ligne n'est pas le dernier enfant de son parent, il ne peut pas se déindenter
-        if parent.getLastChild() != self: return False
+        if parent.getLastChild() is not self: return False
         grandParent:Line = parent.parent
         if not grandParent: return False
         
         parentIndex = grandParent.getChildIndex(parent)
-        parent.removeChild(self)
         grandParent.insertChildAt(self, parentIndex + 1)
         
         return True
+    
+    def montant_feuille(self):
+        return self.quantite * self.prix_unitaire
         
     def amount(self):
         if self.hasChildren():
-            return sum(child.amount() for child in self.children)
-        return self.quantite * self.prix_unitaire
+            return self.totaux(Line.montant_feuille)[self]
+        return self.montant_feuille()
  
 class LineManager:
     def __init__(self, lot_nom="Bordereau des prix unitaires", data=None):
-        self.line_map = {}
         self.root_line = Line(None, "Root", lot_nom)
-        self.index_map = {}  # Cache des index
-        self.cached_flat_list = None  # Cache flatList
-        self.cache_valid = False  # Flag de validité
+        self.arbre = Arbre(self.root_line)  # index par id et liste à plat incrémentale
+        self.line_map = self.arbre.noeuds
         self.data = data or []
+        self.attachements_index = {}  # (ligne_id, attachement_id) -> LigneAttachement
         self.data_table = self.get_table_data() if data else []
     def set_model_data(self, lot):
         """Initialise les données à partir d'un modèle Django"""
         self.lot = lot
-        self.data = convert_lot_to_table(lot)
+        self.data, self.attachements_index = charger_lot(lot)
         self.build_tree()
         self.build_index_map()
-        self.invalidate_cache()
     def get_attachements_from_model(self):
         """Récupère les attachements associés au lot"""
         if not hasattr(self, 'lot'): return []
@@ -202,10 +226,7 @@ class LineManager:
         attachements = lot.projet.attachements.all()
         return attachements
     def insert_child_at(self, line, index):
-        """Insertion d'un enfant à une position index"""
-        # Trouver le parent qui se trouve à la position index dans la liste flat_list
-        # vérifier l'index est valide
-        
+        """Insertion d'une ligne à la position index de la liste à plat, avant la ligne qui l'occupe"""
         flat_list = self.get_cached_flat_list()
         
         if index < 0 or index >= len(flat_list):
@@ -217,34 +238,31 @@ class LineManager:
             if not parent_line:
                 return
 
-            position = index - self.get_index_by_id(parent_line.id) - 1
-            parent_line.insertChildAt(line, position)
-            self.invalidate_cache()
+            self.arbre.inserer(line, parent_line, child_line.position())
         except Exception as error:
             print(f"Erreur: {error}")
             return
     
     def remove_child(self, line):
         """Suppression d'un enfant"""
-        parent:Line = line.parent
-        if not parent:
+        if not line.parent:
             return
-        parent.removeChild(line)
-        self.invalidate_cache()
+        self.arbre.retirer(line)
     
     def index_of(self, line):
         """Retourne l'index de la ligne"""
-        flat_list = self.get_cached_flat_list()
-        return flat_list.index(line) if line in flat_list else -1
+        return self.arbre.index(line)
     
     def build_tree(self):
         """Construit l'arbre à partir des données"""
-        self.cache_valid = False
+        self.root_line.children = []
+        self.arbre = Arbre(self.root_line)
+        self.line_map = self.arbre.noeuds
         if not self.data: return
-        attachements = self.get_attachements_from_model()
         
-        self.line_map = {}
         # Créer tous les nodes
+        lines = []
+        parents = {}
         for row in self.data:
             if not row or row.get('id') is None:
                 continue
@@ -259,59 +277,46 @@ class LineManager:
                 None,
                 True  # _expanded par défaut pour voir les données
             )
-            line_bordereau = line.get_ligne_bordereau()
-            if line_bordereau:
-                for attachement in attachements:
-                    try:
-                        line_attachement = line_bordereau.lignes_attachement.get(attachement=attachement)
-                        line.set_line_attachement(line_attachement)
-                    except Exception:
-                        continue
-            self.line_map[row['id']] = line
+            lines.append(line)
+            parents[row['id']] = row.get('parent_id')
         
         # Construire la hiérarchie
-        for row in self.data:
-            if not row or not self.line_map.get(row['id']):
-                continue
-            
-            line:Line = self.line_map[row['id']]
-            
-            if row.get('parent_id') and self.line_map.get(row['parent_id']):
-                parent_line:Line = self.line_map[row['parent_id']]
-                parent_line.addChild(line)
-            else:
-                self.root_line.addChild(line)
+        self.arbre = Arbre.construire(self.root_line, lines, lambda line: parents[line.id])
+        self.line_map = self.arbre.noeuds
+        
+        # Rattacher les lignes d'attachement préchargées
+        for (ligne_id, _), line_attachement in self.attachements_index.items():
+            line = self.line_map.get(ligne_id)
+            if line:
+                line.set_line_attachement(line_attachement)
     
     def get_updated_flat_list(self):
         """Retourne la liste plate mise à jour"""
         flat_list = self.get_cached_flat_list()
+        montants = self.root_line.totaux(Line.montant_feuille)
         
         return [{
             'id': line.id,
             'parent_id': line.parent.id if line.parent else None,
             'numero': line.numero,
             'niveau': line.level(),
-            'est_titre': line.has_children(),
+            'est_titre': line.hasChildren(),
             'designation': line.designation,
             'unite': line.unite,
             'quantite': line.quantite,
             'prix_unitaire': line.prix_unitaire,
-            'montant': line.amount(),
+            'montant': montants[line],
         } for line in flat_list]
     
     def build_index_map(self):
         """Construit la map d'index"""
-        self.index_map = {}
-        flat_list = self.get_cached_flat_list()
-        
-        for index, line in enumerate(flat_list):
-            if line and line.id:
-                self.index_map[line.id] = index
+        self.arbre.index(self.root_line)
     
     def get_table_data(self):
         """Convertit les données en format tableau"""
         self.build_tree()
         flat_list = self.get_cached_flat_list()
+        montants = self.root_line.totaux(Line.montant_feuille)
 
         return [{
             '_expanded': line.isExpanded(),
@@ -324,59 +329,43 @@ class LineManager:
             'unite': line.unite,
             'quantite': line.quantite,
             'prix_unitaire': line.prix_unitaire,
-            'montant': line.amount(),
+            'montant': montants[line],
         } for line in flat_list]
     
     def get_index_by_id(self, id):
         """GETTER optimisé"""
-        try:
-            return self.index_map.get(id, -1)
-        except Exception:
-            return -1
+        line = self.line_map.get(id)
+        return self.arbre.index(line) if line else -1
     
     def get_line_by_id(self, id):
         """Retourne une ligne par son ID"""
         return self.line_map.get(id)
     
+    def get_line_attachement(self, ligne_id, attachement_id):
+        """Retourne la ligne d'attachement préchargée d'une ligne pour un attachement"""
+        return self.attachements_index.get((ligne_id, attachement_id))
+    
     def montant_total(self):
         """Retourne le montant total"""
         return self.root_line.amount()
     
     def get_flat_list(self):
         """Retourne la liste plate de toutes les lignes"""
-        result = []
-        
-        def traverse(line):
-            result.append(line)
-            if line.children:
-                for child in line.children:
-                    traverse(child)
-        
-        for child in self.root_line.children:
-            traverse(child)
-        
-        return result
+        return list(self.root_line.descendants())
     
     def get_cached_flat_list(self):
-        """Retourne la liste plate avec cache"""
-        if not self.cache_valid or not self.cached_flat_list:
-            self.cached_flat_list = self.get_flat_list()
-            self.cache_valid = True
-        return self.cached_flat_list
+        """Retourne la liste plate avec cache (maintenue lors des insertions/suppressions)"""
+        return self.arbre.liste_plate()
     
     def invalidate_cache(self):
         """Invalide le cache"""
-        self.cache_valid = False
-        self.cached_flat_list = None
+        self.arbre.invalider()
     
     def remove_line_by_index(self, row_index):
         """Supprime une ligne par son index"""
-        flat_list = self.get_cached_flat_list()
-        if 0 <= row_index < len(flat_list):
-            line = flat_list[row_index]
-            if line and line.parent:
-                line.parent.remove_child(line)
-                self.invalidate_cache()
+        line = self.get_line_by_index(row_index)
+        if line and line.parent:
+            self.arbre.retirer(line)
     
     def get_line_by_index(self, row_index):
         """Retourne une ligne par son index"""
@@ -386,43 +375,39 @@ class LineManager:
         return None
     
     def indent_line_by_index(self, row_index):
-        """Indente une ligne par son index"""
-        flat_list = self.get_cached_flat_list()
-        if 0 <= row_index < len(flat_list):
-            line = flat_list[row_index]
-            if line:
-                line.indent()
-                self.invalidate_cache()
-                return True
+        """Indente une ligne par son index (elle devient le dernier enfant de son frère précédent)"""
+        line = self.get_line_by_index(row_index)
+        if line:
+            index = line.position()
+            if index > 0:
+                self.arbre.deplacer(line, line.parent.children[index - 1])
+            return True
         return False
     
     def desindent_line_by_index(self, row_index):
-        """Désindente une ligne par son index"""
-        flat_list = self.get_cached_flat_list()
-        if 0 <= row_index < len(flat_list):
-            line = flat_list[row_index]
-            if line:
-                line.desindent()
-                self.invalidate_cache()
-                return True
+        """Désindente une ligne par son index (dernier enfant uniquement, placée après son parent)"""
+        line = self.get_line_by_index(row_index)
+        if line:
+            parent = line.parent
+            if parent and parent.parent and parent.getLastChild() is line:
+                self.arbre.deplacer(line, parent.parent, parent.position() + 1)
+            return True
         return False  
     
     def expand_line_by_index(self, row_index):
         """Expand une ligne par son index"""
-        flat_list = self.get_cached_flat_list()
-        if 0 <= row_index < len(flat_list):
-            line = flat_list[row_index]
-            if line:
-                line.setExpanded(True)
-                self.invalidate_cache()
-                return True
+        line = self.get_line_by_index(row_index)
+        if line:
+            line.setExpanded(True)
+            return True
         return False
 
-class LigneHierarchique:
+class LigneHierarchique(Noeud):
     """
     Classe générique pour créer des structures hiérarchiques
     Fonctionne avec des dicts ET des instances Django
     """
+    __slots__ = ('parent_id', 'numero', 'designation', 'unite', 'quantite', 'prix_unitaire', 'montant', 'collapsed')
     
     def __init__(self, data):
         """
@@ -431,9 +416,8 @@ class LigneHierarchique:
         - Un objet Django: instance avec .id, .parent_id, etc.
         - Un objet avec attributs: data.id, data.parent_id, etc.
         """
+        super().__init__()
         self._extract_data(data)
-        self.children = []
-        self.parent = None
         self.collapsed = True
     
     def _extract_data(self, data):
@@ -524,69 +508,41 @@ class LigneHierarchique:
                 print(f"Erreur avec {data}: {e}")
                 continue
         
-        # 2. Construire la hiérarchie
-        for line in lines.values():
-            if line.parent_id:
-                parent_line = lines.get(line.parent_id)
-                if parent_line: 
-                    parent_line.ajouter_enfant(line)
-                else:
-                    # Parent non trouvé → ajouter à la racine
-                    parent.ajouter_enfant(line)
-            else:
-                parent.ajouter_enfant(line)
+        # 2. Construire la hiérarchie (parent non trouvé → racine)
+        Arbre.construire(parent, list(lines.values()), lambda line: line.parent_id)
 
         return lines, parent
     
-    def ajouter_enfant(self, enfant):
-        """Ajoute un enfant et met à jour son parent"""
-        enfant.parent = self
-        self.children.append(enfant)
-        return enfant
     def collapse(self, all=True):
-        if self.parent: 
-            self.collapsed = True
-        else:
-            self.collapsed = False
-        
-        if all:    
-            for enfant in self.children:
-                enfant.collapse(all)
+        for ligne in (self.parcourir() if all else [self]):
+            ligne.collapsed = ligne.parent is not None
     @property
     def has_children(self):
         return len(self.children) > 0
     
     @property
     def level(self):
-        level = 0
-        currentNode = self
-        while (currentNode.parent):
-            level += 1
-            currentNode = currentNode.parent
-        
-        return level
+        return self.profondeur
     
     def collecter_tous_enfants(self):
-        """Collecte tous les enfants et petits-enfants de manière récursive"""
-        result = [self]
-        for enfant in self.children:
-            result.extend(enfant.collecter_tous_enfants())
-        return result
+        """Collecte tous les enfants et petits-enfants (parcours itératif)"""
+        return list(self.parcourir())
     
     def collecter_ids_enfants(self):
         """Collecte tous les IDs des enfants (utile pour suppression)"""
-        ids = [self.id]
-        for enfant in self.children:
-            ids.extend(enfant.collecter_ids_enfants())
-        return ids
+        return [ligne.id for ligne in self.parcourir()]
     
     def est_parent(self):
         """Vérifie si la ligne a des enfants"""
         return self.has_children
     
+    def montants(self):
+        """Montants cumulés de tout le sous-arbre en un seul parcours: {ligne: montant}"""
+        return self.totaux(lambda ligne: ligne.montant)
+    
     def amount(self):
         if self.has_children:
-            return sum(child.amount() for child in self.children)
+            return self.montants()[self]
         return self.montant
     
     def export_to_table(self):
@@ -594,59 +550,49 @@ class LigneHierarchique:
         Exporte la ligne et ses enfants sous forme de tableau plat
         avec les niveaux hiérarchiques préservés
         """
-        result = []
-        
-        # Ajouter la ligne actuelle
-        result.append({
-            'id': self.id,
-            'parent_id': self.parent_id,
-            'numero': self.numero,
-            'designation': self.designation,
-            'unite': self.unite,
-            'quantite': self.quantite,
-            'prix_unitaire': self.prix_unitaire,
-            'montant': self.amount(),
-            'level': self.level,
-            'has_children': self.has_children,
-            'is_parent': self.est_parent(),
-            'children_count': len(self.children),
-            'children_ids': [child.id for child in self.children]
-        })
-        
-        # Ajouter récursivement les enfants
-        for enfant in self.children:
-            result.extend(enfant.export_to_table())
-        
-        return result
+        montants = self.montants()
+        return [{
+            'id': ligne.id,
+            'parent_id': ligne.parent_id,
+            'numero': ligne.numero,
+            'designation': ligne.designation,
+            'unite': ligne.unite,
+            'quantite': ligne.quantite,
+            'prix_unitaire': ligne.prix_unitaire,
+            'montant': montants[ligne],
+            'level': ligne.level,
+            'has_children': ligne.has_children,
+            'is_parent': ligne.est_parent(),
+            'children_count': len(ligne.children),
+            'children_ids': [child.id for child in ligne.children]
+        } for ligne in self.parcourir()]
     
     def export_to_json(self):
         """Exporte en format JSON pour le template"""
-        return {
-            'id': self.id,
-            'parent_id': self.parent_id,
-            'numero': self.numero,
-            'designation': self.designation,
-            'unite': self.unite,
-            'quantite': self.quantite,
-            'prix_unitaire': self.prix_unitaire,
-            'montant': self.amount(),
-            'level': self.level,
-            'has_children': self.has_children,
-            'is_parent': self.est_parent(),
-            'children': [child.export_to_json() for child in self.children]
-        }
+        montants = self.montants()
+        exports = {}
+        for ligne in self.parcourir():
+            exports[ligne] = {
+                'id': ligne.id,
+                'parent_id': ligne.parent_id,
+                'numero': ligne.numero,
+                'designation': ligne.designation,
+                'unite': ligne.unite,
+                'quantite': ligne.quantite,
+                'prix_unitaire': ligne.prix_unitaire,
+                'montant': montants[ligne],
+                'level': ligne.level,
+                'has_children': ligne.has_children,
+                'is_parent': ligne.est_parent(),
+                'children': []
+            }
+            if ligne is not self:
+                exports[ligne.parent]['children'].append(exports[ligne])
+        return exports[self]
     
     def trouver_par_id(self, ligne_id):
         """Trouve une ligne par son ID dans l'arbre"""
-        if self.id == ligne_id:
-            return self
-        
-        for enfant in self.children:
-            result = enfant.trouver_par_id(ligne_id)
-            if result:
-                return result
-        
-        return None
+        return self.trouver(ligne_id)
     
 #     # Fonction utilitaire pour construire la hiérarchie
 # def construire_hierarchie(lignes_data):
@@ -1,3 +1,4 @@
 from .profile import *
 from .projet import *
 from .decomptes import *
+from .revision import *
@@ -1,7 +1,7 @@
 from decimal import Decimal
 import os
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Q, Sum
 from django.utils.translation import gettext_lazy as _
 from datetime import date
 from django.contrib.auth.models import User
@@ -36,6 +36,13 @@ class Attachement(models.Model):
     original_filename = models.CharField(max_length=255, blank=True, verbose_name="Nom de fichier original")
     
     date_creation = models.DateTimeField(auto_now_add=True)
+    # Mis à jour à chaque enregistrement et à chaque réécriture de ses entrées du registre des cumuls
+    date_modification = models.DateTimeField(auto_now=True)
+    
+    # Montants HT S, S-1 et de la situation, recalculés avec le registre des cumuls quand les lignes changent
+    montant_ht_cumule = models.DecimalField(_("Montant HT cumulé (S)"), max_digits=20, decimal_places=2, default=0)
+    montant_ht_precedent = models.DecimalField(_("Montant HT précédent (S-1)"), max_digits=20, decimal_places=2, default=0)
+    montant_ht_situation = models.DecimalField(_("Montant HT de la situation"), max_digits=20, decimal_places=2, default=0)
 
     class Meta: 
         verbose_name = "Attachement"
@@ -103,24 +110,52 @@ class Attachement(models.Model):
         self.initialiser_processus_validation(demandeur=user)
     @property
     def total_montant_ht(self):
-        return sum(ligne.montant_ligne_realise for ligne in self.lignes_attachement.all())
+        return self.montant_ht_cumule
 
     def get_previous_attachement(self):
-        return Attachement.objects.filter(projet=self.projet, id__lt=self.id).order_by('-id').first()
+        """Attachement précédent dans l'ordre du registre des cumuls (date d'établissement, puis id)"""
+        return Attachement.objects.filter(projet=self.projet).filter(
+            Q(date_etablissement__lt=self.date_etablissement) | Q(date_etablissement=self.date_etablissement, id__lt=self.id)
+        ).order_by('-date_etablissement', '-id').first()
     
     @property
     def montant_ht_attachement_precedent(self):
-        try:
-            precedent = self.get_previous_attachement()
-            if precedent:
-                return precedent.total_montant_ht
-            return 0
-        except Exception:
-            return 0
+        return self.montant_ht_precedent
     
     @property
     def montant_situation(self):
-        return self.total_montant_ht - self.montant_ht_attachement_precedent
+        return self.montant_ht_situation
+        
+    # Écrits uniquement par le registre des cumuls (bulk_update, sans passer par save)
+    CHAMPS_REGISTRE = ('montant_ht_cumule', 'montant_ht_precedent', 'montant_ht_situation')
+
+    def save(self, *args, **kwargs):
+        """
+        Une instance chargée avant la dernière réécriture du registre ne doit pas remettre ses montants HT périmés:
+        hors création, les colonnes du registre sont retirées des champs enregistrés puis relues
+        """
+        if self._state.adding or kwargs.get('force_insert'):
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [champ.name for champ in self._meta.concrete_fields if not champ.primary_key]
+        kwargs['update_fields'] = [champ for champ in update_fields if champ not in self.CHAMPS_REGISTRE]
+        if not kwargs['update_fields']:
+            return None
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=self.CHAMPS_REGISTRE)
+
+    def delete(self, *args, **kwargs):
+        from .projet import LigneBordereau
+        from projets.services.cumuls_service import RegistreCumuls
+        lots_ids = set(self.lignes_attachement.values_list('ligne_lot__lot_id', flat=True))
+        projet_id = self.projet_id
+        resultat = super().delete(*args, **kwargs)
+        # Les rangs des attachements suivants et leur S-1 changent
+        RegistreCumuls(projet_id).reconstruire()
+        for lot_id in lots_ids:
+            LigneBordereau.recalculer_sous_totaux(lot_id)
+        return resultat
         
     def __str__(self):
         return f"Attachement {self.numero} - {self.projet.nom}"
@@ -162,6 +197,49 @@ class LigneAttachement(models.Model):
             ).aggregate(total=Sum('quantite_realisee'))['total'] or 0
             self.quantite_cumulee = cumul_precedent + self.quantite_realisee
         super().save(*args, **kwargs)
+        self.actualiser_registre(self.ligne_lot)
+    
+    def delete(self, *args, **kwargs):
+        ligne_lot = self.ligne_lot
+        resultat = super().delete(*args, **kwargs)
+        self.actualiser_registre(ligne_lot)
+        return resultat
+    
+    def actualiser_registre(self, ligne_lot):
+        """Entrées du registre de cette seule ligne et réalisé de ses ancêtres"""
+        from projets.services.cumuls_service import RegistreCumuls
+        RegistreCumuls(self.attachement.projet_id).actualiser_ligne(self.attachement_id, ligne_lot.id)
+        ligne_lot.actualiser_realise()
+
+class CumulLigneAttachement(models.Model):
+    """
+    Registre des cumuls: pour chaque attachement (dans l'ordre de sa séquence au sein du projet) et chaque ligne
+    de bordereau saisie dans cet attachement ou dans le précédent, quantités et montants S-1, partiel et S.
+    Maintenu par projets.services.cumuls_service.RegistreCumuls, reconstruit par la commande reconstruire_cumuls.
+    """
+    ligne_lot = models.ForeignKey('LigneBordereau', on_delete=models.CASCADE, related_name='cumuls')
+    attachement = models.ForeignKey('Attachement', on_delete=models.CASCADE, related_name='cumuls')
+    sequence = models.PositiveIntegerField(_("Rang de l'attachement"))
+    saisie = models.BooleanField(_("Saisie dans l'attachement"), default=True)
+    
+    quantite_precedente = models.DecimalField(_("Quantité S-1"), max_digits=15, decimal_places=3, default=0)
+    quantite_partielle = models.DecimalField(_("Quantité partielle"), max_digits=15, decimal_places=3, default=0)
+    quantite_cumulee = models.DecimalField(_("Quantité S"), max_digits=15, decimal_places=3, default=0)
+    montant_precedent = models.DecimalField(_("Montant S-1"), max_digits=20, decimal_places=2, default=0)
+    montant_partiel = models.DecimalField(_("Montant partiel"), max_digits=20, decimal_places=2, default=0)
+    montant_cumule = models.DecimalField(_("Montant S"), max_digits=20, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name = _("Cumul de ligne d'attachement")
+        verbose_name_plural = _("Cumuls des lignes d'attachement")
+        unique_together = ['ligne_lot', 'sequence']
+        indexes = [
+            models.Index(fields=['attachement', 'ligne_lot']),
+            models.Index(fields=['ligne_lot', 'saisie', 'sequence']),
+        ]
+
+    def __str__(self):
+        return f"{self.ligne_lot_id} @ {self.sequence}: {self.quantite_cumulee}"
 
 # ------------------------ Processus de validation ------------------------
 class ProcessValidation(models.Model):
@@ -448,56 +526,65 @@ class Decompte(models.Model):
     observations = models.TextField(blank=True, verbose_name="Observations")
     
     montant_revision_prix = models.DecimalField(max_digits=15, decimal_places=2, default=0, null=True, blank=True, verbose_name="Révision des prix")
+    # Part de montant_revision_prix (cumulée) propre à la période, écrite par MoteurRevision; pour un projet
+    # sans formule de révision, la révision saisie à la main (reportée par Decompte.save)
+    montant_revision_periode = models.DecimalField(max_digits=15, decimal_places=2, default=0, verbose_name="Révision des prix de la période")
     
     @property
     def montant_total_avec_revision(self):
-        """Calcule le montant total avec révision"""
-        total = self.montant_situation_ht or Decimal('0')
-        return total + (self.montant_revision_prix or Decimal('0'))
+        """Montant HT de la situation, révision de la période comprise"""
+        return self.montant_situation_ht or Decimal('0')
     
     @property
     def montant_TTC_avec_revision(self):
         """Calcule le TTC avec révision"""
         return self.montant_total_avec_revision * (1 + Decimal('0.20'))  # TVA 20%
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.m_ht_situation = 0.0
-        
+    _situation = None
+
+    @property
+    def situation(self):
+        """Montants de situation en Decimal; posés par DecompteCalculator dans les listes, sinon calculés ici"""
+        if self._situation is None:
+            from projets.services.decompte_service import DecompteCalculator
+            self._situation = DecompteCalculator.montants(self, self.attachement.montant_situation)
+        return self._situation
+
+    @situation.setter
+    def situation(self, montants):
+        self._situation = montants
+
     @property
     def montant_situation_ht(self):
-        self.m_ht_situation = self.attachement.montant_situation
-        return float(self.m_ht_situation)
+        return self.situation['ht']
     
     @property
     def montant_situation_retenue_garantie(self):
-        taux = float(self.taux_retenue_garantie) if self.taux_retenue_garantie else 0.0
-        return float(self.m_ht_situation)*taux/100
+        return self.situation['retenue_garantie']
     
     @property
     def reste_a_payer_ht(self):
-        return float(self.m_ht_situation) - float(self.montant_situation_retenue_garantie)
+        return self.situation['reste_a_payer_ht']
     
     @property
     def montant_situation_ttc(self):
-        return self.reste_a_payer_ht*(1+(float(self.taux_tva)/100))
+        return self.situation['ttc']
     
     @property
     def montant_situation_tva(self):
-        return self.montant_situation_ttc - self.reste_a_payer_ht
+        return self.situation['tva']
     
     @property
     def montant_situation_ras(self):
-        taux = float(self.taux_ras) if self.taux_ras else 0.0
-        return float(self.m_ht_situation)*(taux/100)
+        return self.situation['ras']
     
     @property
     def montant_situation_autres_retenues(self):
-        return float(self.autres_retenues) if self.autres_retenues else 0.0
+        return self.situation['autres_retenues']
     
     @property
     def montant_situation_net_a_payer(self):
-        return self.montant_situation_ttc - self.montant_situation_ras - self.montant_situation_autres_retenues
+        return self.situation['net_a_payer']
     
     class Meta:
         verbose_name = "Décompte"
@@ -505,14 +592,32 @@ class Decompte(models.Model):
         ordering = ['-date_emission', '-numero']
 
     def save(self, *args, **kwargs):
-        self.montant_ht = self.attachement.total_montant_ht + self.montant_revision_prix
-        self.montant_tva = (self.montant_ht * self.taux_tva) / 100
-        self.montant_ttc = self.montant_ht + self.montant_tva
-        self.montant_retenue_garantie = (self.montant_ht * self.taux_retenue_garantie) / 100
-        self.montant_ras = (self.montant_ht * self.taux_ras) / 100
-        total_retenues = self.montant_retenue_garantie + self.montant_ras + self.autres_retenues
-        self.montant_net_a_payer = max(0, self.montant_ttc - total_retenues)
-        super().save(*args, **kwargs)
+        from projets.services.decompte_service import DecompteCalculator
+        from .revision import ConfigRevisionProjet
+        if not ConfigRevisionProjet.objects.filter(projet_id=self.attachement.projet_id).exists():
+            # Projet sans formule de révision: la révision saisie est celle de la période
+            self.montant_revision_periode = self.montant_revision_prix or Decimal('0')
+        # Montant HT cumulé relu en base: l'attachement en mémoire peut précéder la dernière écriture du registre
+        montant_ht_cumule = Attachement.objects.filter(pk=self.attachement_id).values_list(
+            'montant_ht_cumule', flat=True).first()
+        DecompteCalculator.montants_decompte(self, montant_ht_cumule)
+        with self.suivre_situation_financiere():
+            super().save(*args, **kwargs)
+        self.actualiser_resume()
+
+    def delete(self, *args, **kwargs):
+        with self.suivre_situation_financiere():
+            return super().delete(*args, **kwargs)
+
+    def suivre_situation_financiere(self):
+        """Bloc transactionnel reportant sur le grand livre du projet l'écart de ce décompte avant/après écriture"""
+        from projets.services.situation_service import GrandLivreProjet
+        return GrandLivreProjet(self.attachement.projet_id).suivre({'attachement_id': self.attachement_id})
+
+    def actualiser_resume(self):
+        """Résumé HT/TVA/TTC/acompte recalculé des lignes du décompte (le taux de TVA a pu changer)"""
+        from projets.services.recapitulatif_service import RecapitulatifDecomptes
+        RecapitulatifDecomptes(Decompte.objects.filter(pk=self.pk)).enregistrer()
 
     @property
     def est_en_retard(self):
@@ -523,6 +628,34 @@ class Decompte(models.Model):
     def __str__(self):
         return f"Décompte {self.numero} - {self.attachement.projet.nom}"
 
+class SituationFinanciereProjet(models.Model):
+    """
+    Grand livre financier d'un projet: cumuls facturés et retenus, payé et reste à payer sur ses décomptes.
+    Maintenu par projets.services.situation_service.GrandLivreProjet dans la transaction de chaque écriture
+    d'un décompte ou des montants d'un attachement, reconstruit par la commande reconstruire_situations.
+    """
+    projet = models.OneToOneField('Projet', on_delete=models.CASCADE, related_name='situation_financiere')
+    nb_decomptes = models.PositiveIntegerField(_("Nombre de décomptes"), default=0)
+    nb_decomptes_payes = models.PositiveIntegerField(_("Nombre de décomptes payés"), default=0)
+
+    montant_ht_cumule = models.DecimalField(_("Montant HT cumulé facturé"), max_digits=20, decimal_places=2, default=0)
+    montant_ttc_cumule = models.DecimalField(_("Montant TTC cumulé facturé"), max_digits=20, decimal_places=2, default=0)
+    retenue_garantie_cumulee = models.DecimalField(_("Retenue de garantie cumulée"), max_digits=20, decimal_places=2, default=0)
+    ras_cumulee = models.DecimalField(_("RAS cumulée"), max_digits=20, decimal_places=2, default=0)
+    autres_retenues_cumulees = models.DecimalField(_("Autres retenues cumulées"), max_digits=20, decimal_places=2, default=0)
+    net_a_payer_cumule = models.DecimalField(_("Net à payer cumulé"), max_digits=20, decimal_places=2, default=0)
+    montant_paye = models.DecimalField(_("Montant payé"), max_digits=20, decimal_places=2, default=0)
+    montant_restant = models.DecimalField(_("Reste à payer"), max_digits=20, decimal_places=2, default=0)
+
+    date_modification = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Situation financière du projet")
+        verbose_name_plural = _("Situations financières des projets")
+
+    def __str__(self):
+        return f"Situation financière {self.projet_id}: {self.net_a_payer_cumule}"
+
 # ------------------------
 class LigneDecompte(models.Model):
     NATURE_DEPENSES_CHOICES = [
@@ -544,6 +677,8 @@ class LigneDecompte(models.Model):
         ('approvisionnement', 'APPROVISIONNEMENT'),
         ('honoraires', 'HONORAIRES'),
     ]
+    decompte = models.ForeignKey('Decompte', on_delete=models.CASCADE, related_name='lignes_recapitulatif',
+                                 null=True, blank=True, verbose_name="Décompte")
     nature_depenses = models.CharField(
         max_length=50, 
         choices=NATURE_DEPENSES_CHOICES,
@@ -586,7 +721,17 @@ class LigneDecompte(models.Model):
 
     def save(self, *args, **kwargs):
         self.reste_a_payer = self.cumul_a_date - self.cumul_deja_percu
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if self.decompte_id:
+                self.decompte.actualiser_resume()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            resultat = super().delete(*args, **kwargs)
+            if self.decompte_id:
+                self.decompte.actualiser_resume()
+        return resultat
 
     def __str__(self):
         return f"{self.get_nature_depenses_display()} - {self.cumul_a_date}"
@@ -596,6 +741,8 @@ class LigneDecompte(models.Model):
         return self.get_nature_depenses_display()
 
 class ResumeDecompte(models.Model):
+    decompte = models.OneToOneField('Decompte', on_delete=models.CASCADE, related_name='resume',
+                                    null=True, blank=True, verbose_name="Décompte")
     sous_total_ht = models.DecimalField(
         max_digits=15, 
         decimal_places=2, 
@@ -603,6 +750,20 @@ class ResumeDecompte(models.Model):
         verbose_name="Sous-total HT"
     )
     
+    deja_percu_ht = models.DecimalField(
+        max_digits=15, 
+        decimal_places=2, 
+        default=0.00,
+        verbose_name="Cumul déjà perçu HT"
+    )
+    
+    reste_a_payer_ht = models.DecimalField(
+        max_digits=15, 
+        decimal_places=2, 
+        default=0.00,
+        verbose_name="Reste à payer HT"
+    )
+    
     total_ht = models.DecimalField(
         max_digits=15, 
         decimal_places=2, 
@@ -645,7 +806,11 @@ class ResumeDecompte(models.Model):
         verbose_name_plural = "Résumés de décomptes"
 
     def calculer_totaux(self, decomptes):
-        self.sous_total_ht = sum(d.cumul_a_date for d in decomptes)
+        """Totaux à partir de lignes de décompte; pour un décompte enregistré, voir RecapitulatifDecomptes"""
+        if hasattr(decomptes, 'aggregate'):
+            self.sous_total_ht = decomptes.aggregate(total=Sum('cumul_a_date'))['total'] or 0
+        else:
+            self.sous_total_ht = sum(d.cumul_a_date for d in decomptes)
         self.total_ht = self.sous_total_ht
         self.tva_montant = self.total_ht * (self.tva_taux / 100)
         self.total_ttc = self.total_ht + self.tva_montant
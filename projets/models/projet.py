@@ -1,8 +1,8 @@
 from decimal import Decimal
 import os
 import cloudinary
-from django.db import models
-from django.db.models import Sum
+from django.db import models, transaction
+from django.db.models import Sum, F, OuterRef, Subquery
 from django.utils.translation import gettext_lazy as _
 from datetime import date, timedelta
 from django.contrib.auth.models import User
@@ -10,6 +10,7 @@ from django.utils import timezone
 from django.conf import settings
 from django.db.models import Q
 from django.core.exceptions import ValidationError
+from projets.arbre import Noeud
 
 # ------------------------ Entreprise ------------------------ #
 class Entreprise(models.Model):
@@ -257,8 +258,7 @@ class Projet(models.Model):
     @property
     def avancement_workflow(self):
         montant_total = self.montant_total()
-        dernier_attachement = self.attachements.order_by('-id').first()
-        montant_attachements = dernier_attachement.total_montant_ht if dernier_attachement else 0
+        montant_attachements = self.attachements.order_by('-id').values_list('montant_ht_cumule', flat=True).first() or 0
         if montant_total > 0:
             return round((montant_attachements / montant_total) * 100)
         return 0
@@ -649,35 +649,31 @@ class DocumentAdministratif(models.Model):
         return os.path.splitext(self.fichier.name)[1][1:].upper() if self.fichier else ''
 
 # ------------------ Lots du projet --------------------------
-class Line:
+class Line(Noeud):
+    __slots__ = ('numero', 'designation', 'montant')
+    
     def __init__(self, id=None, parent=None, numero="", designation="New Line", montant=Decimal('0.00')):
-        self.id=id
-        self.parent = parent
+        super().__init__(id=id, parent=parent)
         self.numero = numero
         self.designation = designation
         self.montant = montant
-        self.children = []
+    
+    def montant_feuille(self):
+        return self.montant
     
     def amount(self):
         if self.children:
-            return sum(child.amount() for child in self.children)
-        return self.montant
+            return self.totaux(lambda line: line.montant_feuille())[self]
+        return self.montant_feuille()
     
     def add_child(self, child_line):
-        child_line.parent = self
-        self.children.append(child_line)
-        return child_line
+        return self.ajouter_enfant(child_line)
     
     def insert_child(self, index, child_line):
-        child_line.parent = self
-        self.children.insert(index, child_line)
-        return child_line
+        return self.ajouter_enfant(child_line, index)
     
     def remove_child(self, child_line):
-        if child_line in self.children:
-            self.children.remove(child_line)
-            child_line.parent = None
-        else:
+        if not self.retirer_enfant(child_line):
             raise ValueError("Child line not found")
         return child_line
     
@@ -688,9 +684,7 @@ class Line:
             return -1
     
     def index(self):
-        if self.parent:
-            return self.parent.index_of(self)
-        return -1
+        return self.position()
     
     def get_child(self, index):
         if 0 <= index < len(self.children):
@@ -698,18 +692,13 @@ class Line:
         return None
     
     def find_by_id(self, id):
-        for child in self.get_descendants():
+        for child in self.descendants():
             if child.id == id:
                 return child
         return None
     
     def level(self):
-        level = 0
-        current = self.parent
-        while current:
-            level += 1
-            current = current.parent
-        return level
+        return self.profondeur
     
     def child_count(self):
         return len(self.children)
@@ -721,27 +710,22 @@ class Line:
         return self.children
     
     def get_descendants(self):
-        descendants = []
-        for child in self.children:
-            descendants.append(child)
-            descendants.extend(child.get_descendants())
-        return descendants
+        return list(self.descendants())
     
     def siblings(self):
         if self.parent:
-            return [child for child in self.parent.children if child != self]
+            return [child for child in self.parent.children if child is not self]
         return []
     
     def previous(self):
-        if self.parent:
-            index = self.parent.index_of(self)
-            if index > 0:
-                return self.parent.children[index - 1]
+        index = self.position()
+        if index > 0:
+            return self.parent.children[index - 1]
         return None
     
     def next(self):
         if self.parent:
-            index = self.parent.index_of(self)
+            index = self.position()
             if index < len(self.parent.children) - 1:
                 return self.parent.children[index + 1]
         return None
@@ -749,7 +733,6 @@ class Line:
     def indent(self):
         previous = self.previous()
         if previous:
-            self.niveau += 1
             previous.add_child(self)
             return self
         return None
@@ -768,11 +751,14 @@ class Line:
         return f"{self.designation} ({self.amount()})"
 
 class LineBPU(Line):
+    __slots__ = ('unite', 'quantite', 'pu', 'montant_cumule')
+    
     def __init__(self, id=None, parent=None, numero="", designation="New Line", unite="", quantite=Decimal('0.00'), pu=Decimal('0.00')):
         super().__init__(id=id, parent=parent, numero=numero, designation=designation,)
         self.unite = unite
         self.quantite = quantite
         self.pu = pu
+        self.montant_cumule = None  # montant précalculé par ArbreMontants (arbre figé)
     
     def get_child_by_id(self, id):
         for child in self.children:
@@ -783,16 +769,21 @@ class LineBPU(Line):
     def __str__(self):
         return f"{self.id} | {self.numero} | {self.designation} | {self.unite} | {self.quantite} | {self.pu} | {self.amount()}"
     
+    def montant_feuille(self):
+        if self.montant_cumule is not None:
+            return self.montant_cumule
+        return self.quantite * self.pu
+    
     def amount(self):
-        if self.has_children():
-            return sum(child.amount() for child in self.children)
-        else:
-            return self.quantite * self.pu
+        if self.montant_cumule is not None:
+            return self.montant_cumule
+        return super().amount()
 
 class LotProjet(models.Model):
     projet = models.ForeignKey(Projet, on_delete=models.CASCADE, related_name='lots', verbose_name=_("Projet"))
     nom = models.CharField(_("Nom du lot"), max_length=200)
     description = models.TextField(_("Description"), blank=True)
+    revision = models.PositiveIntegerField(_("Révision du bordereau"), default=0)
 
     class Meta:
         verbose_name = _("Lot du projet")
@@ -804,7 +795,7 @@ class LotProjet(models.Model):
 
     @property
     def montant_total_ht(self):
-        total = self.lignes.aggregate(total_ht=Sum('montant_calcule'))['total_ht']
+        total = self.lignes.filter(parent__isnull=True).aggregate(total_ht=Sum('sous_total_marche'))['total_ht']
         return total if total is not None else Decimal('0.00')
 
     @property
@@ -822,35 +813,96 @@ class LotProjet(models.Model):
         return mnt_txt
     @property
     def montant_realise(self):
-        total = self.lignes.aggregate(total_ht=Sum('montant_realise'))['total_ht']
+        total = self.lignes.filter(parent__isnull=True).aggregate(total_ht=Sum('sous_total_realise'))['total_ht']
         return total if total is not None else Decimal('0.00')
     
     def to_line_tree(self):
-        lignes_dict = {}
+        from projets.services.montants_service import ArbreMontants
+        
+        arbre = ArbreMontants.charger(self)
+        montants = arbre.montants_marche().tolist()
         root = Line(numero="Root", designation=self.nom)
         
-        for ligne in self.lignes.all():
-            lignes_dict[ligne.id] = LineBPU(
-                id=ligne.id,
-                numero=ligne.numero,
-                designation=ligne.designation,
-                unite=ligne.unite,
-                quantite=ligne.quantite,
-                pu=ligne.prix_unitaire,
-            )
-
-        for ligne in self.lignes.all():
-            line_instance = lignes_dict[ligne.id]
-            if ligne.parent_id:
-                parent_instance = lignes_dict.get(ligne.parent_id)
-                if parent_instance:
-                    parent_instance.add_child(line_instance)
-            else:
-                root.add_child(line_instance)
+        lines = []
+        for i, (ligne_id, _, numero, designation, unite, quantite, pu, _) in enumerate(arbre.lignes):
+            line_instance = LineBPU(id=ligne_id, numero=numero, designation=designation, unite=unite,
+                                    quantite=quantite, pu=pu)
+            line_instance.montant_cumule = montants[i]
+            lines.append(line_instance)
+        
+        # Les lignes sont en ordre préfixe: les enfants sont rattachés dans l'ordre d'affichage
+        for line_instance, parent_index in zip(lines, arbre.parent.tolist()):
+            parent_instance = lines[parent_index] if parent_index >= 0 else root
+            parent_instance.add_child(line_instance)
         return root
 
 # ------------------ Lignes de bordereau ---------------------
+def calculer_hierarchie(lignes):
+    """
+    Calcule en un parcours itératif le chemin matérialisé (ids des ancêtres), le niveau
+    et les bornes d'ensembles imbriqués des lignes d'un lot, à partir de parent_id et ordre_affichage.
+    """
+    par_id = {ligne.id: ligne for ligne in lignes}
+    enfants = {}
+    racines = []
+    for ligne in sorted(lignes, key=lambda l: (l.ordre_affichage, l.id)):
+        if ligne.parent_id in par_id and ligne.parent_id != ligne.id:
+            enfants.setdefault(ligne.parent_id, []).append(ligne)
+        else:
+            racines.append(ligne)
+    
+    compteur = 0
+    visitees = set()
+    # Les lignes prises dans un cycle de parents ne sont atteignables depuis aucune racine
+    candidates = iter(racines + sorted(lignes, key=lambda l: (l.ordre_affichage, l.id)))
+    for depart in candidates:
+        if depart.id in visitees:
+            continue
+        pile = [(depart, None, False)]
+        while pile:
+            ligne, parent, fermeture = pile.pop()
+            if fermeture:
+                compteur += 1
+                ligne.borne_droite = compteur
+                continue
+            if ligne.id in visitees:
+                continue
+            visitees.add(ligne.id)
+            compteur += 1
+            ligne.borne_gauche = compteur
+            ligne.niveau = parent.niveau + 1 if parent else 0
+            ligne.chemin = (parent.chemin if parent else '') + f"{ligne.id}/"
+            pile.append((ligne, None, True))
+            for enfant in reversed(enfants.get(ligne.id, [])):
+                pile.append((enfant, ligne, False))
+    return lignes
+
+def calculer_sous_totaux(lignes, quantites_realisees):
+    """
+    Cumule sur chaque ligne les montants marché et réalisé de ses feuilles en remontant le chemin
+    (les feuilles portent leurs propres montants). Chemins et bornes doivent être à jour.
+    """
+    par_id = {ligne.id: ligne for ligne in lignes}
+    for ligne in lignes:
+        ligne.sous_total_marche = Decimal('0.00')
+        ligne.sous_total_realise = Decimal('0.00')
+    for ligne in lignes:
+        if ligne.has_children:
+            continue
+        marche, realise = ligne.montants_propres(quantites_realisees.get(ligne.id, Decimal('0')))
+        for ancetre_id in ligne.chemin.split('/')[:-1]:
+            ancetre = par_id.get(int(ancetre_id))
+            if ancetre is not None:
+                ancetre.sous_total_marche += marche
+                ancetre.sous_total_realise += realise
+    return lignes
+
 class LigneBordereau(models.Model):
+    CHAMPS_HIERARCHIE = ['chemin', 'niveau', 'borne_gauche', 'borne_droite']
+    CHAMPS_SOUS_TOTAUX = ['sous_total_marche', 'sous_total_realise']
+    CHAMPS_MONTANTS = ['numero', 'unite', 'quantite', 'prix_unitaire']
+    CHAMPS_STRUCTURE = ['parent_id', 'ordre_affichage']
+    
     lot = models.ForeignKey(LotProjet, on_delete=models.CASCADE, related_name='lignes', verbose_name=_("Lot"))
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='enfants', 
                                verbose_name=_("Ligne parente (optionnel)"))
@@ -865,40 +917,160 @@ class LigneBordereau(models.Model):
     niveau = models.IntegerField(_("Niveau hiérarchique"), default=0)
     est_titre = models.BooleanField(_("Est un titre"), default=False)
     ordre_affichage = models.IntegerField(_("Ordre d'affichage"), default=0)
+    
+    # Hiérarchie matérialisée: chemin des ids ("12/45/78/") et bornes d'ensembles imbriqués du lot
+    chemin = models.CharField(_("Chemin hiérarchique"), max_length=500, blank=True, default='')
+    borne_gauche = models.IntegerField(_("Borne gauche"), default=0)
+    borne_droite = models.IntegerField(_("Borne droite"), default=0)
+    
+    # Montants cumulés des feuilles du sous-arbre (la ligne elle-même pour une feuille)
+    sous_total_marche = models.DecimalField(_("Sous-total marché"), max_digits=20, decimal_places=2, default=0)
+    sous_total_realise = models.DecimalField(_("Sous-total réalisé"), max_digits=20, decimal_places=2, default=0)
         
     class Meta:
         verbose_name = _("Ligne de bordereau")
         verbose_name_plural = _("Lignes de bordereau")
         ordering = ['ordre_affichage', 'id']
+        indexes = [
+            models.Index(fields=['lot', 'borne_gauche']),
+            models.Index(fields=['lot', 'borne_droite']),
+            models.Index(fields=['chemin']),
+        ]
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._valeurs_initiales = instance.valeurs_suivies()
+        return instance
+    
+    def valeurs_suivies(self):
+        """Valeurs de structure et de montants chargées sur l'instance (les champs différés sont ignorés)"""
+        return {champ: self.__dict__[champ] for champ in self.CHAMPS_STRUCTURE + self.CHAMPS_MONTANTS
+                if champ in self.__dict__}
+    
+    def a_change(self, champs):
+        """Un des champs a-t-il changé depuis la lecture ? Toujours vrai pour une ligne qui n'a pas été lue"""
+        initiales = getattr(self, '_valeurs_initiales', None)
+        if initiales is None:
+            return True
+        return any(champ in initiales and getattr(self, champ) != initiales[champ] for champ in champs)
+    
+    @classmethod
+    def reindexer_lot(cls, lot_id):
+        """Recalcule chemin, niveau et bornes de toutes les lignes d'un lot (une lecture, un bulk_update)"""
+        lignes = list(cls.objects.filter(lot_id=lot_id).only('id', 'parent_id', 'ordre_affichage', *cls.CHAMPS_HIERARCHIE))
+        etats = {ligne.id: tuple(getattr(ligne, champ) for champ in cls.CHAMPS_HIERARCHIE) for ligne in lignes}
+        calculer_hierarchie(lignes)
+        modifiees = [ligne for ligne in lignes
+                     if tuple(getattr(ligne, champ) for champ in cls.CHAMPS_HIERARCHIE) != etats[ligne.id]]
+        if modifiees:
+            cls.objects.bulk_update(modifiees, cls.CHAMPS_HIERARCHIE)
+        return len(modifiees)
+    
+    @classmethod
+    def avec_quantite_realisee(cls, lignes):
+        """
+        Annote chaque ligne du queryset de la quantité réalisée de son dernier attachement
+        (derniere_quantite_realisee, None sans attachement): lecture indexée du registre des cumuls
+        (dernière entrée saisie de la ligne), pas de requête par ligne
+        """
+        from .decomptes import CumulLigneAttachement
+        derniere = CumulLigneAttachement.objects.filter(ligne_lot=OuterRef('pk'), saisie=True).order_by(
+            '-sequence'
+        ).values('quantite_cumulee')[:1]
+        return lignes.annotate(derniere_quantite_realisee=Subquery(derniere))
+    
+    @classmethod
+    def quantites_realisees(cls, lot_id=None, projet_id=None):
+        """Quantité du dernier attachement de chaque ligne du lot (ou de tout le projet), en une requête"""
+        lignes = cls.objects.filter(lot_id=lot_id) if lot_id is not None else cls.objects.filter(lot__projet_id=projet_id)
+        return {
+            ligne_id: quantite
+            for ligne_id, quantite in cls.avec_quantite_realisee(lignes).values_list('id', 'derniere_quantite_realisee')
+            if quantite is not None
+        }
+    
+    @classmethod
+    def recalculer_sous_totaux(cls, lot_id):
+        """Recalcule entièrement les sous-totaux d'un lot (une lecture, un bulk_update des lignes modifiées)"""
+        lignes = list(cls.objects.filter(lot_id=lot_id).only(
+            'id', 'numero', 'unite', 'quantite', 'prix_unitaire', *cls.CHAMPS_HIERARCHIE, *cls.CHAMPS_SOUS_TOTAUX
+        ))
+        etats = {ligne.id: (ligne.sous_total_marche, ligne.sous_total_realise) for ligne in lignes}
+        calculer_sous_totaux(lignes, cls.quantites_realisees(lot_id))
+        modifiees = [ligne for ligne in lignes
+                     if (ligne.sous_total_marche, ligne.sous_total_realise) != etats[ligne.id]]
+        if modifiees:
+            cls.objects.bulk_update(modifiees, cls.CHAMPS_SOUS_TOTAUX)
+        return len(modifiees)
+    
+    def montants_propres(self, quantite_realisee):
+        """Montants marché et réalisé portés par une feuille, arrondis au centime"""
+        centime = Decimal('0.01')
+        marche = (self.quantite * self.prix_unitaire).quantize(centime)
+        if self.is_title:
+            return marche, Decimal('0.00')
+        return marche, (Decimal(quantite_realisee) * self.prix_unitaire).quantize(centime)
+    
+    def propager_sous_totaux(self, delta_marche, delta_realise, inclure_ligne=False):
+        """Reporte une variation de montants sur tous les ancêtres en un seul UPDATE"""
+        if not delta_marche and not delta_realise:
+            return
+        ids = self.ancetres_ids + ([self.id] if inclure_ligne else [])
+        if ids:
+            LigneBordereau.objects.filter(id__in=ids).update(
+                sous_total_marche=F('sous_total_marche') + delta_marche,
+                sous_total_realise=F('sous_total_realise') + delta_realise,
+            )
+    
+    def actualiser_realise(self):
+        """Met à jour le réalisé d'une feuille et de ses ancêtres après un changement d'attachement"""
+        self.refresh_from_db(fields=['numero', 'unite', 'quantite', 'prix_unitaire', 'sous_total_realise',
+                                     *self.CHAMPS_HIERARCHIE])
+        if self.has_children:
+            return
+        _, realise = self.montants_propres(self.get_quantite_deja_realisee)
+        delta = realise - self.sous_total_realise
+        self.propager_sous_totaux(Decimal('0.00'), delta, inclure_ligne=True)
+        self.sous_total_realise = realise
+    
+    def get_descendants(self):
+        return LigneBordereau.objects.filter(lot_id=self.lot_id, borne_gauche__gt=self.borne_gauche,
+                                             borne_droite__lt=self.borne_droite)
+    
+    def get_feuilles(self):
+        return self.get_descendants().filter(borne_droite=F('borne_gauche') + 1)
+    
+    def get_ancetres(self):
+        return LigneBordereau.objects.filter(lot_id=self.lot_id, borne_gauche__lt=self.borne_gauche,
+                                             borne_droite__gt=self.borne_droite)
+    
+    @property
+    def ancetres_ids(self):
+        return [int(ligne_id) for ligne_id in self.chemin.split('/')[:-2]]
     
     @property
     def montant(self):
-        if self.enfants.exists():
-            return sum(enfant.montant for enfant in self.enfants.all())
+        if self.has_children:
+            return self.sous_total_marche
         return self.quantite * self.prix_unitaire
      
     def get_montant_total(self):
         if self.est_titre:
-            total = sum(child.get_montant_total() for child in self.enfants.all())
-            return total
+            return self.sous_total_marche
         return self.montant_calcule
     
     @property
     def has_children(self):
-        return self.enfants.exists()
+        return self.borne_droite > self.borne_gauche + 1
     
     @property
     def level(self):
-        level = 0
-        current = self.parent
-        while current:
-            level += 1
-            current = current.parent
-        return level
+        return self.niveau
     
     @property
     def is_feuille(self):
-        return not self.enfants.exists()
+        return not self.has_children
     
     @property
     def is_title(self):
@@ -908,33 +1080,119 @@ class LigneBordereau(models.Model):
     def get_quantite_deja_realisee(self):
         if self.is_title:
             return Decimal('0')
+        if hasattr(self, 'derniere_quantite_realisee'):
+            # Ligne chargée par avec_quantite_realisee: pas de requête supplémentaire
+            return self.derniere_quantite_realisee if self.derniere_quantite_realisee is not None else Decimal('0')
         
-        dernier_att_cette_ligne = self.lignes_attachement.select_related('attachement').order_by(
-            '-attachement__date_etablissement', '-id'
-        ).first()
-        
-        if dernier_att_cette_ligne:
-            return dernier_att_cette_ligne.quantite_realisee
-        return Decimal('0')
+        # Dernière quantité saisie de la ligne, lue dans le registre des cumuls
+        quantite = self.cumuls.filter(saisie=True).order_by('-sequence').values_list('quantite_cumulee', flat=True).first()
+        return quantite if quantite is not None else Decimal('0')
     @property
     def montant_realise(self):
         if self.est_titre:
-            total = sum(child.montant_realise for child in self.enfants.all())
-            return total
+            return self.sous_total_realise
         return self.get_quantite_deja_realisee * self.prix_unitaire
     @property
     def quantite_restante(self):
         return self.quantite - self.get_quantite_deja_realisee
     
     def save(self, *args, **kwargs):
-        if self.parent:
-            self.niveau = self.parent.niveau + 1
-        else:
-            self.niveau = 0
-            
+        """
+        Enregistrement ligne à ligne: une nouvelle ligne est insérée dans l'arbre sans le réindexer
+        (inserer_feuille), une feuille modifiée sur place reporte la variation de ses montants sur ses ancêtres;
+        seul un déplacement (parent ou ordre modifié) réindexe le lot. Les grilles complètes passent par
+        BordereauSaver. La révision du lot ne change qu'avec la structure ou les montants; un champ différé
+        à la lecture est tenu pour inchangé.
+        """
         if not self.est_titre:
             self.montant_calcule = self.quantite * self.prix_unitaire
-        super().save(*args, **kwargs)
+        
+        creation = self.pk is None
+        structure_modifiee = creation or self.a_change(self.CHAMPS_STRUCTURE)
+        montants_modifies = self.a_change(self.CHAMPS_MONTANTS)
+        delta_marche = delta_realise = Decimal('0.00')
+        if not structure_modifiee and montants_modifies and not self.has_children:
+            # Feuille modifiée sur place: seule la variation de ses montants remonte aux ancêtres
+            marche, realise = self.montants_propres(self.get_quantite_deja_realisee)
+            delta_marche = marche - self.sous_total_marche
+            delta_realise = realise - self.sous_total_realise
+            self.sous_total_marche, self.sous_total_realise = marche, realise
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            
+            if structure_modifiee and not (creation and self.inserer_feuille()):
+                LigneBordereau.reindexer_lot(self.lot_id)
+                LigneBordereau.recalculer_sous_totaux(self.lot_id)
+                self.refresh_from_db(fields=self.CHAMPS_HIERARCHIE + self.CHAMPS_SOUS_TOTAUX)
+            elif not structure_modifiee:
+                self.propager_sous_totaux(delta_marche, delta_realise)
+            self._valeurs_initiales = self.valeurs_suivies()
+            if structure_modifiee or montants_modifies:
+                LotProjet.objects.filter(pk=self.lot_id).update(revision=F('revision') + 1)
+    
+    def inserer_feuille(self):
+        """
+        Place une ligne qui vient d'être créée (donc sans enfants) parmi ses frères, sans réindexer le lot:
+        les bornes qui suivent sa position sont décalées de 2 (deux UPDATE), chemin et niveau viennent du
+        parent et ses montants remontent aux ancêtres. Faux si le parent n'est pas une ligne du lot.
+        """
+        parent = None
+        if self.parent_id is not None:
+            parent = LigneBordereau.objects.filter(pk=self.parent_id, lot_id=self.lot_id).first()
+            if parent is None:
+                return False
+        precedent = LigneBordereau.objects.filter(lot_id=self.lot_id, parent_id=self.parent_id).filter(
+            Q(ordre_affichage__lt=self.ordre_affichage) | Q(ordre_affichage=self.ordre_affichage, id__lt=self.id)
+        ).order_by('-ordre_affichage', '-id').values_list('borne_droite', flat=True).first()
+        if precedent is not None:
+            position = precedent + 1
+        else:
+            position = parent.borne_gauche + 1 if parent is not None else 1
+        
+        suivantes = LigneBordereau.objects.filter(lot_id=self.lot_id).exclude(pk=self.pk)
+        suivantes.filter(borne_gauche__gte=position).update(borne_gauche=F('borne_gauche') + 2)
+        suivantes.filter(borne_droite__gte=position).update(borne_droite=F('borne_droite') + 2)
+        self.borne_gauche, self.borne_droite = position, position + 1
+        self.niveau = parent.niveau + 1 if parent is not None else 0
+        self.chemin = (parent.chemin if parent is not None else '') + f"{self.id}/"
+        # Nouvelle ligne: aucune quantité réalisée
+        self.sous_total_marche, self.sous_total_realise = self.montants_propres(Decimal('0'))
+        LigneBordereau.objects.filter(pk=self.pk).update(
+            **{champ: getattr(self, champ) for champ in self.CHAMPS_HIERARCHIE + self.CHAMPS_SOUS_TOTAUX}
+        )
+        if parent is not None and not parent.has_children:
+            # L'ancien parent était une feuille: ses propres montants cessent de compter pour lui et ses ancêtres
+            parent.propager_sous_totaux(-parent.sous_total_marche, -parent.sous_total_realise, inclure_ligne=True)
+        self.propager_sous_totaux(self.sous_total_marche, self.sous_total_realise)
+        return True
+    
+    def delete(self, *args, **kwargs):
+        """
+        Une feuille est retirée sans réindexer le lot (bornes suivantes décalées, montants retirés des ancêtres,
+        parent redevenu feuille recompté); une ligne avec enfants, dont les enfants remontent à la racine,
+        réindexe le lot
+        """
+        lot_id = self.lot_id
+        with transaction.atomic():
+            self.refresh_from_db(fields=['parent'] + self.CHAMPS_HIERARCHIE + self.CHAMPS_SOUS_TOTAUX)
+            if self.has_children:
+                resultat = super().delete(*args, **kwargs)
+                LigneBordereau.reindexer_lot(lot_id)
+                LigneBordereau.recalculer_sous_totaux(lot_id)
+            else:
+                parent = LigneBordereau.objects.filter(pk=self.parent_id, lot_id=lot_id).first()
+                self.propager_sous_totaux(-self.sous_total_marche, -self.sous_total_realise)
+                borne_droite = self.borne_droite
+                resultat = super().delete(*args, **kwargs)
+                suivantes = LigneBordereau.objects.filter(lot_id=lot_id)
+                suivantes.filter(borne_gauche__gt=borne_droite).update(borne_gauche=F('borne_gauche') - 2)
+                suivantes.filter(borne_droite__gt=borne_droite).update(borne_droite=F('borne_droite') - 2)
+                if parent is not None and parent.borne_droite == parent.borne_gauche + 3:
+                    # Le parent n'avait que cette ligne: redevenu feuille, il porte à nouveau ses propres montants
+                    marche, realise = parent.montants_propres(parent.get_quantite_deja_realisee)
+                    parent.propager_sous_totaux(marche, realise, inclure_ligne=True)
+            LotProjet.objects.filter(pk=lot_id).update(revision=F('revision') + 1)
+        return resultat
         
     def __str__(self):
         return f"{self.numero} – {self.designation[:30]}"
@@ -0,0 +1,73 @@
+from datetime import date
+from decimal import Decimal
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+# ------------------------ Indices de révision ------------------------
+class IndiceRevision(models.Model):
+    code = models.CharField(_("Code"), max_length=20, unique=True)
+    libelle = models.CharField(_("Libellé"), max_length=200, blank=True)
+    unite = models.CharField(_("Unité"), max_length=20, blank=True)
+
+    class Meta:
+        verbose_name = _("Indice de révision")
+        verbose_name_plural = _("Indices de révision")
+        ordering = ['code']
+
+    def __str__(self):
+        return f"{self.code} - {self.libelle}" if self.libelle else self.code
+
+
+class ValeurIndice(models.Model):
+    """
+    Série mensuelle d'un indice: une valeur par (indice, mois), le mois étant le premier jour du mois.
+    Alimentée en bloc par IndicesImporter, lue par projets.services.indices_service.CacheIndices.
+    """
+    indice = models.ForeignKey(IndiceRevision, on_delete=models.CASCADE, related_name='valeurs')
+    mois = models.DateField(_("Mois"))
+    valeur = models.DecimalField(_("Valeur"), max_digits=12, decimal_places=4)
+    date_publication = models.DateField(_("Date de publication"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("Valeur d'indice")
+        verbose_name_plural = _("Valeurs d'indices")
+        ordering = ['indice', 'mois']
+        constraints = [
+            models.UniqueConstraint(fields=['indice', 'mois'], name='valeur_indice_unique_par_mois'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.mois = date(self.mois.year, self.mois.month, 1)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.indice_id} {self.mois:%Y-%m}: {self.valeur}"
+
+
+class ConfigRevisionProjet(models.Model):
+    """
+    Formule de révision d'un projet: P = P0 · (a + Σ bᵢ · Iᵢ / I0ᵢ), a étant la partie fixe et bᵢ le poids
+    de l'indice de code i (coefficients: {code: bᵢ}); I0ᵢ est la valeur de l'indice au mois de base,
+    Iᵢ sa valeur au mois de la période révisée. La variation (P / P0 - 1) est multipliée par le
+    coefficient K et ramenée à zéro si sa valeur absolue reste sous la marge (en %).
+    """
+    projet = models.OneToOneField('Projet', on_delete=models.CASCADE, related_name='config_revision')
+    partie_fixe = models.DecimalField(_("Partie fixe (a)"), max_digits=6, decimal_places=4, default=Decimal('0.15'))
+    coefficients = models.JSONField(_("Coefficients des indices (bᵢ)"), default=dict, blank=True)
+    mois_base = models.DateField(_("Mois des indices de base (I0)"))
+    coefficient_K = models.DecimalField(_("Coefficient K"), max_digits=6, decimal_places=4, default=Decimal('1'))
+    marge_variation = models.DecimalField(_("Marge de variation (%)"), max_digits=5, decimal_places=2,
+                                          default=Decimal('0'))
+    date_modification = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = _("Configuration de révision")
+        verbose_name_plural = _("Configurations de révision")
+
+    def save(self, *args, **kwargs):
+        self.mois_base = date(self.mois_base.year, self.mois_base.month, 1)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"Révision {self.projet_id}: {self.partie_fixe} + " + " + ".join(
+            f"{coefficient}·{code}" for code, coefficient in self.coefficients.items())
@@ -0,0 +1,148 @@
+# services/attachement_service.py
+# Enregistrement ensembliste des lignes d'attachement
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from django.db.models import F, Sum
+from projets.models import LigneAttachement, LigneBordereau
+from projets.services.cumuls_service import RegistreCumuls
+
+
+class AttachementSaver:
+    """
+    Enregistre les lignes d'un attachement soumises par la grille en un nombre fixe de requêtes:
+    lignes de bordereau référencées et cumuls des attachements antérieurs chargés en deux requêtes groupées,
+    insertion par bulk_create, puis recalcul des sous-totaux réalisés des lots touchés.
+    En modification, les lignes existantes sont comparées à la grille: seules les lignes modifiées sont
+    mises à jour (ids conservés), les nouvelles insérées et les retirées supprimées, chaque fois en une requête.
+    """
+    TAILLE_LOT = 1000
+    CHAMPS = ['numero', 'designation', 'unite', 'prix_unitaire', 'quantite_initiale', 'quantite_realisee',
+              'quantite_cumulee']
+
+    def __init__(self, attachement):
+        self.attachement = attachement
+
+    @staticmethod
+    def lignes_soumises(rows):
+        """Lignes de la grille à enregistrer: {id ligne de bordereau: quantité réalisée}, titres de fin retirés"""
+        rows = list(rows)
+        while rows and rows[-1].get('is_title'):
+            rows.pop()
+        quantites = {}
+        for row in rows:
+            try:
+                quantites[int(row['id'])] = Decimal(str(row.get('quantite_realisee') or 0))
+            except (InvalidOperation, ValueError) as e:
+                raise ValueError(f"Quantité invalide pour la ligne {row.get('id')}: {e}")
+        return quantites
+
+    def charger_lignes(self, ids):
+        """Lignes de bordereau du projet référencées par la grille (une requête)"""
+        lignes = LigneBordereau.objects.filter(lot__projet_id=self.attachement.projet_id).in_bulk(ids)
+        manquantes = set(ids) - set(lignes)
+        if manquantes:
+            raise ValueError(f"Lignes de bordereau introuvables: {sorted(manquantes)[:10]}")
+        return lignes
+
+    def cumuls_precedents(self, ids):
+        """Somme des quantités réalisées des attachements antérieurs, par ligne (une requête groupée)"""
+        return dict(
+            LigneAttachement.objects.filter(
+                ligne_lot_id__in=ids,
+                attachement__date_etablissement__lt=self.attachement.date_etablissement,
+            ).values('ligne_lot_id').annotate(total=Sum('quantite_realisee')).values_list('ligne_lot_id', 'total')
+        )
+
+    def nouvelle_ligne(self, ligne, quantite_realisee, cumul_precedent):
+        """Instance non enregistrée, quantite_cumulee calculée comme LigneAttachement.save"""
+        if ligne.is_title:
+            quantite_realisee = Decimal('0')
+        return LigneAttachement(
+            attachement=self.attachement,
+            ligne_lot=ligne,
+            numero=ligne.numero,
+            designation=ligne.designation,
+            unite=ligne.unite,
+            prix_unitaire=ligne.prix_unitaire,
+            quantite_initiale=ligne.quantite,
+            quantite_realisee=quantite_realisee,
+            quantite_cumulee=(cumul_precedent or Decimal('0')) + quantite_realisee,
+        )
+
+    def recalculer_lots(self, lot_ids):
+        """
+        Les insertions ensemblistes ne passent pas par save: registre des cumuls actualisé pour l'attachement
+        et son suivant, puis réalisé des lots touchés recalculé par lot (il lit le registre)
+        """
+        RegistreCumuls(self.attachement.projet_id).actualiser(self.attachement.id)
+        for lot_id in sorted(lot_ids):
+            LigneBordereau.recalculer_sous_totaux(lot_id)
+
+    def creer(self, rows):
+        """Crée les lignes de l'attachement (titres inclus, articles à quantité nulle ignorés). Retourne leur nombre"""
+        quantites = self.lignes_soumises(rows)
+        if not quantites:
+            return 0
+        with transaction.atomic():
+            lignes = self.charger_lignes(list(quantites))
+            retenues = [ligne_id for ligne_id, quantite in quantites.items()
+                        if quantite > 0 or lignes[ligne_id].is_title]
+            cumuls = self.cumuls_precedents(retenues)
+            nouvelles = [self.nouvelle_ligne(lignes[ligne_id], quantites[ligne_id], cumuls.get(ligne_id))
+                         for ligne_id in retenues]
+            LigneAttachement.objects.bulk_create(nouvelles, batch_size=self.TAILLE_LOT)
+            self.recalculer_lots({lignes[ligne_id].lot_id for ligne_id in retenues})
+        return len(nouvelles)
+
+    def modifier(self, rows):
+        """Applique la grille aux lignes existantes de l'attachement. Retourne (créées, modifiées, supprimées)"""
+        quantites = self.lignes_soumises(rows)
+        with transaction.atomic():
+            existantes = {
+                ligne.ligne_lot_id: ligne
+                for ligne in LigneAttachement.objects.filter(attachement=self.attachement).annotate(
+                    lot_ligne_id=F('ligne_lot__lot_id'))
+            }
+            lignes = self.charger_lignes(list(quantites)) if quantites else {}
+            retenues = [ligne_id for ligne_id, quantite in quantites.items()
+                        if quantite > 0 or lignes[ligne_id].is_title]
+            cumuls = self.cumuls_precedents(retenues)
+
+            creees, modifiees = [], []
+            for ligne_id in retenues:
+                attendue = self.nouvelle_ligne(lignes[ligne_id], quantites[ligne_id], cumuls.get(ligne_id))
+                existante = existantes.get(ligne_id)
+                if existante is None:
+                    creees.append(attendue)
+                    continue
+                valeurs = [getattr(attendue, champ) for champ in self.CHAMPS]
+                if valeurs != [getattr(existante, champ) for champ in self.CHAMPS]:
+                    for champ, valeur in zip(self.CHAMPS, valeurs):
+                        setattr(existante, champ, valeur)
+                    modifiees.append(existante)
+            conservees = set(retenues)
+            supprimees = [ligne for ligne_id, ligne in existantes.items() if ligne_id not in conservees]
+
+            if supprimees:
+                LigneAttachement.objects.filter(id__in=[ligne.id for ligne in supprimees]).delete()
+            if modifiees:
+                LigneAttachement.objects.bulk_update(modifiees, self.CHAMPS, batch_size=self.TAILLE_LOT)
+            if creees:
+                LigneAttachement.objects.bulk_create(creees, batch_size=self.TAILLE_LOT)
+
+            lots = {ligne.ligne_lot.lot_id for ligne in creees}
+            lots |= {ligne.lot_ligne_id for ligne in modifiees + supprimees}
+            self.recalculer_lots(lots)
+        return len(creees), len(modifiees), len(supprimees)
+
+    def quantites_grille(self, precedent):
+        """
+        Quantités réalisées de l'attachement et de son précédent pour la grille d'édition,
+        en deux requêtes: ({id ligne: quantité}, {id ligne: quantité précédente})
+        """
+        def quantites(attachement):
+            if attachement is None:
+                return {}
+            return dict(LigneAttachement.objects.filter(attachement=attachement)
+                        .values_list('ligne_lot_id', 'quantite_realisee'))
+        return quantites(self.attachement), quantites(precedent)
@@ -0,0 +1,465 @@
+# services/bordereau_service.py
+# Sauvegarde ensembliste des lignes de bordereau
+from decimal import Decimal, InvalidOperation
+from django.db import transaction
+from django.db.models import Case, CharField, F, Q, Sum, Value, When
+from django.db.models.functions import Concat, Substr
+from projets.models import LigneBordereau, LotProjet, calculer_hierarchie, calculer_sous_totaux
+
+
+def decimal_or_zero(value, decimal_places=2):
+    """Convertit une valeur saisie en Decimal arrondi au nombre de décimales du champ"""
+    try:
+        valeur = Decimal(str(value)) if value not in (None, '') else Decimal('0')
+    except (InvalidOperation, ValueError):
+        valeur = Decimal('0')
+    return valeur.quantize(Decimal(1).scaleb(-decimal_places))
+
+
+class BordereauSaver:
+    """
+    Applique une grille de bordereau soumise à un lot en un nombre fixe de requêtes:
+    diff avec les lignes existantes, bulk_create / bulk_update / un seul delete,
+    le tout dans une transaction.
+    """
+    CHAMPS = ['numero', 'designation', 'unite', 'quantite', 'prix_unitaire', 'montant_calcule',
+              'est_titre', 'ordre_affichage', 'parent', 'niveau', 'chemin', 'borne_gauche', 'borne_droite',
+              'sous_total_marche', 'sous_total_realise']
+
+    def __init__(self, lot):
+        self.lot = lot
+        self.lignes = {}            # clé client -> instance LigneBordereau
+        self.parents = {}           # clé client -> clé client du parent
+        self.lignes_modifiees = []  # instances existantes dont au moins un champ a changé
+        self.lignes_creees = []     # nouvelles instances
+        self.lignes_supprimees = set()
+
+    @staticmethod
+    def etat(ligne):
+        return tuple(getattr(ligne, 'parent_id' if champ == 'parent' else champ) for champ in BordereauSaver.CHAMPS)
+
+    def appliquer_ligne(self, ligne, row, index):
+        """Copie les valeurs d'une ligne de la grille dans l'instance"""
+        ligne.numero = row.get('numero') or ''
+        ligne.designation = row.get('designation') or ''
+        ligne.unite = row.get('unite') or ''
+        ligne.quantite = decimal_or_zero(row.get('quantite'))
+        ligne.prix_unitaire = decimal_or_zero(row.get('prix_unitaire'))
+        ligne.est_titre = bool(row.get('est_titre', False))
+        ligne.ordre_affichage = index
+        if ligne.est_titre:
+            ligne.montant_calcule = decimal_or_zero(row.get('montant'))
+        else:
+            ligne.montant_calcule = ligne.quantite * ligne.prix_unitaire
+
+    def sauvegarder(self, rows, existantes=None, revision=None):
+        """
+        Sauvegarde la grille et retourne le mapping {id client: id en base}. Avec revision, la grille doit avoir
+        été lue sur la dernière révision du bordereau (ConflitRevision sinon)
+        """
+        with transaction.atomic():
+            lot = LotProjet.objects.select_for_update().filter(pk=self.lot.pk).first()
+            if revision is not None and int(revision) != lot.revision:
+                raise ConflitRevision(lot.revision)
+            if existantes is None:
+                existantes = {ligne.id: ligne for ligne in LigneBordereau.objects.filter(lot=self.lot)}
+            etats_initiaux = {}
+
+            # 1. Rapprocher chaque ligne soumise d'une ligne existante ou d'une nouvelle instance
+            for index, row in enumerate(rows):
+                cle = row.get('id')
+                if cle is None:
+                    cle = f"nouvelle_{index}"
+                if cle in self.lignes:
+                    continue
+                if cle in existantes:
+                    ligne = existantes[cle]
+                    etats_initiaux[cle] = self.etat(ligne)
+                else:
+                    ligne = LigneBordereau(lot=self.lot)
+                    self.lignes_creees.append(ligne)
+                self.appliquer_ligne(ligne, row, index)
+                self.lignes[cle] = ligne
+                self.parents[cle] = row.get('parent_id')
+
+            # Les parents inconnus de la grille sont rattachés à la racine
+            for cle, parent_cle in self.parents.items():
+                if parent_cle not in self.lignes or parent_cle == cle:
+                    self.parents[cle] = None
+
+            # 2. Créer les nouvelles lignes (les parents déjà en base sont résolus immédiatement)
+            for cle, ligne in self.lignes.items():
+                parent = self.lignes.get(self.parents[cle])
+                ligne.parent_id = parent.id if parent is not None else None
+            if self.lignes_creees:
+                LigneBordereau.objects.bulk_create(self.lignes_creees)
+
+            # 3. Second passage: résoudre les parents vers les lignes nouvellement créées,
+            #    puis recalculer chemins, bornes et sous-totaux (le chemin des nouvelles lignes contient leur id)
+            for cle, ligne in self.lignes.items():
+                parent = self.lignes.get(self.parents[cle])
+                ligne.parent_id = parent.id if parent is not None else None
+            calculer_hierarchie(list(self.lignes.values()))
+            quantites = LigneBordereau.quantites_realisees(self.lot.pk) if etats_initiaux else {}
+            calculer_sous_totaux(list(self.lignes.values()), quantites)
+            # Le montant d'un titre avec enfants est son sous-total (un titre vide garde le montant soumis)
+            for ligne in self.lignes.values():
+                if ligne.est_titre and ligne.has_children:
+                    ligne.montant_calcule = ligne.sous_total_marche
+            
+            a_mettre_a_jour = list(self.lignes_creees)
+            for cle, etat_initial in etats_initiaux.items():
+                ligne = self.lignes[cle]
+                if self.etat(ligne) != etat_initial:
+                    self.lignes_modifiees.append(ligne)
+                    a_mettre_a_jour.append(ligne)
+            if a_mettre_a_jour:
+                LigneBordereau.objects.bulk_update(a_mettre_a_jour, self.CHAMPS)
+
+            # 4. Supprimer en une fois les lignes absentes de la grille
+            ids_a_supprimer = set(existantes) - set(etats_initiaux)
+            if ids_a_supprimer:
+                LigneBordereau.objects.filter(id__in=ids_a_supprimer).delete()
+            self.lignes_supprimees = ids_a_supprimer
+
+            # 5. Nouvelle révision du bordereau
+            LotProjet.objects.filter(pk=self.lot.pk).update(revision=F('revision') + 1)
+            self.lot.revision = LotProjet.objects.values_list('revision', flat=True).get(pk=self.lot.pk)
+
+        return {cle: ligne.id for cle, ligne in self.lignes.items()}
+
+
+class ConflitRevision(Exception):
+    """Le client a travaillé sur une révision du bordereau qui n'est plus la dernière"""
+    def __init__(self, revision):
+        super().__init__(f"Le bordereau a été modifié entre-temps (révision actuelle: {revision}).")
+        self.revision = revision
+
+
+class BordereauPatcher:
+    """
+    Applique une liste ordonnée d'opérations à l'arbre d'un lot, côté serveur:
+        {"op": "update",  "id": 12, "valeurs": {"prix_unitaire": 150}}
+        {"op": "insert",  "id": "tmp_1", "parent_id": 4, "index": 2, "valeurs": {...}}
+        {"op": "delete",  "id": 12}                      (supprime aussi les descendants)
+        {"op": "indent",  "id": 12}                      (devient le dernier enfant du frère précédent)
+        {"op": "outdent", "id": 12}                      (dernier enfant uniquement, placé après son parent)
+        {"op": "move",    "id": 12, "parent_id": None, "index": 0}
+    L'index est la position parmi les nouveaux frères (à la fin si absent). Les identifiants
+    temporaires créés par un insert peuvent être référencés par les opérations suivantes.
+    Le lot n'est pas chargé: seules les lignes citées et les frères utiles au placement sont lus.
+    Une insertion, une suppression ou un déplacement décale les bornes des lignes suivantes par UPDATE
+    ensembliste (leur ordre d'affichage suit leur borne gauche), et la variation des montants n'est
+    reportée que sur les ancêtres concernés.
+    """
+    CHAMPS_MODIFIABLES = ('numero', 'designation', 'unite', 'quantite', 'prix_unitaire')
+    CHAMPS_ECRITS = [*CHAMPS_MODIFIABLES, 'est_titre', 'montant_calcule']
+    CHAMPS_RELUS = ['parent_id', 'ordre_affichage', *LigneBordereau.CHAMPS_HIERARCHIE, *LigneBordereau.CHAMPS_SOUS_TOTAUX]
+
+    def __init__(self, lot):
+        self.lot = lot
+        self.lignes = {}            # id -> ligne lue (hiérarchie et sous-totaux relus après chaque opération)
+        self.temporaires = {}       # id temporaire d'un insert -> id en base
+        self.creees = set()
+        self.modifiees = set()      # lignes existantes modifiées ou déplacées par une opération
+        self.supprimees = set()
+        self.a_ecrire = set()       # lignes dont les valeurs saisies sont à enregistrer
+        self.recalculees = set()    # lignes dont le sous-total a varié (montant des titres à reprendre)
+        self.touchees = set()       # lignes dont le montant est renvoyé au client, avec leurs ancêtres
+
+    # ------------------ Lecture à la demande ------------------
+    def requete(self):
+        return LigneBordereau.avec_quantite_realisee(LigneBordereau.objects.filter(lot_id=self.lot.pk))
+
+    def cle(self, ligne_id):
+        if ligne_id in self.temporaires:
+            return self.temporaires[ligne_id]
+        try:
+            return int(ligne_id)
+        except (TypeError, ValueError):
+            raise ValueError(f"Ligne inconnue: {ligne_id}")
+
+    def ligne(self, ligne_id):
+        """Ligne du lot (id en base ou temporaire), lue au premier accès"""
+        cle = self.cle(ligne_id)
+        if cle not in self.lignes:
+            ligne = self.requete().filter(pk=cle).first()
+            if ligne is None:
+                raise ValueError(f"Ligne inconnue: {ligne_id}")
+            self.lignes[cle] = ligne
+        return self.lignes[cle]
+
+    def parent(self, ligne):
+        return self.ligne(ligne.parent_id) if ligne.parent_id is not None else None
+
+    def enfants(self, parent):
+        """Enfants de parent (racines si None) dans l'ordre d'affichage, instances déjà lues conservées"""
+        enfants = self.requete().filter(parent_id=parent.id) if parent is not None else \
+            self.requete().filter(parent__isnull=True)
+        return [self.lignes.setdefault(enfant.id, enfant) for enfant in enfants.order_by('borne_gauche', 'id')]
+
+    def rafraichir(self):
+        """Relit hiérarchie et sous-totaux des lignes lues (une requête), décalés par les UPDATE ensemblistes"""
+        for valeurs in LigneBordereau.objects.filter(pk__in=list(self.lignes)).values('id', *self.CHAMPS_RELUS):
+            ligne = self.lignes[valeurs.pop('id')]
+            for champ, valeur in valeurs.items():
+                setattr(ligne, champ, valeur)
+
+    # ------------------ Primitives sur l'arbre ------------------
+    def position(self, parent, index=None, exclue=None):
+        """Borne (numérotation actuelle) devant laquelle placer une ligne parmi les enfants de parent"""
+        freres = [frere for frere in self.enfants(parent) if frere is not exclue]
+        index = len(freres) if index is None else min(max(int(index), 0), len(freres))
+        if index < len(freres):
+            return freres[index].borne_gauche
+        if parent is not None:
+            return parent.borne_droite
+        return freres[-1].borne_droite + 1 if freres else 1
+
+    def decaler(self, plages):
+        """
+        Décale en un UPDATE les bornes comprises dans chaque plage (debut, fin, décalage; fin None = jusqu'au
+        bout du lot) et aligne l'ordre d'affichage des lignes qui suivent le début sur leur borne gauche
+        """
+        def decalee(champ):
+            return Case(*[
+                When(Q(**{f"{champ}__gte": debut}) & (Q(**{f"{champ}__lte": fin}) if fin is not None else Q()),
+                     then=F(champ) + decalage)
+                for debut, fin, decalage in plages
+            ], default=F(champ))
+
+        debut = min(plage[0] for plage in plages)
+        LigneBordereau.objects.filter(lot_id=self.lot.pk, borne_droite__gte=debut).update(
+            borne_gauche=decalee('borne_gauche'),
+            borne_droite=decalee('borne_droite'),
+            ordre_affichage=Case(When(borne_gauche__gte=debut, then=decalee('borne_gauche')),
+                                 default=F('ordre_affichage')),
+        )
+
+    def propager(self, ligne, delta_marche, delta_realise, inclure_ligne=False):
+        """Reporte une variation de montants sur les ancêtres (un UPDATE), lignes déjà lues comprises"""
+        ids = ligne.ancetres_ids + ([ligne.id] if inclure_ligne else [])
+        ligne.propager_sous_totaux(delta_marche, delta_realise, inclure_ligne=inclure_ligne)
+        for ligne_id in ids:
+            if ligne_id in self.lignes:
+                self.lignes[ligne_id].sous_total_marche += delta_marche
+                self.lignes[ligne_id].sous_total_realise += delta_realise
+        self.recalculees.update(ids)
+
+    def redevenir_feuille(self, ligne):
+        """Une ligne sans enfants porte à nouveau ses propres montants (reportés sur elle et ses ancêtres)"""
+        if ligne is not None and not ligne.has_children:
+            marche, realise = ligne.montants_propres(ligne.get_quantite_deja_realisee)
+            self.propager(ligne, marche, realise, inclure_ligne=True)
+
+    def cesser_d_etre_feuille(self, ligne):
+        """Une feuille qui reçoit des enfants cesse de compter ses propres montants"""
+        if ligne is not None and not ligne.has_children:
+            self.propager(ligne, -ligne.sous_total_marche, -ligne.sous_total_realise, inclure_ligne=True)
+
+    def modifier(self, ligne, valeurs):
+        for champ, valeur in (valeurs or {}).items():
+            if champ in ('quantite', 'prix_unitaire'):
+                setattr(ligne, champ, decimal_or_zero(valeur))
+            elif champ in self.CHAMPS_MODIFIABLES:
+                setattr(ligne, champ, valeur or '')
+            elif champ == 'est_titre':
+                ligne.est_titre = bool(valeur)
+        if not ligne.est_titre:
+            ligne.montant_calcule = ligne.quantite * ligne.prix_unitaire
+
+    def deplacer(self, ligne, parent, position):
+        """Rattache le sous-arbre de ligne à parent, devant la borne position (numérotation actuelle)"""
+        debut, fin = ligne.borne_gauche, ligne.borne_droite
+        if parent is not None and debut <= parent.borne_gauche <= fin:
+            raise ValueError("Impossible de déplacer une ligne sous elle-même")
+        ancien_parent = self.parent(ligne)
+        largeur = fin - debut + 1
+
+        self.propager(ligne, -ligne.sous_total_marche, -ligne.sous_total_realise)
+        self.cesser_d_etre_feuille(parent)
+        chemin = (parent.chemin if parent is not None else '') + f"{ligne.id}/"
+        if chemin != ligne.chemin:
+            niveau = parent.niveau + 1 if parent is not None else 0
+            LigneBordereau.objects.filter(lot_id=self.lot.pk, chemin__startswith=ligne.chemin).update(
+                chemin=Concat(Value(chemin), Substr('chemin', len(ligne.chemin) + 1), output_field=CharField()),
+                niveau=F('niveau') + (niveau - ligne.niveau),
+            )
+        LigneBordereau.objects.filter(pk=ligne.id).update(parent_id=parent.id if parent is not None else None)
+        if position < debut:
+            self.decaler([(debut, fin, position - debut), (position, debut - 1, largeur)])
+        elif position > fin + 1:
+            self.decaler([(debut, fin, position - 1 - fin), (fin + 1, position - 1, -largeur)])
+        self.rafraichir()
+
+        self.propager(ligne, ligne.sous_total_marche, ligne.sous_total_realise)
+        self.redevenir_feuille(ancien_parent)
+        self.modifiees.add(ligne.id)
+        self.touchees.update(filter(None, (ligne.id, ancien_parent and ancien_parent.id)))
+
+    # ------------------ Opérations ------------------
+    def op_update(self, op):
+        ligne = self.ligne(op.get('id'))
+        self.modifier(ligne, op.get('valeurs'))
+        if not ligne.has_children:
+            marche, realise = ligne.montants_propres(ligne.get_quantite_deja_realisee)
+            self.propager(ligne, marche - ligne.sous_total_marche, realise - ligne.sous_total_realise,
+                          inclure_ligne=True)
+        self.a_ecrire.add(ligne.id)
+        self.modifiees.add(ligne.id)
+        self.touchees.add(ligne.id)
+
+    def op_insert(self, op):
+        cle = op.get('id')
+        if cle is None or cle in self.temporaires:
+            raise ValueError(f"Identifiant d'insertion invalide: {cle}")
+        parent = self.ligne(op['parent_id']) if op.get('parent_id') is not None else None
+        position = self.position(parent, op.get('index'))
+
+        ligne = LigneBordereau(lot_id=self.lot.pk, parent_id=parent.id if parent is not None else None,
+                               numero='', designation='Nouvelle ligne', unite='', quantite=Decimal('0.00'),
+                               prix_unitaire=Decimal('0.00'), est_titre=False)
+        ligne.derniere_quantite_realisee = None
+        self.modifier(ligne, op.get('valeurs'))
+        self.cesser_d_etre_feuille(parent)
+        self.decaler([(position, None, 2)])
+        ligne.borne_gauche, ligne.borne_droite, ligne.ordre_affichage = position, position + 1, position
+        ligne.niveau = parent.niveau + 1 if parent is not None else 0
+        ligne.sous_total_marche, ligne.sous_total_realise = ligne.montants_propres(Decimal('0'))
+        LigneBordereau.objects.bulk_create([ligne])
+        ligne.chemin = (parent.chemin if parent is not None else '') + f"{ligne.id}/"
+        LigneBordereau.objects.filter(pk=ligne.id).update(chemin=ligne.chemin)
+        self.propager(ligne, ligne.sous_total_marche, ligne.sous_total_realise)
+
+        self.lignes[ligne.id] = ligne
+        self.temporaires[cle] = ligne.id
+        self.creees.add(ligne.id)
+        self.touchees.add(ligne.id)
+        self.rafraichir()
+
+    def op_delete(self, op):
+        ligne = self.ligne(op.get('id'))
+        parent = self.parent(ligne)
+        self.propager(ligne, -ligne.sous_total_marche, -ligne.sous_total_realise)
+        sous_arbre = LigneBordereau.objects.filter(lot_id=self.lot.pk, borne_gauche__gte=ligne.borne_gauche,
+                                                   borne_droite__lte=ligne.borne_droite)
+        ids = set(sous_arbre.values_list('id', flat=True))
+        sous_arbre.delete()
+        self.decaler([(ligne.borne_droite + 1, None, -(ligne.borne_droite - ligne.borne_gauche + 1))])
+
+        for ligne_id in ids:
+            self.lignes.pop(ligne_id, None)
+            for ensemble in (self.modifiees, self.a_ecrire, self.recalculees, self.touchees):
+                ensemble.discard(ligne_id)
+        self.temporaires = {cle: ligne_id for cle, ligne_id in self.temporaires.items() if ligne_id not in ids}
+        self.supprimees.update(ids - self.creees)
+        self.creees -= ids
+        self.rafraichir()
+        self.redevenir_feuille(parent)
+        if parent is not None:
+            self.touchees.add(parent.id)
+
+    def op_indent(self, op):
+        ligne = self.ligne(op.get('id'))
+        freres = self.enfants(self.parent(ligne))
+        index = freres.index(ligne)
+        if index == 0:
+            return
+        precedent = freres[index - 1]
+        self.deplacer(ligne, precedent, precedent.borne_droite)
+
+    def op_outdent(self, op):
+        ligne = self.ligne(op.get('id'))
+        parent = self.parent(ligne)
+        if parent is None or parent.borne_droite != ligne.borne_droite + 1:
+            return
+        self.deplacer(ligne, self.parent(parent), parent.borne_droite + 1)
+
+    def op_move(self, op):
+        ligne = self.ligne(op.get('id'))
+        parent = self.ligne(op['parent_id']) if op.get('parent_id') is not None else None
+        self.deplacer(ligne, parent, self.position(parent, op.get('index'), exclue=ligne))
+
+    # ------------------ Résultat ------------------
+    def appliquer(self, revision, operations):
+        """Applique les opérations sur la révision attendue et retourne uniquement les changements"""
+        if revision is None:
+            raise ValueError("La révision du bordereau est requise")
+        with transaction.atomic():
+            lot = LotProjet.objects.select_for_update().get(pk=self.lot.pk)
+            if int(revision) != lot.revision:
+                raise ConflitRevision(lot.revision)
+
+            for op in operations:
+                methode = getattr(self, f"op_{op.get('op')}", None)
+                if methode is None:
+                    raise ValueError(f"Opération inconnue: {op.get('op')}")
+                methode(op)
+
+            # Valeurs saisies, puis montant des titres dont le sous-total a varié (un chapitre vide reste un titre)
+            a_ecrire = [self.lignes[ligne_id] for ligne_id in self.a_ecrire]
+            if a_ecrire:
+                LigneBordereau.objects.bulk_update(a_ecrire, self.CHAMPS_ECRITS)
+            LigneBordereau.objects.filter(
+                pk__in=self.recalculees | set(self.lignes), borne_droite__gt=F('borne_gauche') + 1
+            ).update(est_titre=True, montant_calcule=F('sous_total_marche'))
+
+            LotProjet.objects.filter(pk=lot.pk).update(revision=F('revision') + 1)
+            lot.revision += 1
+            self.lot.revision = lot.revision
+
+            # Montants recalculés des lignes touchées et de leurs ancêtres
+            a_renvoyer = set()
+            for ligne_id in self.touchees:
+                a_renvoyer.update(int(ancetre) for ancetre in self.lignes[ligne_id].chemin.split('/')[:-1])
+            montants = dict(LigneBordereau.objects.filter(pk__in=a_renvoyer).values_list('id', 'sous_total_marche'))
+            montant_total = LigneBordereau.objects.filter(lot_id=lot.pk, parent__isnull=True).aggregate(
+                total=Sum('sous_total_marche'))['total'] or Decimal('0')
+
+        return {
+            'revision': lot.revision,
+            'lignes': {cle: ligne_id for cle, ligne_id in self.temporaires.items()},
+            'modifiees': sorted(self.modifiees - self.creees),
+            'supprimees': sorted(self.supprimees),
+            'montants': {ligne_id: float(montant) for ligne_id, montant in montants.items()},
+            'montant_total': float(montant_total),
+        }
+
+
+TAILLE_PLAGE = 500        # lignes intégrées à la page / renvoyées par défaut
+TAILLE_PLAGE_MAX = 5000   # plafond d'une plage demandée par le client
+
+
+def lire_plage(lot, debut, fin, profondeur_max=None):
+    """
+    Lignes [debut, fin) de l'arbre aplati d'un lot (ordre des bornes), au format de la grille,
+    avec le nombre total de lignes visibles. profondeur_max limite les niveaux renvoyés.
+    """
+    lignes = LigneBordereau.objects.filter(lot=lot)
+    if profondeur_max is not None:
+        lignes = lignes.filter(niveau__lte=profondeur_max)
+    total = lignes.count()
+    valeurs = lignes.order_by('borne_gauche', 'ordre_affichage', 'id').values(
+        'id', 'parent_id', 'numero', 'designation', 'unite', 'quantite', 'prix_unitaire',
+        'niveau', 'borne_gauche', 'borne_droite', 'sous_total_marche'
+    )[debut:fin]
+    rows = [{
+        'id': ligne['id'],
+        'numero': ligne['numero'],
+        'designation': ligne['designation'],
+        'unite': ligne['unite'],
+        'quantite': float(ligne['quantite']),
+        'prix_unitaire': float(ligne['prix_unitaire']),
+        'montant': float(ligne['sous_total_marche']),
+        'niveau': ligne['niveau'] + 1,
+        'est_titre': ligne['borne_droite'] > ligne['borne_gauche'] + 1,
+        'parent_id': ligne['parent_id'],
+        '_expanded': False,
+    } for ligne in valeurs]
+    return {
+        'revision': lot.revision,
+        'total': total,
+        'debut': debut,
+        'fin': debut + len(rows),
+        'lignes': rows,
+    }
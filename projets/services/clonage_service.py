@@ -0,0 +1,90 @@
+# services/clonage_service.py
+# Duplication d'un lot ou d'un projet avec son bordereau (insertions ensemblistes, remappage des ids en mémoire)
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F
+from projets.models import LigneBordereau, LotProjet, Projet
+
+
+class ClonageBordereau:
+    """
+    Copie les lignes de bordereau d'un lot dans un autre en un nombre fixe de requêtes par lot:
+    une lecture, un bulk_create sans parent, puis un bulk_update des parents et chemins
+    une fois les nouveaux ids connus (table ancien id -> nouvel id tenue en mémoire).
+    Ordre d'affichage, niveaux, bornes et sous-totaux marché ne dépendent pas des ids et sont recopiés;
+    le lot cloné n'ayant aucun attachement, son sous-total réalisé repart de zéro.
+    """
+    CHAMPS_COPIES = ['numero', 'designation', 'unite', 'quantite', 'prix_unitaire', 'montant_calcule',
+                     'niveau', 'est_titre', 'ordre_affichage', 'borne_gauche', 'borne_droite', 'sous_total_marche']
+    TAILLE_LOT = 1000
+
+    def __init__(self, source):
+        self.source = source
+        self.correspondances = {}   # id de la ligne source -> id de la copie
+
+    def copier_vers(self, cible):
+        """Copie les lignes du lot source dans le lot cible et retourne le nombre de lignes créées"""
+        sources = list(LigneBordereau.objects.filter(lot=self.source).order_by('borne_gauche', 'ordre_affichage', 'id')
+                       .only('id', 'parent_id', *self.CHAMPS_COPIES))
+        if not sources:
+            return 0
+
+        copies = [
+            LigneBordereau(lot=cible, sous_total_realise=Decimal('0.00'),
+                           **{champ: getattr(ligne, champ) for champ in self.CHAMPS_COPIES})
+            for ligne in sources
+        ]
+        with transaction.atomic():
+            LigneBordereau.objects.bulk_create(copies, batch_size=self.TAILLE_LOT)
+            self.correspondances = {ligne.id: copie.id for ligne, copie in zip(sources, copies)}
+
+            # Ordre préfixe: le chemin du parent est toujours calculé avant celui de ses enfants
+            chemins = {}
+            for ligne, copie in zip(sources, copies):
+                copie.parent_id = self.correspondances.get(ligne.parent_id)
+                copie.chemin = chemins.get(copie.parent_id, '') + f"{copie.id}/"
+                chemins[copie.id] = copie.chemin
+            LigneBordereau.objects.bulk_update(copies, ['parent', 'chemin'], batch_size=self.TAILLE_LOT)
+            LotProjet.objects.filter(pk=cible.pk).update(revision=F('revision') + 1)
+        return len(copies)
+
+
+def cloner_lot(lot, projet=None, nom=None):
+    """Duplique un lot (dans son projet ou dans un autre) avec toutes ses lignes de bordereau"""
+    with transaction.atomic():
+        copie = LotProjet.objects.create(
+            projet=projet or lot.projet,
+            nom=nom or (lot.nom if projet is not None else f"{lot.nom} (copie)"),
+            description=lot.description,
+        )
+        ClonageBordereau(lot).copier_vers(copie)
+    return copie
+
+
+def cloner_projet(projet, numero, nom=None, utilisateur=None):
+    """
+    Duplique un projet et ses lots avec leurs bordereaux. Le numéro de marché étant unique, il est fourni;
+    le nouveau projet repart en appel d'offres, sans avancement ni appel d'offre associé.
+    Les attachements, décomptes et documents ne sont pas copiés. La notification de création est adressée
+    à utilisateur (à défaut, au premier utilisateur du projet source).
+    """
+    if Projet.objects.filter(numero=numero).exists():
+        raise ValueError(f"Le numéro de marché '{numero}' existe déjà")
+
+    with transaction.atomic():
+        copie = Projet.objects.get(pk=projet.pk)
+        copie.pk = None
+        copie._state.adding = True
+        copie.numero = numero
+        copie.nom = nom or projet.nom
+        copie.appel_offre = None
+        copie.statut = Projet.Statut.APPEL_OFFRE
+        copie.avancement = Decimal('0.00')
+        copie.date_reception = None
+        copie._createur = utilisateur or projet.users.first()
+        copie.save()
+        copie.users.set(projet.users.all())
+
+        for lot in LotProjet.objects.filter(projet=projet).order_by('id'):
+            cloner_lot(lot, projet=copie)
+    return copie
@@ -0,0 +1,106 @@
+# services/comparaison_service.py
+# Comparaison de deux attachements (ou d'un attachement et du marché) par fusion de flux triés
+from decimal import Decimal
+from projets.models import LigneAttachement, LigneBordereau, LotProjet
+
+ZERO = Decimal('0')
+CENTIME = Decimal('0.01')
+
+
+class ComparaisonAttachements:
+    """
+    Compare les quantités de deux états d'un projet ligne à ligne, sur tous les lots:
+    un attachement de référence (ou le marché si reference est None) et un attachement comparé.
+    Les lignes de bordereau et les lignes des deux attachements sont lues en trois flux triés par
+    ligne_lot_id (iterator, par paquets) et fusionnées en un seul passage: temps linéaire, mémoire bornée
+    quelle que soit la taille du projet. Les totaux par lot et généraux sont cumulés au fil du passage.
+    """
+    TAILLE_PAQUET = 2000
+    COLONNES = ['lot', 'numero', 'designation', 'unite', 'prix_unitaire', 'quantite_reference', 'quantite_comparee',
+                'ecart_quantite', 'montant_reference', 'montant_compare', 'ecart_montant']
+
+    def __init__(self, projet, comparee, reference=None, ecarts_seulement=False):
+        self.projet = projet
+        self.comparee = comparee
+        self.reference = reference
+        self.ecarts_seulement = ecarts_seulement
+        self.totaux_lots = {}
+        self.total = self.nouveau_total()
+
+    @staticmethod
+    def nouveau_total():
+        return {'montant_reference': ZERO, 'montant_compare': ZERO, 'ecart_montant': ZERO, 'lignes': 0}
+
+    def flux_attachement(self, attachement):
+        """(ligne_lot_id, quantité, prix unitaire) des lignes d'un attachement, par ligne_lot_id croissant"""
+        return LigneAttachement.objects.filter(attachement=attachement).order_by('ligne_lot_id').values_list(
+            'ligne_lot_id', 'quantite_realisee', 'prix_unitaire'
+        ).iterator(chunk_size=self.TAILLE_PAQUET)
+
+    def flux_bordereau(self):
+        return LigneBordereau.objects.filter(lot__projet=self.projet).order_by('id').values_list(
+            'id', 'lot_id', 'numero', 'designation', 'unite', 'quantite', 'prix_unitaire'
+        ).iterator(chunk_size=self.TAILLE_PAQUET)
+
+    @staticmethod
+    def avancer(flux, cle_courante, courant):
+        """Avance un flux trié jusqu'à la clé demandée; retourne (élément courant du flux, valeur pour cette clé)"""
+        while courant is not None and courant[0] < cle_courante:
+            courant = next(flux, None)
+        if courant is not None and courant[0] == cle_courante:
+            return courant, courant
+        return courant, None
+
+    def lignes(self):
+        """Génère les lignes comparées (dicts), dans l'ordre des ids de bordereau; les totaux sont cumulés au passage"""
+        lots = dict(LotProjet.objects.filter(projet=self.projet).values_list('id', 'nom'))
+        comparee = self.flux_attachement(self.comparee)
+        reference = self.flux_attachement(self.reference) if self.reference else None
+        courant_comparee = next(comparee, None)
+        courant_reference = next(reference, None) if reference else None
+
+        for ligne_id, lot_id, numero, designation, unite, quantite, prix_unitaire in self.flux_bordereau():
+            courant_comparee, saisie_comparee = self.avancer(comparee, ligne_id, courant_comparee)
+            if reference is not None:
+                courant_reference, saisie_reference = self.avancer(reference, ligne_id, courant_reference)
+                quantite_reference = saisie_reference[1] if saisie_reference else ZERO
+                prix_reference = saisie_reference[2] if saisie_reference else prix_unitaire or ZERO
+            else:
+                quantite_reference, prix_reference = quantite or ZERO, prix_unitaire or ZERO
+            quantite_comparee = saisie_comparee[1] if saisie_comparee else ZERO
+            prix_compare = saisie_comparee[2] if saisie_comparee else prix_unitaire or ZERO
+
+            if not quantite_reference and not quantite_comparee:
+                continue
+            ecart_quantite = quantite_comparee - quantite_reference
+            montant_reference = (quantite_reference * prix_reference).quantize(CENTIME)
+            montant_compare = (quantite_comparee * prix_compare).quantize(CENTIME)
+            ligne = {
+                'ligne_id': ligne_id, 'lot_id': lot_id, 'lot': lots.get(lot_id, ''),
+                'numero': numero or '', 'designation': designation, 'unite': unite or '',
+                'prix_unitaire': prix_compare,
+                'quantite_reference': quantite_reference, 'quantite_comparee': quantite_comparee,
+                'ecart_quantite': ecart_quantite,
+                'montant_reference': montant_reference, 'montant_compare': montant_compare,
+                'ecart_montant': montant_compare - montant_reference,
+            }
+            total_lot = self.totaux_lots.setdefault(lot_id, {'lot': ligne['lot'], **self.nouveau_total()})
+            for total in (total_lot, self.total):
+                total['montant_reference'] += montant_reference
+                total['montant_compare'] += montant_compare
+                total['ecart_montant'] += ligne['ecart_montant']
+                total['lignes'] += 1
+            # Les totaux portent sur toutes les lignes, le filtre ne s'applique qu'aux lignes restituées
+            if ecart_quantite or not self.ecarts_seulement:
+                yield ligne
+
+    def lignes_csv(self):
+        """Lignes de l'export CSV (séparateur ';', décimales à la française), en-tête et total compris"""
+        def cellule(valeur):
+            return str(valeur).replace('.', ',') if isinstance(valeur, Decimal) else ' '.join(str(valeur).replace(';', ',').split())
+
+        yield ';'.join(self.COLONNES) + '\n'
+        for ligne in self.lignes():
+            yield ';'.join(cellule(ligne[colonne]) for colonne in self.COLONNES) + '\n'
+        yield ';'.join(['TOTAL', '', '', '', '', '', '', '', cellule(self.total['montant_reference']),
+                        cellule(self.total['montant_compare']), cellule(self.total['ecart_montant'])]) + '\n'
@@ -0,0 +1,48 @@
+# services/compteurs_service.py
+# Compteurs par statut et totaux d'en-tête des listes (décomptes, attachements, tâches) en une requête groupée
+from datetime import date
+from django.db.models import Count, Q
+from projets.models import Attachement, Decompte, Tache
+
+
+class CompteursProjet:
+    """
+    Compteurs d'un projet calculés par agrégats conditionnels (Count/Sum filtrés) sur les attachements
+    joints à leur décompte: une seule requête pour les statuts des attachements, ceux des décomptes
+    et les attachements sans décompte. Rien n'est mis en cache: la requête groupée est assez légère
+    pour être refaite à chaque affichage, et reste juste quel que soit le processus qui a écrit.
+    """
+
+    def __init__(self, projet_id):
+        self.projet_id = projet_id
+
+    def agregats(self):
+        agregats = {
+            'attachements': Count('id'),
+            'attachements_sans_decompte': Count('id', filter=Q(decompte__isnull=True)),
+            'decomptes': Count('decompte'),
+            'decomptes_en_retard': Count('decompte', filter=Q(decompte__statut__in=['EMIS', 'PARTIEL'],
+                                                               decompte__date_echeance__lt=date.today())),
+        }
+        for statut, _ in Attachement.STATUT_ATTACHEMENT:
+            agregats[f"attachements_{statut}"] = Count('id', filter=Q(statut=statut))
+        for statut, _ in Decompte.STATUT_DECOMPTE:
+            agregats[f"decomptes_{statut}"] = Count('decompte', filter=Q(decompte__statut=statut))
+        return agregats
+
+    def calculer(self):
+        """{compteur: valeur}"""
+        return Attachement.objects.filter(projet_id=self.projet_id).aggregate(**self.agregats())
+
+
+def compter_taches(taches):
+    """Compteurs d'une liste de tâches (total, terminées, en cours, en retard, par priorité) en une requête"""
+    agregats = {
+        'total': Count('id'),
+        'terminees': Count('id', filter=Q(terminee=True)),
+        'en_cours': Count('id', filter=Q(terminee=False)),
+        'en_retard': Count('id', filter=Q(terminee=False, date_fin__lt=date.today())),
+    }
+    for priorite, _ in Tache.PRIORITE:
+        agregats[priorite] = Count('id', filter=Q(priorite=priorite))
+    return taches.order_by().aggregate(**agregats)
@@ -0,0 +1,138 @@
+# services/controle_service.py
+# Fiche de contrôle d'un attachement: calcul en un passage sur tout le projet et mise en cache du résultat
+from itertools import groupby
+from django.core.cache import cache
+from django.db.models import Count, Max
+from projets.models import Attachement, CumulLigneAttachement, LigneBordereau, LotProjet
+from projets.services.montants_service import ArbreMontants
+
+COLONNES_TOTAUX = ('montant_marche', 'montant_partiel', 'montant_s', 'delta_montant')
+
+
+class FicheControle:
+    """
+    Calcule la fiche de contrôle (marché, S-1, partiel, S, écarts) d'un attachement pour tous les lots d'un projet
+    en trois requêtes: lots, lignes de bordereau du projet (ordre d'affichage), entrées S / S-1 du registre des cumuls.
+    Le résultat est mis en cache sous une clé formée des ids des attachements, de l'horodatage de la dernière
+    modification des attachements du projet et des révisions des bordereaux: toute saisie l'invalide.
+    """
+    DUREE_CACHE = 60 * 60
+
+    def __init__(self, projet, attachement, precedent=None):
+        self.projet = projet
+        self.attachement = attachement
+        self.precedent = precedent
+
+    def cle(self, lots):
+        etat = Attachement.objects.filter(projet=self.projet).aggregate(nombre=Count('id'), maj=Max('date_modification'))
+        revisions = '-'.join(f"{lot.id}.{lot.revision}" for lot in lots)
+        maj = etat['maj'].timestamp() if etat['maj'] else 0
+        return (f"fiche_controle:{self.projet.id}:{self.attachement.id}:{self.precedent.id if self.precedent else 0}:"
+                f"{etat['nombre']}:{maj}:{revisions}")
+
+    def charger(self, lots):
+        """Arbre de montants de chaque lot, quantités S et S-1 renseignées: {lot_id: ArbreMontants}"""
+        colonnes = [self.attachement.id] + ([self.precedent.id] if self.precedent else [])
+        lignes = LigneBordereau.objects.filter(lot__projet=self.projet).order_by(
+            'lot_id', 'borne_gauche', 'ordre_affichage', 'id'
+        ).values_list('lot_id', *ArbreMontants.CHAMPS)
+        arbres = {lot_id: ArbreMontants([ligne[1:] for ligne in groupe], colonnes)
+                  for lot_id, groupe in groupby(lignes.iterator(chunk_size=5000), key=lambda ligne: ligne[0])}
+
+        quantites = {
+            ligne_id: (float(quantite_s or 0), float(quantite_s1 or 0))
+            for ligne_id, quantite_s, quantite_s1 in CumulLigneAttachement.objects.filter(
+                attachement=self.attachement).values_list('ligne_lot_id', 'quantite_cumulee', 'quantite_precedente')
+        }
+        for arbre in arbres.values():
+            for ligne_id, i in arbre.index.items():
+                quantite_s, quantite_s1 = quantites.get(ligne_id, (0.0, 0.0))
+                arbre.realise[i, 0] = quantite_s
+                if self.precedent:
+                    arbre.realise[i, 1] = quantite_s1
+        return {lot.id: arbres[lot.id] for lot in lots if lot.id in arbres}
+
+    def calculer_lot(self, arbre):
+        """Lignes de contrôle et totaux d'un lot, toutes les colonnes calculées en tableaux"""
+        quantite_marche = arbre.quantite
+        montant_marche = arbre.montants_marche()
+        quantite_s = arbre.quantites_realisees(self.attachement.id)
+        quantite_s1 = arbre.quantites_realisees(self.precedent.id if self.precedent else None)
+        quantite_partiel = quantite_s - quantite_s1
+        montant_partiel = quantite_partiel * arbre.prix_unitaire
+        montant_s = quantite_s * arbre.prix_unitaire
+        delta_quantite = quantite_marche - quantite_s
+        delta_montant = montant_marche - montant_s
+        pourcentage_realise = ArbreMontants.pourcentages(quantite_s, quantite_marche)
+
+        colonnes = {
+            'quantite_marche': quantite_marche.tolist(),
+            'montant_marche': montant_marche.tolist(),
+            'quantite_s1': quantite_s1.tolist(),
+            'quantite_partiel': quantite_partiel.tolist(),
+            'montant_partiel': montant_partiel.tolist(),
+            'quantite_s': quantite_s.tolist(),
+            'montant_s': montant_s.tolist(),
+            'delta_quantite': delta_quantite.tolist(),
+            'delta_montant': delta_montant.tolist(),
+            'pourcentage_realise': pourcentage_realise.tolist(),
+        }
+
+        lignes_controle = []
+        lignes_retenues = []
+        for i, (_, _, numero, designation, unite, quantite, _, sous_total_realise) in enumerate(arbre.lignes):
+            if not sous_total_realise:
+                continue
+            if not numero or not unite or not quantite:
+                lignes_controle.append({
+                    'numero': numero or '',
+                    'designation': designation,
+                    'is_title': True,
+                    'can_be_hidden': False
+                })
+                continue
+
+            ligne_controle = {cle: valeurs[i] for cle, valeurs in colonnes.items()}
+            ligne_controle.update({
+                'numero': numero,
+                'designation': designation,
+                'unite': unite,
+                'is_title': False,
+                'can_be_hidden': ligne_controle['montant_s'] == 0
+            })
+            lignes_controle.append(ligne_controle)
+            lignes_retenues.append(i)
+
+        total_lot = {
+            'montant_marche': float(montant_marche[lignes_retenues].sum()),
+            'montant_partiel': float(montant_partiel[lignes_retenues].sum()),
+            'montant_s': float(montant_s[lignes_retenues].sum()),
+            'delta_montant': float(delta_montant[lignes_retenues].sum()),
+        }
+        total_lot['pourcentage_realise'] = float(ArbreMontants.pourcentages(total_lot['montant_s'], total_lot['montant_marche']))
+        return lignes_controle, total_lot
+
+    def calculer(self):
+        """Retourne (donnees_controle, total_general), depuis le cache si rien n'a changé"""
+        lots = list(LotProjet.objects.filter(projet=self.projet).order_by('id'))
+        cle = self.cle(lots)
+        resultat = cache.get(cle)
+        if resultat is not None:
+            return resultat
+
+        donnees_controle = []
+        total_general = dict.fromkeys(COLONNES_TOTAUX, 0)
+        arbres = self.charger(lots)
+        for lot in lots:
+            if lot.id not in arbres:
+                continue
+            lignes_controle, total_lot = self.calculer_lot(arbres[lot.id])
+            if lignes_controle:
+                donnees_controle.append({'lot': lot, 'lignes': lignes_controle, 'total_lot': total_lot})
+                for colonne in COLONNES_TOTAUX:
+                    total_general[colonne] += total_lot[colonne]
+        total_general['pourcentage_realise'] = float(ArbreMontants.pourcentages(total_general['montant_s'], total_general['montant_marche']))
+
+        resultat = (donnees_controle, total_general)
+        cache.set(cle, resultat, self.DUREE_CACHE)
+        return resultat
@@ -0,0 +1,168 @@
+# services/cumuls_service.py
+# Registre persistant des quantités et montants cumulés par ligne de bordereau et par attachement
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from projets.models import Attachement, CumulLigneAttachement, LigneAttachement
+from projets.services.situation_service import GrandLivreProjet
+
+ZERO = Decimal('0')
+CENTIME = Decimal('0.01')
+
+
+class RegistreCumuls:
+    """
+    Tient à jour CumulLigneAttachement pour un projet. Les attachements sont ordonnés par date d'établissement
+    puis id (séquence 1, 2, ...); la quantité saisie dans un attachement est la quantité S cumulée à date.
+    Pour l'attachement de rang k, une entrée par ligne saisie en k ou en k-1:
+    S-1 = quantité saisie en k-1, S = quantité saisie en k (zéro si absente), partiel = S - (S-1).
+    Les écritures touchent l'attachement modifié et son suivant (dont S-1 change), ou tout le projet si
+    l'ordre des attachements a changé, en un nombre fixe de requêtes; les montants HT enregistrés sur
+    Attachement sont recalculés en même temps. Une saisie isolée (LigneAttachement.save/delete) ne réécrit
+    que les entrées de sa ligne (actualiser_ligne).
+    """
+    TAILLE_LOT = 2000
+    CHAMPS_MONTANTS = ['montant_ht_cumule', 'montant_ht_precedent', 'montant_ht_situation', 'date_modification']
+
+    def __init__(self, projet_id):
+        self.projet_id = projet_id
+        self.sequences = {
+            attachement_id: rang
+            for rang, attachement_id in enumerate(
+                Attachement.objects.filter(projet_id=projet_id).order_by('date_etablissement', 'id')
+                .values_list('id', flat=True), start=1)
+        }
+        self.ordre = sorted(self.sequences, key=self.sequences.get)
+
+    def saisies(self, attachements_ids, lignes_ids=None):
+        """{attachement_id: {ligne_id: (quantité, prix unitaire)}} des attachements demandés (une requête)"""
+        saisies = {attachement_id: {} for attachement_id in attachements_ids}
+        lignes = LigneAttachement.objects.filter(attachement_id__in=list(attachements_ids))
+        if lignes_ids is not None:
+            lignes = lignes.filter(ligne_lot_id__in=list(lignes_ids))
+        for attachement_id, ligne_id, quantite, prix in lignes.values_list(
+                'attachement_id', 'ligne_lot_id', 'quantite_realisee', 'prix_unitaire'):
+            saisies[attachement_id][ligne_id] = (quantite or ZERO, prix or ZERO)
+        return saisies
+
+    def entrees(self, attachement_id, saisies):
+        """Entrées du registre d'un attachement, à partir de ses saisies et de celles du précédent"""
+        rang = self.sequences[attachement_id]
+        courantes = saisies.get(attachement_id, {})
+        precedentes = saisies.get(self.ordre[rang - 2], {}) if rang > 1 else {}
+        entrees = []
+        for ligne_id in courantes.keys() | precedentes.keys():
+            quantite_s, prix_s = courantes.get(ligne_id, (ZERO, ZERO))
+            quantite_s1, prix_s1 = precedentes.get(ligne_id, (ZERO, ZERO))
+            montant_s = (quantite_s * prix_s).quantize(CENTIME)
+            montant_s1 = (quantite_s1 * prix_s1).quantize(CENTIME)
+            entrees.append(CumulLigneAttachement(
+                ligne_lot_id=ligne_id, attachement_id=attachement_id, sequence=rang, saisie=ligne_id in courantes,
+                quantite_precedente=quantite_s1, quantite_partielle=quantite_s - quantite_s1, quantite_cumulee=quantite_s,
+                montant_precedent=montant_s1, montant_partiel=montant_s - montant_s1, montant_cumule=montant_s,
+            ))
+        return entrees
+
+    def ecrire(self, attachements_ids):
+        """Remplace les entrées des attachements donnés (lecture des saisies utiles, un delete, un bulk_create)"""
+        attachements_ids = [attachement_id for attachement_id in attachements_ids if attachement_id in self.sequences]
+        a_lire = set(attachements_ids)
+        for attachement_id in attachements_ids:
+            rang = self.sequences[attachement_id]
+            if rang > 1:
+                a_lire.add(self.ordre[rang - 2])
+        saisies = self.saisies(a_lire)
+        entrees = [entree for attachement_id in attachements_ids for entree in self.entrees(attachement_id, saisies)]
+        # Les montants de situation des décomptes de ces attachements changent: écart reporté au grand livre
+        with GrandLivreProjet(self.projet_id).suivre({'attachement_id__in': attachements_ids}):
+            CumulLigneAttachement.objects.filter(attachement_id__in=attachements_ids).delete()
+            CumulLigneAttachement.objects.bulk_create(entrees, batch_size=self.TAILLE_LOT)
+            self.enregistrer_montants(attachements_ids, entrees)
+        return len(entrees)
+
+    def enregistrer_montants(self, attachements_ids, entrees):
+        """
+        Montants HT S, S-1 et de la situation de chaque attachement réécrit, sommés sur ses entrées
+        (un seul bulk_update), avec l'horodatage servant de clé aux résultats mis en cache
+        """
+        maintenant = timezone.now()
+        attachements = {
+            attachement_id: Attachement(id=attachement_id, montant_ht_cumule=ZERO, montant_ht_precedent=ZERO,
+                                        montant_ht_situation=ZERO, date_modification=maintenant)
+            for attachement_id in attachements_ids
+        }
+        for entree in entrees:
+            attachement = attachements[entree.attachement_id]
+            attachement.montant_ht_cumule += entree.montant_cumule
+            attachement.montant_ht_precedent += entree.montant_precedent
+            attachement.montant_ht_situation += entree.montant_partiel
+        Attachement.objects.bulk_update(list(attachements.values()), self.CHAMPS_MONTANTS)
+
+    def recalculer_montants(self, attachements_ids):
+        """Montants HT des attachements donnés, sommés dans le registre (une requête groupée, un bulk_update)"""
+        maintenant = timezone.now()
+        attachements = {
+            attachement_id: Attachement(id=attachement_id, montant_ht_cumule=ZERO, montant_ht_precedent=ZERO,
+                                        montant_ht_situation=ZERO, date_modification=maintenant)
+            for attachement_id in attachements_ids
+        }
+        for total in CumulLigneAttachement.objects.filter(attachement_id__in=list(attachements_ids)).values(
+                'attachement_id').annotate(cumule=Sum('montant_cumule'), precedent=Sum('montant_precedent'),
+                                           partiel=Sum('montant_partiel')).order_by():
+            attachement = attachements[total['attachement_id']]
+            attachement.montant_ht_cumule = total['cumule'] or ZERO
+            attachement.montant_ht_precedent = total['precedent'] or ZERO
+            attachement.montant_ht_situation = total['partiel'] or ZERO
+        Attachement.objects.bulk_update(list(attachements.values()), self.CHAMPS_MONTANTS)
+
+    def ordre_inchange(self, attachements_ids=None):
+        """
+        Les séquences enregistrées correspondent-elles encore à l'ordre des attachements ? Limité aux
+        attachements donnés (lecture indexée): tout attachement inséré avant eux décale leur rang
+        """
+        enregistrees = CumulLigneAttachement.objects.filter(attachement__projet_id=self.projet_id)
+        if attachements_ids is not None:
+            enregistrees = enregistrees.filter(attachement_id__in=list(attachements_ids))
+        enregistrees = dict(enregistrees.values_list('attachement_id', 'sequence').distinct())
+        return all(self.sequences.get(attachement_id) == rang for attachement_id, rang in enregistrees.items())
+
+    def reconstruire(self):
+        """Reconstruit tout le registre du projet"""
+        with transaction.atomic():
+            CumulLigneAttachement.objects.filter(attachement__projet_id=self.projet_id).delete()
+            return self.ecrire(self.ordre)
+
+    def actualiser(self, *attachements_ids):
+        """
+        Après modification des lignes d'attachements: chacun et son suivant, ou tout le projet si l'ordre
+        des attachements a changé
+        """
+        inconnus = any(attachement_id not in self.sequences for attachement_id in attachements_ids)
+        if inconnus or not self.ordre_inchange():
+            return self.reconstruire()
+        a_ecrire = set()
+        for attachement_id in attachements_ids:
+            rang = self.sequences[attachement_id]
+            a_ecrire.update(self.ordre[rang - 1:rang + 1])
+        return self.ecrire(sorted(a_ecrire, key=self.sequences.get))
+
+    def actualiser_ligne(self, attachement_id, ligne_id):
+        """
+        Après modification d'une seule saisie: entrées de cette ligne pour l'attachement et son suivant,
+        montants HT de ces deux attachements et grand livre, sans relire les autres lignes
+        """
+        rang = self.sequences.get(attachement_id)
+        if rang is None:
+            return self.reconstruire()
+        a_ecrire = self.ordre[rang - 1:rang + 1]
+        voisins = self.ordre[max(rang - 2, 0):rang + 1]
+        if not self.ordre_inchange(voisins):
+            return self.reconstruire()
+        saisies = self.saisies(voisins, lignes_ids=[ligne_id])
+        entrees = [entree for attachement_id in a_ecrire for entree in self.entrees(attachement_id, saisies)]
+        with GrandLivreProjet(self.projet_id).suivre({'attachement_id__in': a_ecrire}):
+            CumulLigneAttachement.objects.filter(attachement_id__in=a_ecrire, ligne_lot_id=ligne_id).delete()
+            CumulLigneAttachement.objects.bulk_create(entrees)
+            self.recalculer_montants(a_ecrire)
+        return len(entrees)
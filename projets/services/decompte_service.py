@@ -0,0 +1,166 @@
+# services/decompte_service.py
+# Montants de situation des décomptes (HT, retenues, TVA, TTC, net à payer) calculés en un passage,
+# génération des décomptes manquants du portefeuille
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+from django.db import connection, connections, transaction
+from projets.models import Attachement, Decompte, Projet
+
+ZERO = Decimal('0')
+CENTIME = Decimal('0.01')
+CENT = Decimal('100')
+TAUX_TVA = Decimal('20.00')
+TAUX_RETENUE_GARANTIE = Decimal('10.00')
+TAILLE_LOT = 500
+CHAMPS_TOTAUX = ('ht', 'retenue_garantie', 'reste_a_payer_ht', 'tva', 'ttc', 'ras', 'autres_retenues', 'net_a_payer')
+
+
+def _decimal(valeur):
+    """Taux ou montant en Decimal: une instance non rechargée garde les défauts float du modèle (taux_tva=20.0)"""
+    return ZERO if valeur is None else Decimal(str(valeur))
+
+
+class DecompteCalculator:
+    """
+    Calcule les montants de situation d'un ensemble de décomptes en Decimal, à partir du montant HT de situation
+    enregistré sur chaque attachement (registre des cumuls) augmenté de la révision des prix de la période
+    (montant_revision_periode): une seule requête (select_related) quel que soit le nombre de décomptes.
+    Les montants sont posés sur chaque instance, que les propriétés montant_situation_* du modèle lisent
+    sans nouvelle requête; les totaux de la liste sont cumulés au passage.
+    """
+
+    def __init__(self, decomptes):
+        self.decomptes = decomptes
+        self.totaux = dict.fromkeys(CHAMPS_TOTAUX, ZERO)
+
+    @staticmethod
+    def montants(decompte, montant_ht):
+        """Montants de situation d'un décompte pour le montant HT de situation de son attachement, révision incluse"""
+        ht = Decimal(montant_ht or 0) + _decimal(decompte.montant_revision_periode)
+        retenue_garantie = (ht * _decimal(decompte.taux_retenue_garantie) / CENT).quantize(CENTIME)
+        reste_a_payer_ht = ht - retenue_garantie
+        tva = (reste_a_payer_ht * _decimal(decompte.taux_tva) / CENT).quantize(CENTIME)
+        ttc = reste_a_payer_ht + tva
+        ras = (ht * _decimal(decompte.taux_ras) / CENT).quantize(CENTIME)
+        autres_retenues = _decimal(decompte.autres_retenues)
+        return {
+            'ht': ht,
+            'retenue_garantie': retenue_garantie,
+            'reste_a_payer_ht': reste_a_payer_ht,
+            'tva': tva,
+            'ttc': ttc,
+            'ras': ras,
+            'autres_retenues': autres_retenues,
+            'net_a_payer': ttc - ras - autres_retenues,
+        }
+
+    @staticmethod
+    def montants_decompte(decompte, montant_ht_cumule):
+        """Montants enregistrés d'un décompte pour le montant HT cumulé de son attachement (Decompte.save)"""
+        decompte.montant_ht = Decimal(montant_ht_cumule or 0) + _decimal(decompte.montant_revision_prix)
+        decompte.montant_tva = (decompte.montant_ht * _decimal(decompte.taux_tva)) / CENT
+        decompte.montant_ttc = decompte.montant_ht + decompte.montant_tva
+        decompte.montant_retenue_garantie = (decompte.montant_ht * _decimal(decompte.taux_retenue_garantie)) / CENT
+        decompte.montant_ras = (decompte.montant_ht * _decimal(decompte.taux_ras)) / CENT
+        total_retenues = decompte.montant_retenue_garantie + decompte.montant_ras + _decimal(decompte.autres_retenues)
+        decompte.montant_net_a_payer = max(ZERO, decompte.montant_ttc - total_retenues)
+        return decompte
+
+    def calculer(self):
+        """Évalue les décomptes (une requête), pose leurs montants de situation et retourne la liste"""
+        decomptes = list(self.decomptes.select_related('attachement'))
+        for decompte in decomptes:
+            decompte.situation = self.montants(decompte, decompte.attachement.montant_ht_situation)
+            for champ in CHAMPS_TOTAUX:
+                self.totaux[champ] += decompte.situation[champ]
+        return decomptes
+
+
+def dernier_rang(projet_id):
+    """Plus grand rang DEC-NNN des décomptes du projet (0 si aucun): un numéro libéré n'est pas réattribué"""
+    numeros = Decompte.objects.filter(
+        attachement__projet_id=projet_id, numero__regex=r'^DEC-[0-9]+$'
+    ).values_list('numero', flat=True)
+    return max((int(numero[4:]) for numero in numeros), default=0)
+
+
+def generer_decomptes_projet(projet_id, date_emission=None, attachements_ids=None):
+    """
+    Crée en une transaction les décomptes de tous les attachements validés sans décompte d'un projet
+    (ou de ceux parmi attachements_ids), numérotés à la suite du plus grand numéro DEC-NNN existant.
+    Les montants sont calculés comme Decompte.save (montants_decompte), à partir du montant HT cumulé
+    enregistré sur l'attachement, et les décomptes sont créés par un bulk_create; leurs montants sont ajoutés
+    au grand livre du projet et leurs résumés enregistrés en bloc (RecapitulatifDecomptes, comme Decompte.save),
+    dans la même transaction.
+    Retourne le nombre de décomptes créés.
+    """
+    from projets.services.recapitulatif_service import RecapitulatifDecomptes
+    from projets.services.situation_service import GrandLivreProjet
+
+    date_emission = date_emission or date.today()
+    attachements = Attachement.objects.filter(projet_id=projet_id, statut='VALIDE', decompte__isnull=True)
+    if attachements_ids is not None:
+        attachements = attachements.filter(id__in=attachements_ids)
+
+    with transaction.atomic():
+        # Verrou du projet: deux générations simultanées ne peuvent lire le même dernier numéro
+        Projet.objects.select_for_update().filter(pk=projet_id).first()
+        attachements = list(attachements.select_for_update(of=('self',)).order_by('date_etablissement', 'id').values(
+            'id', 'date_fin_periode', 'montant_ht_cumule'))
+        if not attachements:
+            return 0
+        rang = dernier_rang(projet_id)
+        decomptes = []
+        for attachement in attachements:
+            rang += 1
+            decompte = Decompte(
+                attachement_id=attachement['id'], numero=f"DEC-{rang:03d}", type_decompte='PROVISOIRE',
+                statut='BROUILLON', date_emission=date_emission,
+                date_echeance=max(date_emission, attachement['date_fin_periode'])
+                if attachement['date_fin_periode'] else date_emission + timedelta(days=30),
+                taux_tva=TAUX_TVA, taux_retenue_garantie=TAUX_RETENUE_GARANTIE, taux_ras=ZERO,
+                autres_retenues=ZERO, montant_revision_prix=ZERO,
+            )
+            DecompteCalculator.montants_decompte(decompte, attachement['montant_ht_cumule'])
+            decomptes.append(decompte)
+        filtre = {'attachement_id__in': [decompte.attachement_id for decompte in decomptes]}
+        with GrandLivreProjet(projet_id).suivre(filtre):
+            Decompte.objects.bulk_create(decomptes, batch_size=TAILLE_LOT)
+        RecapitulatifDecomptes(Decompte.objects.filter(**filtre)).enregistrer()
+    return len(decomptes)
+
+
+def _initialiser_processus():
+    """Processus de la réserve: Django chargé, aucune connexion héritée du parent"""
+    import django
+    django.setup()
+    connections.close_all()
+
+
+def _generer_decomptes_projet(arguments):
+    try:
+        return arguments[0], generer_decomptes_projet(*arguments)
+    finally:
+        connections.close_all()
+
+
+def generer_decomptes_portefeuille(projets_ids=None, date_emission=None, processus=1):
+    """
+    Décomptes de tous les attachements validés sans décompte du portefeuille (ou des projets donnés):
+    une transaction par projet, projets traités en parallèle par une réserve de processus si processus > 1
+    (séquentiellement sous SQLite, qui n'accepte qu'un écrivain à la fois). Retourne {projet_id: nombre créé}.
+    """
+    attachements = Attachement.objects.filter(statut='VALIDE', decompte__isnull=True)
+    if projets_ids is not None:
+        attachements = attachements.filter(projet_id__in=projets_ids)
+    taches = [(projet_id, date_emission)
+              for projet_id in attachements.order_by('projet_id').values_list('projet_id', flat=True).distinct()]
+
+    if processus <= 1 or len(taches) <= 1 or connection.vendor == 'sqlite':
+        return {projet_id: generer_decomptes_projet(projet_id, date_emission) for projet_id, _ in taches}
+
+    # Les connexions ouvertes ne doivent pas être partagées avec les processus enfants
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processus, initializer=_initialiser_processus) as reserve:
+        return dict(reserve.map(_generer_decomptes_projet, taches))
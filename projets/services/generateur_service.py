@@ -0,0 +1,161 @@
+# services/generateur_service.py
+# Génération de projets synthétiques (lots, bordereaux profonds, attachements) pour les mesures de performance
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from django.db import transaction
+from projets.models import (Attachement, LigneAttachement, LigneBordereau, LotProjet, Projet,
+                            calculer_hierarchie, calculer_sous_totaux)
+from projets.services.cumuls_service import RegistreCumuls
+
+UNITES = ('m3', 'm2', 'ml', 'U', 'kg', 'T', 'Ens')
+OUVRAGES = ('Déblais en terrain meuble', 'Remblais compactés', 'Béton de propreté', 'Béton armé B25',
+            'Acier HA FeE500', 'Coffrage ordinaire', 'Conduite PVC DN 315', 'Regard de visite',
+            'Couche de base GNB', 'Enrobé 0/14', 'Bordure T3', 'Enduit au mortier', 'Peinture vinylique')
+TITRES = ('TERRASSEMENTS', 'GROS ŒUVRE', 'ASSAINISSEMENT', 'CHAUSSÉE', 'RÉSEAUX DIVERS', 'SECOND ŒUVRE',
+          'OUVRAGES ANNEXES', 'SIGNALISATION')
+
+
+class GenerateurProjet:
+    """
+    Crée un projet réaliste: N lots, arbres de profondeur fixe (titres aux niveaux intermédiaires,
+    articles aux feuilles, numérotation 1, 1.1, 1.1.2...) et une série d'attachements cumulatifs.
+    Toutes les écritures sont ensemblistes (bulk_create / bulk_update), hiérarchie, cumuls et
+    sous-totaux étant calculés en mémoire.
+    """
+    TAILLE_LOT = 2000
+
+    def __init__(self, lots=3, lignes=10000, profondeur=5, attachements=12, graine=None):
+        self.nb_lots = lots
+        self.nb_lignes = lignes
+        self.profondeur = max(profondeur, 1)
+        self.nb_attachements = attachements
+        self.rng = random.Random(graine)
+
+    def branches(self):
+        """Plus petit facteur de branchement dont l'arbre complet atteint nb_lignes à la profondeur demandée"""
+        branches = 2
+        while sum(branches ** niveau for niveau in range(1, self.profondeur + 1)) < self.nb_lignes:
+            branches += 1
+        return branches
+
+    def structure(self):
+        """Arbre en ordre préfixe, parcours en profondeur itératif: [(numero, index du parent, est_titre)]"""
+        branches = self.branches()
+        noeuds = []
+        # Cadres [index du parent, numéro du parent, niveau des enfants, rang du prochain enfant, nombre d'enfants]
+        pile = [[None, '', 0, 1, branches]]
+        while pile and len(noeuds) < self.nb_lignes:
+            cadre = pile[-1]
+            parent, numero_parent, niveau, rang, total = cadre
+            if rang > total:
+                pile.pop()
+                continue
+            cadre[3] += 1
+            numero = f"{numero_parent}.{rang}" if numero_parent else str(rang)
+            est_titre = niveau < self.profondeur - 1
+            noeuds.append((numero, parent, est_titre))
+            if est_titre:
+                pile.append([len(noeuds) - 1, numero, niveau + 1, 1, max(1, branches + self.rng.randint(-1, 1))])
+        return noeuds
+
+    def generer_lot(self, projet, rang):
+        """Crée un lot et ses lignes: un bulk_create en ordre préfixe, puis un bulk_update de la hiérarchie"""
+        lot = LotProjet.objects.create(projet=projet, nom=f"Lot {rang:02d} - {self.rng.choice(TITRES)}")
+        noeuds = self.structure()
+        lignes = []
+        for index, (numero, _, est_titre) in enumerate(noeuds):
+            if est_titre:
+                lignes.append(LigneBordereau(
+                    lot=lot, numero=numero, designation=self.rng.choice(TITRES), unite='',
+                    quantite=Decimal('0.00'), prix_unitaire=Decimal('0.00'), est_titre=True, ordre_affichage=index,
+                ))
+            else:
+                quantite = Decimal(self.rng.randint(1, 50000)) / 10
+                prix_unitaire = Decimal(self.rng.randint(500, 500000)) / 100
+                lignes.append(LigneBordereau(
+                    lot=lot, numero=numero, designation=f"{self.rng.choice(OUVRAGES)} ({numero})",
+                    unite=self.rng.choice(UNITES), quantite=quantite, prix_unitaire=prix_unitaire,
+                    montant_calcule=quantite * prix_unitaire, ordre_affichage=index,
+                ))
+        LigneBordereau.objects.bulk_create(lignes, batch_size=self.TAILLE_LOT)
+
+        for ligne, (_, parent, _) in zip(lignes, noeuds):
+            ligne.parent_id = lignes[parent].id if parent is not None else None
+        calculer_hierarchie(lignes)
+        calculer_sous_totaux(lignes, {})
+        for ligne in lignes:
+            if ligne.est_titre:
+                ligne.montant_calcule = ligne.sous_total_marche
+        LigneBordereau.objects.bulk_update(
+            lignes, ['parent', 'montant_calcule', *LigneBordereau.CHAMPS_HIERARCHIE, *LigneBordereau.CHAMPS_SOUS_TOTAUX],
+            batch_size=self.TAILLE_LOT,
+        )
+        return lot, lignes
+
+    def generer_attachements(self, projet, feuilles):
+        """
+        Attachements mensuels: chaque article avance d'une fraction aléatoire de sa quantité marché.
+        Les quantités réalisées sont cumulatives (l'attachement n porte le cumul à date), quantite_cumulee
+        reproduit le calcul de LigneAttachement.save.
+        """
+        debut = date.today().replace(day=1) - timedelta(days=31 * self.nb_attachements)
+        attachements = Attachement.objects.bulk_create([
+            Attachement(
+                projet=projet, numero=f"{rang:02d}", statut='VALIDE',
+                date_etablissement=debut + timedelta(days=31 * rang),
+                date_debut_periode=debut + timedelta(days=31 * (rang - 1)),
+                date_fin_periode=debut + timedelta(days=31 * rang - 1),
+            )
+            for rang in range(1, self.nb_attachements + 1)
+        ])
+
+        avancement = {ligne.id: Decimal('0') for ligne in feuilles}
+        cumuls = {ligne.id: Decimal('0') for ligne in feuilles}
+        lignes_attachement = []
+        for attachement in attachements:
+            for ligne in feuilles:
+                # Environ un article sur trois avance à chaque période; un article commencé est ressaisi
+                # dans chaque attachement suivant avec son cumul à date, comme le fait la grille
+                if self.rng.random() <= 0.35 and avancement[ligne.id] < ligne.quantite:
+                    pas = (ligne.quantite * Decimal(self.rng.randint(5, 30)) / 100).quantize(Decimal('0.001'))
+                    avancement[ligne.id] = min(ligne.quantite, avancement[ligne.id] + pas)
+                if not avancement[ligne.id]:
+                    continue
+                cumuls[ligne.id] += avancement[ligne.id]
+                lignes_attachement.append(LigneAttachement(
+                    attachement=attachement, ligne_lot_id=ligne.id, numero=ligne.numero,
+                    designation=ligne.designation, unite=ligne.unite, quantite_initiale=ligne.quantite,
+                    prix_unitaire=ligne.prix_unitaire, quantite_realisee=avancement[ligne.id],
+                    quantite_cumulee=cumuls[ligne.id],
+                ))
+        LigneAttachement.objects.bulk_create(lignes_attachement, batch_size=self.TAILLE_LOT)
+        return attachements
+
+    def generer(self, numero=None, utilisateur=None):
+        """
+        Crée le projet complet et le retourne. utilisateur, s'il est fourni, est rattaché au projet et reçoit
+        la notification de création; sans lui (base de mesure vide), aucune notification n'est émise.
+        """
+        numero = numero or f"SYN-{self.rng.randrange(16 ** 8):08X}"
+        with transaction.atomic():
+            projet = Projet(
+                nom=f"Synthétique {numero}"[:50], numero=numero, objet="Projet synthétique (mesures de performance)",
+                maitre_ouvrage="Banc d'essai", localisation="—", statut=Projet.Statut.EN_COURS,
+            )
+            projet._createur = utilisateur
+            projet.save()
+            if utilisateur is not None:
+                projet.users.add(utilisateur)
+            lots = []
+            feuilles = []
+            for rang in range(1, self.nb_lots + 1):
+                lot, lignes = self.generer_lot(projet, rang)
+                lots.append(lot)
+                feuilles.extend(ligne for ligne in lignes if not ligne.est_titre)
+            if self.nb_attachements:
+                self.generer_attachements(projet, feuilles)
+                RegistreCumuls(projet.id).reconstruire()
+                for lot in lots:
+                    LigneBordereau.recalculer_sous_totaux(lot.id)
+        return projet
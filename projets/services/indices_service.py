@@ -0,0 +1,78 @@
+# services/indices_service.py
+# Séries mensuelles des indices de révision en mémoire (tableaux triés, recherche par bisection)
+from bisect import bisect_right
+from threading import Lock
+import numpy as np
+from django.core.cache import cache
+from projets.models import ValeurIndice
+
+
+def rang_mois(jour):
+    """Rang absolu du mois d'une date (année * 12 + mois - 1), croissant avec le temps"""
+    return jour.year * 12 + jour.month - 1
+
+
+class CacheIndices:
+    """
+    Valeurs des indices de révision chargées en une requête et rangées par code en deux tableaux
+    parallèles triés (rangs des mois, valeurs). valeur(code, mois) retourne la dernière valeur publiée
+    au plus tard ce mois-là (bisect_right), sans requête: les calculs de révision ne lisent jamais
+    les indices un par un. L'instance partagée du processus (partage()) est rechargée lorsque
+    IndicesImporter (ou tout écrivain en bloc) appelle invalider().
+    """
+    CLE_VERSION = 'indices_revision:version'
+    _partagee = None
+    _verrou = Lock()
+
+    def __init__(self, codes=None):
+        self.version = cache.get(self.CLE_VERSION, 0)
+        self.series = {}
+        self._tableaux = {}
+        valeurs = ValeurIndice.objects.order_by('indice__code', 'mois')
+        if codes is not None:
+            valeurs = valeurs.filter(indice__code__in=list(codes))
+        for code, mois, valeur in valeurs.values_list('indice__code', 'mois', 'valeur').iterator(chunk_size=5000):
+            rangs, serie = self.series.setdefault(code, ([], []))
+            rangs.append(rang_mois(mois))
+            serie.append(valeur)
+
+    @classmethod
+    def invalider(cls):
+        """Signale une écriture des valeurs: les instances partagées des processus seront rechargées"""
+        try:
+            cache.incr(cls.CLE_VERSION)
+        except ValueError:
+            cache.set(cls.CLE_VERSION, 1, None)
+
+    @classmethod
+    def partage(cls):
+        """Instance du processus, rechargée si les valeurs ont été réécrites depuis son chargement"""
+        with cls._verrou:
+            if cls._partagee is None or cls._partagee.version != cache.get(cls.CLE_VERSION, 0):
+                cls._partagee = cls()
+            return cls._partagee
+
+    def codes(self):
+        return sorted(self.series)
+
+    def valeur(self, code, mois):
+        """Dernière valeur publiée de l'indice au plus tard le mois de la date donnée (None si aucune)"""
+        rangs, serie = self.series.get(code, ((), ()))
+        position = bisect_right(rangs, rang_mois(mois))
+        return serie[position - 1] if position else None
+
+    def valeurs(self, code, mois):
+        """valeur() pour une suite de dates, dans le même ordre"""
+        return [self.valeur(code, jour) for jour in mois]
+
+    def colonne(self, code, rangs):
+        """
+        valeur() vectorisée: pour un tableau de rangs de mois, valeurs de l'indice en float64
+        (np.searchsorted côté droit, NaN là où rien n'était encore publié)
+        """
+        if code not in self._tableaux:
+            mois, serie = self.series.get(code, ((), ()))
+            self._tableaux[code] = (np.asarray(mois, dtype=np.int64), np.asarray(serie, dtype=np.float64))
+        mois, serie = self._tableaux[code]
+        positions = np.searchsorted(mois, rangs, side='right')
+        return np.where(positions > 0, serie[np.maximum(positions - 1, 0)] if len(serie) else np.nan, np.nan)
@@ -0,0 +1,108 @@
+# services/montants_service.py
+# Calcul vectorisé (NumPy) des montants d'un arbre de bordereau
+import numpy as np
+from projets.models import LigneAttachement, LigneBordereau
+
+
+class ArbreMontants:
+    """
+    Arbre d'un lot sous forme de tableaux parallèles, dans l'ordre d'affichage (ordre préfixe):
+    index du parent (-1 pour une racine), quantité, prix unitaire et quantités réalisées par attachement.
+    Les montants des feuilles sont cumulés sur leurs ancêtres niveau par niveau avec np.add.at,
+    sans récursion Python.
+    """
+    CHAMPS = ('id', 'parent_id', 'numero', 'designation', 'unite', 'quantite', 'prix_unitaire', 'sous_total_realise')
+
+    def __init__(self, lignes, attachements_ids=()):
+        """lignes: tuples dans l'ordre de CHAMPS, les parents avant leurs enfants"""
+        self.lignes = list(lignes)
+        n = len(self.lignes)
+        self.ids = np.fromiter((ligne[0] for ligne in self.lignes), dtype=np.int64, count=n)
+        self.index = {ligne_id: i for i, ligne_id in enumerate(self.ids.tolist())}
+        self.parent = np.fromiter((self.index.get(ligne[1], -1) for ligne in self.lignes), dtype=np.int64, count=n)
+        self.quantite = np.fromiter((float(ligne[5] or 0) for ligne in self.lignes), dtype=np.float64, count=n)
+        self.prix_unitaire = np.fromiter((float(ligne[6] or 0) for ligne in self.lignes), dtype=np.float64, count=n)
+        self.attachements = {attachement_id: j for j, attachement_id in enumerate(attachements_ids)}
+        self.realise = np.zeros((n, len(self.attachements)), dtype=np.float64)
+
+        self.profondeur = self._calculer_profondeurs()
+        self.est_feuille = np.bincount(self.parent[self.parent >= 0], minlength=n) == 0
+        ordre = np.argsort(self.profondeur, kind='stable')
+        bornes = np.searchsorted(self.profondeur[ordre], np.arange(self.profondeur.max(initial=0) + 2))
+        self.par_niveau = [ordre[bornes[niveau]:bornes[niveau + 1]] for niveau in range(len(bornes) - 1)]
+        self._montants_marche = None
+
+    @classmethod
+    def charger(cls, lot, attachements_ids=()):
+        """Charge un lot (une requête) et, si demandé, les quantités de ses attachements (une requête)"""
+        lignes = LigneBordereau.objects.filter(lot=lot).order_by(
+            'borne_gauche', 'ordre_affichage', 'id'
+        ).values_list(*cls.CHAMPS)
+        arbre = cls(lignes, attachements_ids)
+        if arbre.attachements and arbre.lignes:
+            quantites = LigneAttachement.objects.filter(
+                ligne_lot__lot=lot, attachement_id__in=list(arbre.attachements)
+            ).values_list('ligne_lot_id', 'attachement_id', 'quantite_realisee')
+            for ligne_id, attachement_id, quantite in quantites:
+                i = arbre.index.get(ligne_id)
+                if i is not None:
+                    arbre.realise[i, arbre.attachements[attachement_id]] = float(quantite or 0)
+        return arbre
+
+    def __len__(self):
+        return len(self.lignes)
+
+    def _calculer_profondeurs(self):
+        """Profondeur de chaque ligne par sauts de pointeurs vectorisés (une itération par niveau)"""
+        n = len(self.parent)
+        profondeur = np.zeros(n, dtype=np.int64)
+        courant = self.parent.copy()
+        actifs = courant >= 0
+        for _ in range(n):
+            if not actifs.any():
+                break
+            profondeur[actifs] += 1
+            courant[actifs] = self.parent[courant[actifs]]
+            actifs = courant >= 0
+        if actifs.any():
+            # Cycle de parents: les lignes concernées sont rattachées à la racine
+            self.parent[actifs] = -1
+            profondeur[actifs] = 0
+        return profondeur
+
+    # ------------------ Cumuls ------------------
+    def cumuler(self, valeurs):
+        """Cumule sur chaque ligne les valeurs de ses feuilles (tableau (n,) ou (n, k))"""
+        masque = self.est_feuille if valeurs.ndim == 1 else self.est_feuille[:, None]
+        totaux = np.where(masque, valeurs, 0.0)
+        for lignes in reversed(self.par_niveau[1:]):
+            np.add.at(totaux, self.parent[lignes], totaux[lignes])
+        return totaux
+
+    def montants_propres(self):
+        """Quantité x prix unitaire de chaque ligne, sans cumul"""
+        return self.quantite * self.prix_unitaire
+
+    def montants_marche(self):
+        """Montant marché de chaque ligne: propre pour une feuille, somme des feuilles pour un titre"""
+        if self._montants_marche is None:
+            self._montants_marche = self.cumuler(self.montants_propres())
+        return self._montants_marche
+
+    def quantites_realisees(self, attachement_id):
+        """Quantités réalisées d'un attachement (zéro si absent ou non chargé)"""
+        j = self.attachements.get(attachement_id)
+        if j is None:
+            return np.zeros(len(self.lignes), dtype=np.float64)
+        return self.realise[:, j]
+
+    def montant_total(self):
+        return float(self.montants_marche()[self.parent < 0].sum())
+
+    @staticmethod
+    def pourcentages(numerateur, denominateur):
+        """numerateur / denominateur x 100, zéro là où le dénominateur est nul ou négatif"""
+        numerateur = np.asarray(numerateur, dtype=np.float64)
+        denominateur = np.asarray(denominateur, dtype=np.float64)
+        return np.divide(numerateur * 100, denominateur,
+                         out=np.zeros(np.broadcast(numerateur, denominateur).shape), where=denominateur > 0)
@@ -0,0 +1,84 @@
+# services/recapitulatif_service.py
+# Récapitulatif des décomptes (lignes par nature de dépenses et de recettes, résumé HT/TVA/TTC/acompte) en SQL groupé
+from decimal import Decimal
+from django.db import transaction
+from django.db.models import F, Sum
+from projets.models import LigneDecompte, ResumeDecompte
+
+ZERO = Decimal('0')
+CENTIME = Decimal('0.01')
+CENT = Decimal('100')
+
+
+class RecapitulatifDecomptes:
+    """
+    Récapitulatif d'un ensemble de décomptes: une requête groupée par décompte et par couple
+    (nature des dépenses, nature des recettes) donne cumul à date, déjà perçu et reste à payer
+    (recalculé en SQL, sans dépendre de LigneDecompte.save); le résumé de chaque décompte
+    (HT, TVA à son taux, TTC, acompte TTC à délivrer) est dérivé de ces groupes et enregistré en bloc
+    (insertion ou mise à jour sur le décompte, le résumé garde son id).
+    Le nombre de requêtes ne dépend ni du nombre de décomptes ni du nombre de lignes.
+    """
+    TAILLE_LOT = 500
+    CHAMPS_RESUME = ['sous_total_ht', 'deja_percu_ht', 'reste_a_payer_ht', 'total_ht', 'tva_taux', 'tva_montant',
+                     'total_ttc', 'acompte_ttc']
+
+    def __init__(self, decomptes):
+        self.decomptes = decomptes
+
+    def groupes(self):
+        """Lignes du récapitulatif, par décompte puis par nature (une requête)"""
+        return LigneDecompte.objects.filter(decompte__in=self.decomptes).values(
+            'decompte_id', 'decompte__taux_tva', 'nature_recettes', 'nature_depenses'
+        ).annotate(
+            # Avant les sommes homonymes: F() désigne ici les colonnes de la ligne
+            reste_a_payer=Sum(F('cumul_a_date') - F('cumul_deja_percu')),
+        ).annotate(
+            cumul_a_date=Sum('cumul_a_date'),
+            cumul_deja_percu=Sum('cumul_deja_percu'),
+        ).order_by('decompte_id', 'nature_recettes', 'nature_depenses')
+
+    @staticmethod
+    def resume(decompte_id, taux_tva, lignes):
+        """ResumeDecompte (non enregistré) d'un décompte à partir de ses lignes groupées"""
+        taux_tva = taux_tva if taux_tva is not None else Decimal('20.00')
+        sous_total_ht = sum((ligne['cumul_a_date'] or ZERO for ligne in lignes), ZERO)
+        deja_percu_ht = sum((ligne['cumul_deja_percu'] or ZERO for ligne in lignes), ZERO)
+        reste_a_payer_ht = sum((ligne['reste_a_payer'] or ZERO for ligne in lignes), ZERO)
+        tva_montant = (sous_total_ht * taux_tva / CENT).quantize(CENTIME)
+        return ResumeDecompte(
+            decompte_id=decompte_id,
+            sous_total_ht=sous_total_ht,
+            deja_percu_ht=deja_percu_ht,
+            reste_a_payer_ht=reste_a_payer_ht,
+            total_ht=sous_total_ht,
+            tva_taux=taux_tva,
+            tva_montant=tva_montant,
+            total_ttc=sous_total_ht + tva_montant,
+            acompte_ttc=(reste_a_payer_ht * (1 + taux_tva / CENT)).quantize(CENTIME),
+        )
+
+    def calculer(self):
+        """{decompte_id: {'lignes': [groupes], 'resume': ResumeDecompte non enregistré}}"""
+        recapitulatifs = {}
+        for ligne in self.groupes():
+            recapitulatif = recapitulatifs.setdefault(ligne['decompte_id'], {'taux_tva': ligne['decompte__taux_tva'],
+                                                                               'lignes': []})
+            recapitulatif['lignes'].append(ligne)
+        for decompte_id, recapitulatif in recapitulatifs.items():
+            recapitulatif['resume'] = self.resume(decompte_id, recapitulatif.pop('taux_tva'), recapitulatif['lignes'])
+        return recapitulatifs
+
+    def enregistrer(self):
+        """
+        Enregistre les résumés des décomptes de l'ensemble: mis à jour sur place (update_or_create par décompte,
+        en une requête d'insertion avec mise à jour sur conflit), un décompte qui n'a plus de lignes perd le sien
+        """
+        recapitulatifs = self.calculer()
+        resumes = [recapitulatif['resume'] for recapitulatif in recapitulatifs.values()]
+        with transaction.atomic():
+            ResumeDecompte.objects.filter(decompte__in=self.decomptes).exclude(
+                decompte_id__in=list(recapitulatifs)).delete()
+            ResumeDecompte.objects.bulk_create(resumes, batch_size=self.TAILLE_LOT, update_conflicts=True,
+                                               unique_fields=['decompte'], update_fields=self.CHAMPS_RESUME)
+        return recapitulatifs
@@ -0,0 +1,172 @@
+# services/revision_service.py
+# Révision des prix de tous les décomptes d'un projet ou du portefeuille, en opérations matricielles (NumPy)
+from decimal import Decimal
+import numpy as np
+from django.db import transaction
+from django.db.models import F
+from projets.models import ConfigRevisionProjet, Decompte
+from projets.services.decompte_service import TAILLE_LOT, DecompteCalculator
+from projets.services.indices_service import CacheIndices, rang_mois
+from projets.services.situation_service import GrandLivreProjet
+
+CHAMPS_DECOMPTE = ['montant_revision_prix', 'montant_revision_periode', 'montant_ht', 'montant_tva', 'montant_ttc',
+                   'montant_retenue_garantie', 'montant_ras', 'montant_net_a_payer']
+# Décomptes réglés (même partiellement): leur révision n'est plus réécrite
+STATUTS_FIGES = ('PAYE', 'PARTIEL')
+
+
+class MoteurRevision:
+    """
+    Révision des prix des décomptes des projets configurés (ConfigRevisionProjet), tous projets par défaut.
+    Les décomptes sont lus en une requête, dans l'ordre des attachements de chaque projet; les indices
+    viennent de CacheIndices (aucune requête par indice). Pour n décomptes et c indices, la matrice n × c
+    des valeurs au mois de fin de période est divisée par celle des valeurs de base, pondérée par les
+    coefficients bᵢ du projet de chaque décompte et sommée: variation = (a + Σ bᵢ · Iᵢ / I0ᵢ - 1) · K,
+    ramenée à zéro sous la marge. Un indice sans valeur publiée ne contribue pas à la variation.
+    La révision de chaque période vaut montant HT de situation × variation, et montant_revision_prix
+    du décompte est la révision cumulée du projet jusqu'à lui (montant_ht étant lui-même cumulé);
+    montant_revision_periode, différence de deux cumuls arrondis, s'ajoute au HT de situation des montants
+    de trésorerie (DecompteCalculator, grand livre). Un décompte réglé (STATUTS_FIGES) garde sa révision
+    enregistrée, reprise telle quelle dans le cumul des décomptes suivants.
+    """
+
+    def __init__(self, projets_ids=None, indices=None):
+        self.projets_ids = projets_ids
+        self.indices = indices or CacheIndices.partage()
+
+    def configurations(self):
+        configurations = ConfigRevisionProjet.objects.all()
+        if self.projets_ids is not None:
+            configurations = configurations.filter(projet_id__in=self.projets_ids)
+        return {configuration.projet_id: configuration for configuration in configurations}
+
+    @staticmethod
+    def decomptes(projets_ids):
+        return list(Decompte.objects.filter(attachement__projet_id__in=projets_ids).select_related(
+            'attachement'
+        ).order_by('attachement__projet_id', 'attachement__date_etablissement', 'attachement_id'))
+
+    def calculer(self):
+        """
+        Retourne (décomptes ordonnés, variations, révisions de période, révisions cumulées), les trois
+        derniers étant des tableaux float64 alignés sur les décomptes, révisions arrondies au centime
+        """
+        configurations = self.configurations()
+        decomptes = self.decomptes(list(configurations))
+        n = len(decomptes)
+        if not n:
+            return decomptes, np.zeros(0), np.zeros(0), np.zeros(0)
+
+        # Paramètres par projet (une ligne par projet, une colonne par indice)
+        projets = list(configurations)
+        lignes = {projet_id: i for i, projet_id in enumerate(projets)}
+        codes = sorted({code for configuration in configurations.values() for code in configuration.coefficients})
+        colonnes = {code: j for j, code in enumerate(codes)}
+        poids = np.zeros((len(projets), len(codes)))
+        for projet_id, configuration in configurations.items():
+            for code, coefficient in configuration.coefficients.items():
+                poids[lignes[projet_id], colonnes[code]] = float(coefficient)
+        partie_fixe = np.array([float(configurations[projet_id].partie_fixe) for projet_id in projets])
+        coefficient_k = np.array([float(configurations[projet_id].coefficient_K) for projet_id in projets])
+        seuil = np.array([float(configurations[projet_id].marge_variation) / 100 for projet_id in projets])
+        rangs_base = np.array([rang_mois(configurations[projet_id].mois_base) for projet_id in projets], dtype=np.int64)
+
+        # Paramètres par décompte
+        projet = np.fromiter((lignes[decompte.attachement.projet_id] for decompte in decomptes), dtype=np.int64, count=n)
+        rangs = np.fromiter((rang_mois(decompte.attachement.date_fin_periode or decompte.attachement.date_etablissement)
+                             for decompte in decomptes), dtype=np.int64, count=n)
+        situation_ht = np.fromiter((float(decompte.attachement.montant_ht_situation or 0) for decompte in decomptes),
+                                   dtype=np.float64, count=n)
+
+        # Matrices des indices courants (n × c) et de base (projets × c)
+        courants = np.empty((n, len(codes)))
+        bases = np.empty((len(projets), len(codes)))
+        for code, j in colonnes.items():
+            courants[:, j] = self.indices.colonne(code, rangs)
+            bases[:, j] = self.indices.colonne(code, rangs_base)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rapports = courants / bases[projet]
+        rapports = np.where(np.isfinite(rapports) & (bases[projet] > 0), rapports, 1.0)
+
+        variations = (partie_fixe[projet] + (poids[projet] * rapports).sum(axis=1) - 1) * coefficient_k[projet]
+        variations[np.abs(variations) < seuil[projet]] = 0
+
+        # Décomptes réglés: révision de période déduite des cumuls enregistrés (0 avant le premier du projet)
+        debuts = np.flatnonzero(np.r_[True, projet[1:] != projet[:-1]])
+        figes = np.fromiter((decompte.statut in STATUTS_FIGES for decompte in decomptes), dtype=bool, count=n)
+        enregistres = np.fromiter((float(decompte.montant_revision_prix or 0) for decompte in decomptes),
+                                  dtype=np.float64, count=n)
+        precedents = np.r_[0.0, enregistres[:-1]]
+        precedents[debuts] = 0
+        revisions = np.where(figes, enregistres - precedents, situation_ht * variations)
+
+        # Cumul par projet: cumul global moins ce qui précède le premier décompte du projet
+        cumul = np.cumsum(revisions)
+        cumul -= np.repeat(cumul[debuts] - revisions[debuts], np.diff(np.r_[debuts, n]))
+        # Révisions de période reprises des cumuls arrondis: leur somme redonne exactement le cumul
+        cumul = np.round(cumul, 2)
+        revisions = np.diff(cumul, prepend=0.0)
+        revisions[debuts] = cumul[debuts]
+        return decomptes, variations, revisions, cumul
+
+    def resultats(self):
+        """Détail par décompte (simulation): variation, révision de la période et révision cumulée"""
+        decomptes, variations, revisions, cumuls = self.calculer()
+        for decompte, variation, revision, cumul in zip(decomptes, variations.tolist(), revisions.tolist(),
+                                                        cumuls.tolist()):
+            yield {
+                'decompte': decompte,
+                'variation': variation,
+                'revision_periode': Decimal(f"{revision:.2f}"),
+                'montant_revision_prix': Decimal(f"{cumul:.2f}"),
+            }
+
+    def enregistrer(self):
+        """
+        Écrit montant_revision_prix, montant_revision_periode et les montants qui en dépendent (calcul de
+        Decompte.save) sur les décomptes non réglés dont la révision change, en bulk_update. Les décomptes
+        sont relus verrouillés (select_for_update) dans la transaction d'écriture et les statuts réglés
+        filtrés à ce moment: un décompte payé entre le calcul et l'écriture n'est pas réécrit. Le grand livre
+        des projets concernés est reconstruit. Retourne les décomptes modifiés.
+        """
+        resultats = {resultat['decompte'].id: resultat for resultat in self.resultats()}
+        modifies = []
+        with transaction.atomic():
+            decomptes = Decompte.objects.select_for_update(of=('self',)).select_related('attachement').filter(
+                id__in=list(resultats)
+            ).exclude(statut__in=STATUTS_FIGES)
+            for decompte in decomptes:
+                resultat = resultats[decompte.id]
+                if (resultat['montant_revision_prix'], resultat['revision_periode']) == (
+                        decompte.montant_revision_prix, decompte.montant_revision_periode):
+                    continue
+                decompte.montant_revision_prix = resultat['montant_revision_prix']
+                decompte.montant_revision_periode = resultat['revision_periode']
+                DecompteCalculator.montants_decompte(decompte, decompte.attachement.montant_ht_cumule)
+                modifies.append(decompte)
+
+            projets_ids = sorted({decompte.attachement.projet_id for decompte in modifies})
+            Decompte.objects.bulk_update(modifies, CHAMPS_DECOMPTE, batch_size=TAILLE_LOT)
+            if projets_ids:
+                GrandLivreProjet.reconstruire(projets_ids)
+        return modifies
+
+
+def reporter_revisions_manuelles(projets_ids=None):
+    """
+    Reprise des décomptes enregistrés avant montant_revision_periode: pour un projet sans formule de révision,
+    la révision saisie à la main (montant_revision_prix) devient la révision de la période, comprise dans le HT
+    de situation comme le fait désormais Decompte.save. Un UPDATE, grand livre des projets repris reconstruit.
+    Retourne le nombre de décomptes repris.
+    """
+    decomptes = Decompte.objects.filter(
+        attachement__projet__config_revision__isnull=True, montant_revision_prix__isnull=False
+    ).exclude(montant_revision_periode=F('montant_revision_prix'))
+    if projets_ids is not None:
+        decomptes = decomptes.filter(attachement__projet_id__in=projets_ids)
+    with transaction.atomic():
+        projets = sorted(set(decomptes.values_list('attachement__projet_id', flat=True)))
+        reprises = decomptes.update(montant_revision_periode=F('montant_revision_prix'))
+        if projets:
+            GrandLivreProjet.reconstruire(projets)
+    return reprises
@@ -0,0 +1,126 @@
+# services/situation_service.py
+# Grand livre financier par projet, tenu à jour à chaque écriture des décomptes et des montants d'attachement
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import groupby
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from projets.models import Decompte, Projet, SituationFinanciereProjet
+from projets.services.decompte_service import DecompteCalculator
+
+ZERO = Decimal('0')
+CHAMPS = ['nb_decomptes', 'nb_decomptes_payes', 'montant_ht_cumule', 'montant_ttc_cumule', 'retenue_garantie_cumulee',
+          'ras_cumulee', 'autres_retenues_cumulees', 'net_a_payer_cumule', 'montant_paye', 'montant_restant']
+# Champs sommés sur les décomptes: l'écart d'une écriture s'y ajoute
+CHAMPS_SOMMES = [champ for champ in CHAMPS if champ not in ('montant_ht_cumule', 'montant_ttc_cumule')]
+
+
+class GrandLivreProjet:
+    """
+    Tient SituationFinanciereProjet: une ligne par projet, mise à jour dans la transaction de chaque écriture
+    d'un décompte (save, delete, changement de statut) ou des montants HT d'un attachement (registre des cumuls).
+    Le montant HT/TTC cumulé est celui du dernier décompte dans l'ordre des attachements, les retenues, le net,
+    le payé et le reste à payer sont sommés sur les montants de situation: une écriture n'y ajoute que l'écart
+    des décomptes qu'elle touche (suivre), sans relire le projet. Les tableaux de bord lisent la ligne
+    enregistrée sans recalcul; reconstruire() la recalcule entièrement.
+    """
+    TAILLE_LOT = 500
+
+    def __init__(self, projet_id):
+        self.projet_id = projet_id
+
+    @staticmethod
+    def decomptes(filtre):
+        """Décomptes dans l'ordre des attachements, montants de situation posés (une requête)"""
+        return DecompteCalculator(Decompte.objects.filter(**filtre).order_by(
+            'attachement__projet_id', 'attachement__date_etablissement', 'attachement_id'
+        )).calculer()
+
+    @staticmethod
+    def situation(projet_id, decomptes):
+        """SituationFinanciereProjet (non enregistrée) d'un projet à partir de ses décomptes ordonnés"""
+        situation = SituationFinanciereProjet(projet_id=projet_id, nb_decomptes=len(decomptes))
+        for decompte in decomptes:
+            situation.retenue_garantie_cumulee += decompte.situation['retenue_garantie']
+            situation.ras_cumulee += decompte.situation['ras']
+            situation.autres_retenues_cumulees += decompte.situation['autres_retenues']
+            situation.net_a_payer_cumule += decompte.situation['net_a_payer']
+            if decompte.statut == 'PAYE':
+                situation.nb_decomptes_payes += 1
+                situation.montant_paye += decompte.situation['net_a_payer']
+        if decomptes:
+            situation.montant_ht_cumule = decomptes[-1].montant_ht
+            situation.montant_ttc_cumule = decomptes[-1].montant_ttc
+        situation.montant_restant = situation.net_a_payer_cumule - situation.montant_paye
+        return situation
+
+    @contextmanager
+    def suivre(self, filtre):
+        """
+        Bloc d'écriture des décomptes filtrés (ou des montants de leurs attachements): leurs montants de situation
+        sont lus avant et après le bloc, et seul l'écart est reporté sur le grand livre
+        """
+        with transaction.atomic():
+            avant = self.situation(self.projet_id, self.decomptes(filtre))
+            yield
+            self.appliquer_ecart(avant, self.situation(self.projet_id, self.decomptes(filtre)))
+
+    def appliquer_ecart(self, avant, apres):
+        """
+        Ajoute aux cumuls l'écart entre deux états des mêmes décomptes (ligne verrouillée, mise à jour F()) et relit
+        le HT/TTC du dernier décompte du projet (une ligne). Sans ligne enregistrée, la situation est calculée.
+        """
+        with transaction.atomic():
+            if not SituationFinanciereProjet.objects.select_for_update().filter(projet_id=self.projet_id).exists():
+                return self.actualiser()
+            dernier = Decompte.objects.filter(attachement__projet_id=self.projet_id).order_by(
+                '-attachement__date_etablissement', '-attachement_id').values('montant_ht', 'montant_ttc').first()
+            SituationFinanciereProjet.objects.filter(projet_id=self.projet_id).update(
+                montant_ht_cumule=dernier['montant_ht'] if dernier else ZERO,
+                montant_ttc_cumule=dernier['montant_ttc'] if dernier else ZERO,
+                date_modification=timezone.now(),
+                **{champ: F(champ) + (getattr(apres, champ) - getattr(avant, champ)) for champ in CHAMPS_SOMMES},
+            )
+
+    def actualiser(self):
+        """Recalcule entièrement et enregistre la situation du projet"""
+        situation = self.situation(self.projet_id, self.decomptes({'attachement__projet_id': self.projet_id}))
+        with transaction.atomic():
+            situation, _ = SituationFinanciereProjet.objects.update_or_create(
+                projet_id=self.projet_id, defaults={champ: getattr(situation, champ) for champ in CHAMPS}
+            )
+        return situation
+
+    @classmethod
+    def reconstruire(cls, projets_ids=None):
+        """Réécrit la situation des projets donnés (tous par défaut): une lecture des décomptes, un bulk_create"""
+        projets = Projet.objects.all()
+        filtre = {}
+        if projets_ids is not None:
+            projets = projets.filter(id__in=projets_ids)
+            filtre = {'attachement__projet_id__in': projets_ids}
+        par_projet = {
+            projet_id: list(groupe)
+            for projet_id, groupe in groupby(cls.decomptes(filtre), key=lambda decompte: decompte.attachement.projet_id)
+        }
+        situations = [cls.situation(projet_id, par_projet.get(projet_id, []))
+                      for projet_id in projets.values_list('id', flat=True)]
+        with transaction.atomic():
+            SituationFinanciereProjet.objects.filter(projet_id__in=[situation.projet_id for situation in situations]).delete()
+            SituationFinanciereProjet.objects.bulk_create(situations, batch_size=cls.TAILLE_LOT)
+        return situations
+
+    @classmethod
+    def lire(cls, projet_id):
+        """Situation enregistrée du projet; calculée et enregistrée à la première lecture"""
+        situation = SituationFinanciereProjet.objects.filter(projet_id=projet_id).first()
+        return situation if situation is not None else cls(projet_id).actualiser()
+
+    @staticmethod
+    def portefeuille(projets):
+        """Totaux des situations d'un ensemble de projets (une requête)"""
+        totaux = SituationFinanciereProjet.objects.filter(projet__in=projets).aggregate(
+            **{champ: Sum(champ) for champ in CHAMPS}
+        )
+        return {champ: valeur or ZERO for champ, valeur in totaux.items()}
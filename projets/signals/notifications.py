@@ -9,10 +9,14 @@ from django.contrib.auth.models import User
 @receiver(post_save, sender=Projet)
 def gerer_notifications_projet(sender, instance: Projet, created, **kwargs):
     if created:
-        # Notification pour nouveau projet
+        # Notification pour nouveau projet: ses utilisateurs n'existent pas encore à la création,
+        # le créateur est posé sur l'instance (_createur) avant l'enregistrement
+        utilisateur = instance.users.first() or getattr(instance, '_createur', None)
+        if utilisateur is None:
+            return
         from projets.services.notification_service import NotificationService
         NotificationService.creer_notification_personnalisee(
-            utilisateur=instance.users.first(),
+            utilisateur=utilisateur,
             type_notif='PROJET_MODIFIE',
             titre=f"Nouveau projet: {instance.nom}",
             message=f"Le projet {instance.nom} a été créé.",
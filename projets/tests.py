@@ -1,3 +1,543 @@
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from projets.models import (Attachement, ConfigRevisionProjet, CumulLigneAttachement, Decompte, IndiceRevision,
+                            LigneAttachement, LigneBordereau, LigneDecompte, LotProjet, Projet, ResumeDecompte,
+                            SituationFinanciereProjet, ValeurIndice)
+from projets.services.bordereau_service import BordereauPatcher, BordereauSaver, ConflitRevision
+from projets.services.clonage_service import cloner_projet
+from projets.services.cumuls_service import RegistreCumuls
+from projets.services.decompte_service import generer_decomptes_projet
+from projets.services.indices_service import CacheIndices
+from projets.services.revision_service import MoteurRevision, reporter_revisions_manuelles
+from projets.services.situation_service import CHAMPS, GrandLivreProjet
+
+
+def creer_projet(numero='T-001'):
+    """Projet de test rattaché à l'utilisateur 'conducteur' (destinataire de la notification de création)"""
+    utilisateur, _ = User.objects.get_or_create(username='conducteur')
+    projet = Projet(nom=f"Projet {numero}", numero=numero, objet="Projet de test",
+                    maitre_ouvrage="Maître d'ouvrage", localisation="Rabat")
+    projet._createur = utilisateur
+    projet.save()
+    projet.users.add(utilisateur)
+    return projet
+
+
+def creer_bordereau(lot):
+    """
+    Bordereau de test: T1 (titre) > a (2 x 10), b (1 x 5); c (3 x 1) à la racine.
+    Retourne {clé: id en base}
+    """
+    rows = [
+        {'id': 'T1', 'parent_id': None, 'est_titre': True, 'numero': '1', 'designation': 'Terrassements'},
+        {'id': 'a', 'parent_id': 'T1', 'numero': '1.1', 'designation': 'Déblais', 'unite': 'm3',
+         'quantite': 2, 'prix_unitaire': 10},
+        {'id': 'b', 'parent_id': 'T1', 'numero': '1.2', 'designation': 'Remblais', 'unite': 'm3',
+         'quantite': 1, 'prix_unitaire': 5},
+        {'id': 'c', 'parent_id': None, 'numero': '2', 'designation': 'Béton', 'unite': 'm3',
+         'quantite': 3, 'prix_unitaire': 1},
+    ]
+    return BordereauSaver(lot).sauvegarder(rows)
+
+
+def grille(lot):
+    """Lignes du lot au format de la grille, dans l'ordre d'affichage"""
+    return [{
+        'id': ligne.id, 'parent_id': ligne.parent_id, 'est_titre': ligne.est_titre, 'numero': ligne.numero,
+        'designation': ligne.designation, 'unite': ligne.unite, 'quantite': ligne.quantite,
+        'prix_unitaire': ligne.prix_unitaire, 'montant': ligne.montant_calcule,
+    } for ligne in LigneBordereau.objects.filter(lot=lot).order_by('ordre_affichage', 'id')]
+
+
+class BordereauSaverTests(TestCase):
+    def setUp(self):
+        self.lot = LotProjet.objects.create(projet=creer_projet(), nom="Lot 1")
+        self.ids = creer_bordereau(self.lot)
+
+    def test_sous_totaux_et_hierarchie(self):
+        titre = LigneBordereau.objects.get(id=self.ids['T1'])
+        self.assertEqual(titre.sous_total_marche, Decimal('25.00'))
+        self.assertEqual(titre.montant_calcule, Decimal('25.00'))
+        self.assertTrue(titre.has_children)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['a']).parent_id, self.ids['T1'])
+        self.assertEqual(self.lot.revision, 1)
+
+    def test_grille_inchangee_sans_ecriture(self):
+        saver = BordereauSaver(self.lot)
+        saver.sauvegarder(grille(self.lot))
+        self.assertEqual(saver.lignes_modifiees, [])
+        self.assertEqual(saver.lignes_creees, [])
+        self.assertEqual(saver.lignes_supprimees, set())
+
+    def test_diff_ligne_modifiee(self):
+        rows = grille(self.lot)
+        for row in rows:
+            if row['id'] == self.ids['a']:
+                row['quantite'] = 4
+        saver = BordereauSaver(self.lot)
+        saver.sauvegarder(rows)
+        # La ligne modifiée et son titre (sous-total) seulement
+        self.assertEqual({ligne.id for ligne in saver.lignes_modifiees}, {self.ids['a'], self.ids['T1']})
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['T1']).sous_total_marche, Decimal('45.00'))
+
+    def test_diff_ligne_absente_supprimee(self):
+        rows = [row for row in grille(self.lot) if row['id'] != self.ids['c']]
+        saver = BordereauSaver(self.lot)
+        saver.sauvegarder(rows)
+        self.assertEqual(saver.lignes_modifiees, [])
+        self.assertEqual(saver.lignes_supprimees, {self.ids['c']})
+        self.assertFalse(LigneBordereau.objects.filter(id=self.ids['c']).exists())
+
+    def test_erreur_annule_toute_la_sauvegarde(self):
+        rows = grille(self.lot)[:2] + [{'id': None, 'parent_id': None, 'designation': 'Nouvelle', 'quantite': 1,
+                                        'prix_unitaire': 1}]
+        with mock.patch('projets.services.bordereau_service.calculer_sous_totaux', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                BordereauSaver(self.lot).sauvegarder(rows)
+        self.assertEqual(LigneBordereau.objects.filter(lot=self.lot).count(), 4)
+        self.assertFalse(LigneBordereau.objects.filter(lot=self.lot, designation='Nouvelle').exists())
+        self.lot.refresh_from_db()
+        self.assertEqual(self.lot.revision, 1)
+
+    def test_grille_sur_une_revision_depassee(self):
+        rows = grille(self.lot)
+        rows[1]['quantite'] = 9
+        with self.assertRaises(ConflitRevision):
+            BordereauSaver(self.lot).sauvegarder(rows, revision=0)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['a']).quantite, Decimal('2.00'))
+        BordereauSaver(self.lot).sauvegarder(rows, revision=1)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['a']).quantite, Decimal('9.00'))
+
+
+class BordereauPatcherTests(TestCase):
+    def setUp(self):
+        self.lot = LotProjet.objects.create(projet=creer_projet(), nom="Lot 1")
+        self.ids = creer_bordereau(self.lot)
+        self.lot.refresh_from_db()
+
+    def appliquer(self, *operations):
+        resultat = BordereauPatcher(self.lot).appliquer(self.lot.revision, list(operations))
+        self.lot.refresh_from_db()
+        return resultat
+
+    def test_update_renvoie_ligne_et_ancetres(self):
+        resultat = self.appliquer({'op': 'update', 'id': self.ids['a'], 'valeurs': {'quantite': 4}})
+        self.assertEqual(resultat['montants'], {self.ids['a']: 40.0, self.ids['T1']: 45.0})
+        self.assertEqual(resultat['montant_total'], 48.0)
+        self.assertEqual(resultat['revision'], 2)
+
+    def test_insert_puis_reference_temporaire(self):
+        resultat = self.appliquer(
+            {'op': 'insert', 'id': 'tmp_1', 'parent_id': self.ids['T1'], 'index': 0,
+             'valeurs': {'designation': 'Décapage', 'quantite': 1, 'prix_unitaire': 7}},
+            {'op': 'update', 'id': 'tmp_1', 'valeurs': {'quantite': 2}},
+        )
+        nouvelle = LigneBordereau.objects.get(id=resultat['lignes']['tmp_1'])
+        self.assertEqual(nouvelle.parent_id, self.ids['T1'])
+        self.assertEqual(nouvelle.montant_calcule, Decimal('14.00'))
+        enfants = LigneBordereau.objects.filter(parent_id=self.ids['T1']).order_by('ordre_affichage')
+        self.assertEqual(enfants[0].id, nouvelle.id)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['T1']).sous_total_marche, Decimal('39.00'))
+
+    def test_delete_supprime_les_descendants(self):
+        resultat = self.appliquer({'op': 'delete', 'id': self.ids['T1']})
+        self.assertEqual(resultat['supprimees'], sorted([self.ids['T1'], self.ids['a'], self.ids['b']]))
+        self.assertEqual(list(LigneBordereau.objects.filter(lot=self.lot).values_list('id', flat=True)),
+                         [self.ids['c']])
+
+    def test_indent_outdent(self):
+        self.appliquer({'op': 'indent', 'id': self.ids['c']})
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['c']).parent_id, self.ids['T1'])
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['T1']).sous_total_marche, Decimal('28.00'))
+        self.appliquer({'op': 'outdent', 'id': self.ids['c']})
+        self.assertIsNone(LigneBordereau.objects.get(id=self.ids['c']).parent_id)
+
+    def test_move_sous_soi_meme_refuse(self):
+        with self.assertRaises(ValueError):
+            self.appliquer({'op': 'move', 'id': self.ids['T1'], 'parent_id': self.ids['a']})
+
+    def test_titre_vide_conserve(self):
+        self.appliquer({'op': 'insert', 'id': 'chapitre', 'parent_id': None, 'valeurs': {'est_titre': True}})
+        self.appliquer({'op': 'update', 'id': self.ids['c'], 'valeurs': {'prix_unitaire': 2}})
+        self.assertTrue(LigneBordereau.objects.get(lot=self.lot, designation='Nouvelle ligne').est_titre)
+
+    def test_conflit_de_revision(self):
+        revision = self.lot.revision
+        with self.assertRaises(ConflitRevision):
+            BordereauPatcher(self.lot).appliquer(revision - 1, [
+                {'op': 'update', 'id': self.ids['a'], 'valeurs': {'quantite': 9}}])
+        self.lot.refresh_from_db()
+        self.assertEqual(self.lot.revision, revision)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['a']).quantite, Decimal('2.00'))
+
+    def test_revision_requise(self):
+        with self.assertRaises(ValueError):
+            BordereauPatcher(self.lot).appliquer(None, [{'op': 'update', 'id': self.ids['c'], 'valeurs': {}}])
+
+    def test_arbre_coherent_apres_operations(self):
+        self.appliquer(
+            {'op': 'insert', 'id': 'tmp_1', 'parent_id': self.ids['c'], 'valeurs': {'quantite': 2, 'prix_unitaire': 4}},
+            {'op': 'move', 'id': self.ids['b'], 'parent_id': None, 'index': 0},
+            {'op': 'indent', 'id': self.ids['T1']},
+            {'op': 'update', 'id': self.ids['a'], 'valeurs': {'prix_unitaire': 3}},
+            {'op': 'outdent', 'id': 'tmp_1'},
+            {'op': 'delete', 'id': self.ids['c']},
+        )
+        # Bornes, chemins, niveaux et sous-totaux tenus par décalages égalent un recalcul complet
+        self.assertEqual(LigneBordereau.reindexer_lot(self.lot.id), 0)
+        self.assertEqual(LigneBordereau.recalculer_sous_totaux(self.lot.id), 0)
+        b = LigneBordereau.objects.get(id=self.ids['b'])
+        self.assertEqual((b.est_titre, b.sous_total_marche, b.montant_calcule), (True, Decimal('6.00'), Decimal('6.00')))
+        self.assertEqual([ligne['designation'] for ligne in grille(self.lot)],
+                         ['Remblais', 'Terrassements', 'Déblais', 'Nouvelle ligne'])
+
+
+
+class LigneBordereauSaveTests(TestCase):
+    def setUp(self):
+        self.lot = LotProjet.objects.create(projet=creer_projet(), nom="Lot 1")
+        self.ids = creer_bordereau(self.lot)
+
+    def revision(self):
+        self.lot.refresh_from_db()
+        return self.lot.revision
+
+    def test_champ_differe_sans_reindexation(self):
+        ligne = LigneBordereau.objects.only('id', 'lot_id', 'designation').get(id=self.ids['a'])
+        ligne.designation = 'Déblais en grande masse'
+        with mock.patch.object(LigneBordereau, 'reindexer_lot') as reindexer:
+            ligne.save()
+        reindexer.assert_not_called()
+        self.assertEqual(self.revision(), 1)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['a']).designation, 'Déblais en grande masse')
+
+    def test_revision_sur_changement_de_montant(self):
+        ligne = LigneBordereau.objects.get(id=self.ids['a'])
+        ligne.designation = 'Déblais'
+        ligne.save()
+        self.assertEqual(self.revision(), 1)
+        ligne.quantite = Decimal('3')
+        ligne.save()
+        self.assertEqual(self.revision(), 2)
+        self.assertEqual(LigneBordereau.objects.get(id=self.ids['T1']).sous_total_marche, Decimal('35.00'))
+
+
+class ClonageProjetTests(TestCase):
+    def setUp(self):
+        self.projet = creer_projet()
+        self.utilisateur = self.projet.users.get()
+        self.lot = LotProjet.objects.create(projet=self.projet, nom="Lot 1")
+        self.ids = creer_bordereau(self.lot)
+
+    def test_clone_lots_et_bordereau(self):
+        copie = cloner_projet(self.projet, 'T-002', utilisateur=self.utilisateur)
+        lot = LotProjet.objects.get(projet=copie)
+        self.assertEqual(lot.nom, "Lot 1")
+        self.assertEqual(list(copie.users.all()), [self.utilisateur])
+
+        lignes = {ligne.numero: ligne for ligne in LigneBordereau.objects.filter(lot=lot)}
+        self.assertEqual(len(lignes), 4)
+        self.assertNotIn(lignes['1'].id, self.ids.values())
+        self.assertEqual(lignes['1.1'].parent_id, lignes['1'].id)
+        self.assertEqual(lignes['1.1'].chemin, f"{lignes['1'].id}/{lignes['1.1'].id}/")
+        self.assertEqual(lignes['1'].sous_total_marche, Decimal('25.00'))
+        self.assertEqual(LigneBordereau.objects.filter(lot=self.lot).count(), 4)
+
+    def test_numero_existant(self):
+        with self.assertRaises(ValueError):
+            cloner_projet(self.projet, self.projet.numero)
+
+
+class ResumeDecompteTests(TestCase):
+    def setUp(self):
+        projet = creer_projet()
+        attachement = Attachement.objects.create(projet=projet, numero='01', statut='VALIDE',
+                                                 date_etablissement=date(2024, 1, 31),
+                                                 date_debut_periode=date(2024, 1, 1), date_fin_periode=date(2024, 1, 31))
+        self.decompte = Decompte.objects.create(attachement=attachement, numero='DEC-001',
+                                                date_emission=date(2024, 1, 31), taux_tva=Decimal('20.00'))
+
+    def ligne(self, cumul, deja_percu):
+        return LigneDecompte.objects.create(decompte=self.decompte, nature_depenses='autres',
+                                            nature_recettes='travaux_metre', cumul_a_date=Decimal(cumul),
+                                            cumul_deja_percu=Decimal(deja_percu))
+
+    def test_resume_mis_a_jour_sur_place(self):
+        self.ligne('100', '40')
+        resume = ResumeDecompte.objects.get(decompte=self.decompte)
+        self.assertEqual((resume.reste_a_payer_ht, resume.total_ttc, resume.acompte_ttc),
+                         (Decimal('60.00'), Decimal('120.00'), Decimal('72.00')))
+        self.ligne('50', '0')
+        self.decompte.save()
+        mis_a_jour = ResumeDecompte.objects.get(decompte=self.decompte)
+        self.assertEqual(mis_a_jour.id, resume.id)
+        self.assertEqual((mis_a_jour.sous_total_ht, mis_a_jour.reste_a_payer_ht), (Decimal('150.00'), Decimal('110.00')))
+
+    def test_resume_supprime_sans_lignes(self):
+        self.ligne('100', '40').delete()
+        self.assertFalse(ResumeDecompte.objects.filter(decompte=self.decompte).exists())
+
+
+class GrandLivreProjetTests(TestCase):
+    def setUp(self):
+        self.projet = creer_projet()
+        lot = LotProjet.objects.create(projet=self.projet, nom="Lot 1")
+        self.ligne = LigneBordereau.objects.get(id=creer_bordereau(lot)['a'])
+        self.attachements = []
+        for rang, quantite in ((1, 2), (2, 5), (3, 6)):
+            attachement = Attachement.objects.create(
+                projet=self.projet, numero=f"{rang:02d}", statut='VALIDE', date_etablissement=date(2024, rang, 28),
+                date_debut_periode=date(2024, rang, 1), date_fin_periode=date(2024, rang, 28))
+            self.attachements.append(attachement)
+            self.saisie = LigneAttachement.objects.create(
+                attachement=attachement, ligne_lot=self.ligne, designation=self.ligne.designation,
+                quantite_initiale=self.ligne.quantite, prix_unitaire=self.ligne.prix_unitaire,
+                quantite_realisee=Decimal(quantite))
+        generer_decomptes_projet(self.projet.id)
+
+    def assertGrandLivreExact(self):
+        """La ligne tenue par écarts égale le recalcul complet"""
+        tenue = SituationFinanciereProjet.objects.get(projet=self.projet)
+        calculee = GrandLivreProjet.situation(
+            self.projet.id, GrandLivreProjet.decomptes({'attachement__projet_id': self.projet.id}))
+        self.assertEqual({champ: getattr(tenue, champ) for champ in CHAMPS},
+                         {champ: getattr(calculee, champ) for champ in CHAMPS})
+
+    def test_generation(self):
+        tenue = SituationFinanciereProjet.objects.get(projet=self.projet)
+        self.assertEqual(tenue.nb_decomptes, 3)
+        self.assertEqual(tenue.montant_ht_cumule, Decimal('60.00'))
+        self.assertGrandLivreExact()
+
+    def test_paiement_modification_et_suppression(self):
+        decomptes = list(Decompte.objects.filter(attachement__projet=self.projet).order_by('numero'))
+        decomptes[0].statut = 'PAYE'
+        decomptes[0].save()
+        self.assertEqual(SituationFinanciereProjet.objects.get(projet=self.projet).nb_decomptes_payes, 1)
+        decomptes[1].autres_retenues = Decimal('3.00')
+        decomptes[1].save()
+        self.assertGrandLivreExact()
+        decomptes[2].delete()
+        tenue = SituationFinanciereProjet.objects.get(projet=self.projet)
+        self.assertEqual((tenue.nb_decomptes, tenue.montant_ht_cumule), (2, Decimal('50.00')))
+        self.assertGrandLivreExact()
+
+    def test_saisie_d_attachement(self):
+        self.saisie.quantite_realisee = Decimal('9')
+        self.saisie.save()
+        self.assertGrandLivreExact()
+
+
+class RegistreCumulsTests(TestCase):
+    def setUp(self):
+        self.projet = creer_projet()
+        lot = LotProjet.objects.create(projet=self.projet, nom="Lot 1")
+        ids = creer_bordereau(lot)
+        self.a = LigneBordereau.objects.get(id=ids['a'])
+        self.b = LigneBordereau.objects.get(id=ids['b'])
+        self.a1 = self.attachement('01', date(2024, 1, 31))
+        self.a2 = self.attachement('02', date(2024, 2, 29))
+
+    def attachement(self, numero, jour):
+        return Attachement.objects.create(projet=self.projet, numero=numero, statut='VALIDE', date_etablissement=jour,
+                                          date_debut_periode=jour.replace(day=1), date_fin_periode=jour)
+
+    def saisir(self, attachement, ligne, quantite):
+        return LigneAttachement.objects.create(
+            attachement=attachement, ligne_lot=ligne, numero=ligne.numero, designation=ligne.designation,
+            unite=ligne.unite, quantite_initiale=ligne.quantite, prix_unitaire=ligne.prix_unitaire,
+            quantite_realisee=Decimal(quantite),
+        )
+
+    def entree(self, attachement, ligne):
+        return CumulLigneAttachement.objects.get(attachement=attachement, ligne_lot=ligne)
+
+    def test_s_s1_et_partiel(self):
+        self.saisir(self.a1, self.a, 2)
+        self.saisir(self.a2, self.a, 5)
+        self.saisir(self.a2, self.b, 1)
+        entree = self.entree(self.a2, self.a)
+        self.assertEqual((entree.quantite_precedente, entree.quantite_partielle, entree.quantite_cumulee),
+                         (Decimal('2'), Decimal('3'), Decimal('5')))
+        self.assertEqual((entree.montant_precedent, entree.montant_partiel, entree.montant_cumule),
+                         (Decimal('20.00'), Decimal('30.00'), Decimal('50.00')))
+        self.a2.refresh_from_db()
+        self.assertEqual(self.a2.montant_ht_cumule, Decimal('55.00'))
+        self.assertEqual(self.a2.montant_ht_precedent, Decimal('20.00'))
+        self.assertEqual(self.a2.montant_ht_situation, Decimal('35.00'))
+
+    def test_modification_actualise_le_suivant(self):
+        saisie = self.saisir(self.a1, self.a, 2)
+        self.saisir(self.a2, self.a, 5)
+        saisie.quantite_realisee = Decimal('3')
+        saisie.save()
+        entree = self.entree(self.a2, self.a)
+        self.assertEqual((entree.quantite_precedente, entree.quantite_partielle), (Decimal('3'), Decimal('2')))
+        self.a1.refresh_from_db()
+        self.assertEqual(self.a1.montant_ht_cumule, Decimal('30.00'))
+
+    def test_suppression_d_une_saisie(self):
+        self.saisir(self.a1, self.a, 2)
+        saisie = self.saisir(self.a2, self.a, 5)
+        saisie.delete()
+        entree = self.entree(self.a2, self.a)
+        self.assertFalse(entree.saisie)
+        self.assertEqual((entree.quantite_cumulee, entree.quantite_partielle), (Decimal('0'), Decimal('-2')))
+
+    def test_reordonnancement_des_attachements(self):
+        self.saisir(self.a1, self.a, 2)
+        self.saisir(self.a2, self.a, 5)
+        # Un attachement antérieur au premier décale les rangs: le registre est reconstruit
+        a0 = self.attachement('00', date(2023, 12, 31))
+        self.saisir(a0, self.a, 1)
+        self.assertEqual(self.entree(a0, self.a).sequence, 1)
+        entree = self.entree(self.a1, self.a)
+        self.assertEqual((entree.sequence, entree.quantite_precedente, entree.quantite_partielle),
+                         (2, Decimal('1'), Decimal('1')))
+        # Déplacer le dernier attachement en tête, puis actualiser
+        self.a2.date_etablissement = date(2023, 11, 30)
+        self.a2.save()
+        RegistreCumuls(self.projet.id).actualiser(self.a2.id)
+        self.assertEqual(self.entree(self.a2, self.a).sequence, 1)
+        entree = self.entree(a0, self.a)
+        self.assertEqual((entree.quantite_precedente, entree.quantite_partielle), (Decimal('5'), Decimal('-4')))
+
+
+class GenerationDecomptesTests(TestCase):
+    def setUp(self):
+        self.projet = creer_projet()
+        self.attachements = [
+            Attachement.objects.create(projet=self.projet, numero=f"{rang:02d}", statut='VALIDE',
+                                       date_etablissement=date(2024, rang, 28), date_debut_periode=date(2024, rang, 1),
+                                       date_fin_periode=date(2024, rang, 28))
+            for rang in (1, 2, 3)
+        ]
+
+    def numeros(self):
+        return dict(Decompte.objects.filter(attachement__projet=self.projet).values_list('attachement_id', 'numero'))
+
+    def test_numerotation_a_la_suite(self):
+        self.assertEqual(generer_decomptes_projet(self.projet.id, attachements_ids=[self.attachements[0].id]), 1)
+        self.assertEqual(generer_decomptes_projet(self.projet.id), 2)
+        self.assertEqual(self.numeros(), {attachement.id: f"DEC-{rang:03d}"
+                                          for rang, attachement in enumerate(self.attachements, start=1)})
+        self.assertEqual(generer_decomptes_projet(self.projet.id), 0)
+
+    def test_numero_libere_non_reattribue(self):
+        generer_decomptes_projet(self.projet.id)
+        Decompte.objects.get(numero='DEC-001', attachement__projet=self.projet).delete()
+        generer_decomptes_projet(self.projet.id)
+        self.assertEqual(self.numeros()[self.attachements[0].id], 'DEC-004')
+        self.assertEqual(len(set(self.numeros().values())), 3)
+
+    def test_numeros_libres_ignores(self):
+        Decompte.objects.create(attachement=self.attachements[0], numero='DEC-A12', date_emission=date(2024, 1, 28),
+                                taux_tva=Decimal('20.00'))
+        generer_decomptes_projet(self.projet.id)
+        self.assertEqual(self.numeros()[self.attachements[1].id], 'DEC-001')
+
+    def test_brouillons_sans_resume(self):
+        # Un décompte généré n'a pas encore de lignes: pas de résumé, comme après Decompte.save
+        generer_decomptes_projet(self.projet.id)
+        self.assertFalse(ResumeDecompte.objects.filter(decompte__attachement__projet=self.projet).exists())
+        decompte = Decompte.objects.get(attachement=self.attachements[0])
+        LigneDecompte.objects.create(decompte=decompte, nature_depenses='autres', nature_recettes='travaux_metre',
+                                     cumul_a_date=Decimal('100'), cumul_deja_percu=Decimal('0'))
+        self.assertEqual(ResumeDecompte.objects.get(decompte=decompte).total_ttc, Decimal('120.00'))
+
+
+
+class MoteurRevisionTests(TestCase):
+    def setUp(self):
+        self.projet = creer_projet()
+        lot = LotProjet.objects.create(projet=self.projet, nom="Lot 1")
+        ligne = LigneBordereau.objects.get(id=creer_bordereau(lot)['a'])
+        indice = IndiceRevision.objects.create(code='BT01', libelle='Bâtiment gros œuvre')
+        ValeurIndice.objects.create(indice=indice, mois=date(2024, 1, 1), valeur=Decimal('100'))
+        ValeurIndice.objects.create(indice=indice, mois=date(2024, 3, 1), valeur=Decimal('110'))
+        ConfigRevisionProjet.objects.create(projet=self.projet, partie_fixe=Decimal('0.15'),
+                                            coefficients={'BT01': '0.85'}, mois_base=date(2024, 1, 1))
+        # Situation de février: 1000 HT à l'indice de base; de mars: 500 HT à l'indice 110
+        for rang, quantite in ((2, 100), (3, 150)):
+            attachement = Attachement.objects.create(
+                projet=self.projet, numero=f"{rang:02d}", statut='VALIDE', date_etablissement=date(2024, rang, 28),
+                date_debut_periode=date(2024, rang, 1), date_fin_periode=date(2024, rang, 28))
+            LigneAttachement.objects.create(
+                attachement=attachement, ligne_lot=ligne, designation=ligne.designation,
+                quantite_initiale=ligne.quantite, prix_unitaire=ligne.prix_unitaire, quantite_realisee=quantite)
+        generer_decomptes_projet(self.projet.id)
+        self.decomptes = list(Decompte.objects.filter(attachement__projet=self.projet).order_by('numero'))
+
+    def moteur(self):
+        return MoteurRevision([self.projet.id], indices=CacheIndices())
+
+    def test_variations_et_revisions(self):
+        resultats = list(self.moteur().resultats())
+        self.assertAlmostEqual(resultats[0]['variation'], 0.0)
+        self.assertAlmostEqual(resultats[1]['variation'], 0.085)
+        self.assertEqual([resultat['revision_periode'] for resultat in resultats], [Decimal('0.00'), Decimal('42.50')])
+        self.assertEqual([resultat['montant_revision_prix'] for resultat in resultats],
+                         [Decimal('0.00'), Decimal('42.50')])
+
+    def test_enregistrer_reporte_la_revision_dans_les_montants(self):
+        modifies = self.moteur().enregistrer()
+        self.assertEqual([decompte.id for decompte in modifies], [self.decomptes[1].id])
+        decompte = Decompte.objects.get(id=self.decomptes[1].id)
+        self.assertEqual(decompte.montant_revision_prix, Decimal('42.50'))
+        self.assertEqual(decompte.montant_revision_periode, Decimal('42.50'))
+        self.assertEqual(decompte.montant_ht, Decimal('1542.50'))
+        self.assertEqual(decompte.montant_situation_ht, Decimal('542.50'))
+        self.assertEqual(self.moteur().enregistrer(), [])
+
+    def test_decompte_paye_non_reecrit(self):
+        Decompte.objects.filter(id=self.decomptes[0].id).update(statut='PAYE', montant_revision_prix=Decimal('10.00'),
+                                                                 montant_revision_periode=Decimal('10.00'))
+        self.moteur().enregistrer()
+        paye = Decompte.objects.get(id=self.decomptes[0].id)
+        self.assertEqual(paye.montant_revision_prix, Decimal('10.00'))
+        suivant = Decompte.objects.get(id=self.decomptes[1].id)
+        self.assertEqual(suivant.montant_revision_prix, Decimal('52.50'))
+        self.assertEqual(suivant.montant_revision_periode, Decimal('42.50'))
+
+
+class RevisionSaisieTests(TestCase):
+    """Projet sans formule de révision: la révision saisie à la main compte dans la situation de la période"""
+
+    def setUp(self):
+        self.projet = creer_projet()
+        lot = LotProjet.objects.create(projet=self.projet, nom="Lot 1")
+        ligne = LigneBordereau.objects.get(id=creer_bordereau(lot)['a'])
+        attachement = Attachement.objects.create(
+            projet=self.projet, numero='01', statut='VALIDE', date_etablissement=date(2024, 1, 31),
+            date_debut_periode=date(2024, 1, 1), date_fin_periode=date(2024, 1, 31))
+        LigneAttachement.objects.create(
+            attachement=attachement, ligne_lot=ligne, designation=ligne.designation,
+            quantite_initiale=ligne.quantite, prix_unitaire=ligne.prix_unitaire, quantite_realisee=Decimal('2'))
+        generer_decomptes_projet(self.projet.id)
+        self.decompte = Decompte.objects.get(attachement=attachement)
+
+    def test_revision_saisie_dans_le_montant_de_situation(self):
+        self.decompte.montant_revision_prix = Decimal('5.00')
+        self.decompte.save()
+        decompte = Decompte.objects.get(id=self.decompte.id)
+        self.assertEqual(decompte.montant_revision_periode, Decimal('5.00'))
+        self.assertEqual(decompte.montant_total_avec_revision, Decimal('25.00'))
+        self.assertEqual(SituationFinanciereProjet.objects.get(projet=self.projet).montant_ht_cumule, Decimal('25.00'))
+
+    def test_reprise_des_decomptes_enregistres(self):
+        # Décompte enregistré avant montant_revision_periode: révision dans le HT cumulé, hors situation
+        Decompte.objects.filter(id=self.decompte.id).update(montant_revision_prix=Decimal('5.00'),
+                                                            montant_revision_periode=Decimal('0'),
+                                                            montant_ht=Decimal('25.00'))
+        self.assertEqual(reporter_revisions_manuelles([self.projet.id]), 1)
+        decompte = Decompte.objects.get(id=self.decompte.id)
+        self.assertEqual(decompte.montant_total_avec_revision, Decimal('25.00'))
+        situation = GrandLivreProjet.situation(self.projet.id, GrandLivreProjet.decomptes({'id': decompte.id}))
+        self.assertEqual(SituationFinanciereProjet.objects.get(projet=self.projet).net_a_payer_cumule,
+                         situation.net_a_payer_cumule)
+        self.assertEqual(reporter_revisions_manuelles([self.projet.id]), 0)
@@ -42,6 +42,7 @@ projets_urlpatterns = [
     path('projets/', views.liste_projets, name='liste_projets'),
     path('projets/liste_projets/', views.liste_projets, name='liste_projets'),
     path('projet/<int:projet_id>/supprimer/', views.supprimer_projet, name='supprimer_projet'),
+    path('projet/<int:projet_id>/dupliquer/', views.dupliquer_projet, name='dupliquer_projet'),
     path('projet/<int:projet_id>/dashboard/', views.dashboard_projet, name='dashboard'),
     path('projets/ajouter_projet_modal/', views.ajouter_projet_modal, name='ajouter_projet_modal'),
     path('modifier_projet_modal/<int:projet_id>/', views.modifier_projet_modal, name='modifier_projet_modal'),
@@ -50,9 +51,13 @@ projets_urlpatterns = [
     path('projet/<int:projet_id>/lots/details/', views.lots_details, name='lots_details'),
     path('projet/<int:projet_id>/lot/<int:lot_id>/modifier/', views.modifier_lot, name='modifier_lot'),
     path('projet/<int:projet_id>/lot/<int:lot_id>/supprimer/', views.supprimer_lot, name='supprimer_lot'),
+    path('projet/<int:projet_id>/lot/<int:lot_id>/dupliquer/', views.dupliquer_lot, name='dupliquer_lot'),
+    path('projet/<int:projet_id>/lot/<int:lot_id>/import-excel/', views.importer_bordereau_excel, name='importer_bordereau_excel'),
     path('api/projet/lots/<int:projet_id>/export-excel/', views.export_excel, name='export_excel'),
     path('projet/<int:projet_id>/lot/<int:lot_id>/saisie/', views.saisie_bordereau, name='saisie_bordereau'),
     path('api/lot/<int:lot_id>/save/', views.sauvegarder_lignes_bordereau, name='sauvegarder_lignes_bordereau'),
+    path('api/lot/<int:lot_id>/patch/', views.patcher_lignes_bordereau, name='patcher_lignes_bordereau'),
+    path('api/lot/<int:lot_id>/lignes/', views.plage_lignes_bordereau, name='plage_lignes_bordereau'),
 ]
 base_donnees_urlpatterns = [
      path('base-donnees/', views.base_donnees, name='base_donnees'),
@@ -110,6 +115,7 @@ attachement_urlpatterns = [
     path('decompte/<int:decompte_id>/calcul-retard/', views.calcul_retard_decompte, name='calcul_retard_decompte'),
     # Fiche de contrôle
     path('projet/<int:projet_id>/fiche-contrle/', views.fiche_controle, name='fiche_controle'),
+    path('projet/<int:projet_id>/comparaison-attachements/', views.comparer_attachements, name='comparer_attachements'),
 ]
 utilisateur_urlpatterns = [
      # Gestion du profil utilisateur
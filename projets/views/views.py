@@ -12,18 +12,30 @@ from django.conf import settings
 from django.forms import ValidationError
 from django.shortcuts import render, get_object_or_404, redirect
 
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect, JsonResponse, FileResponse, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, HttpResponseRedirect, JsonResponse, FileResponse, Http404, StreamingHttpResponse
 from django.urls import  reverse, reverse_lazy
 from django.utils.translation import gettext as _
 from django.views import View
 from projets.decorators import can_view_projet, chef_projet_required, superuser_required
 from projets.exporters import ExcelExporter
+from projets.importers import ExcelImporter
+from projets.services.attachement_service import AttachementSaver
+from projets.services.bordereau_service import (BordereauPatcher, BordereauSaver, ConflitRevision, TAILLE_PLAGE,
+                                                 TAILLE_PLAGE_MAX, lire_plage)
+from projets.services.clonage_service import cloner_lot, cloner_projet
+from projets.services.comparaison_service import ComparaisonAttachements
+from projets.services.compteurs_service import CompteursProjet, compter_taches
+from projets.services.controle_service import FicheControle
+from projets.services.decompte_service import DecompteCalculator
+from projets.services.recapitulatif_service import RecapitulatifDecomptes
+from projets.services.situation_service import GrandLivreProjet
 
 from ..forms import ClientForm, DecompteForm, DocumentAdministratifForm, EntrepriseForm, IngenieurForm, OrdreServiceForm, ProjetForm, TacheForm, AttachementForm
 from ..models import *
 
 from django.views.generic import ListView
 
+from django.db import transaction
 from django.db.models import Sum, Avg, Q 
 from django.contrib import messages
 
@@ -469,6 +481,10 @@ def home(request):
     annee_courante = date.today().year
     ca_total = request.user.projets.all().filter(date_debut__year=annee_courante).aggregate(total=Sum('montant'))['total'] or 0
     
+    # Position de trésorerie du portefeuille, lue dans les situations financières enregistrées
+    portefeuille = GrandLivreProjet.portefeuille(request.user.projets.all())
+    net_a_payer = portefeuille['net_a_payer_cumule']
+    
     # Notifications non lues pour l'utilisateur connecté
     if request.user.is_authenticated:
         notifications = Notification.objects.filter(utilisateur=request.user, lue=False).order_by('-date_creation')[:5]
@@ -514,6 +530,15 @@ def home(request):
             "sous_valeur": f"{nb_receptions_validees} réceptions",
             "progress": min(100, nb_receptions_validees * 10)  # Pourcentage arbitraire pour l'affichage
         },
+        {
+            "titre": "Décomptes payés",
+            "valeur": f"{round(portefeuille['montant_paye'] / 1_000_000, 1)}M MAD",
+            "couleur": "green",
+            "icône": "fa-hand-holding-usd",
+            "sous_titre": "Reste à encaisser",
+            "sous_valeur": f"{round(portefeuille['montant_restant'] / 1_000_000, 1)}M MAD",
+            "progress": round(portefeuille['montant_paye'] / net_a_payer * 100) if net_a_payer else 0
+        },
     ]
      # Échéances à venir (7 prochains jours)
     echeances = Tache.objects.filter(date_fin__gte=today).order_by('date_fin')[:3]
@@ -772,6 +797,7 @@ def ajouter_projet_modal(request):
     if request.method == 'POST':
         form = ProjetForm(request.POST)
         if form.is_valid():
+            form.instance._createur = request.user  # Destinataire de la notification de création
             projet = form.save()
             projet.montant = 0.0  # ou une autre valeur par défaut
             projet.users.add(request.user)  # Ajouter l'utilisateur actuel au projet
@@ -844,6 +870,22 @@ def supprimer_projet(request, projet_id):
     projet.delete()
     return redirect('projets:liste_projets')
 
+@chef_projet_required
+def dupliquer_projet(request, projet_id):
+    """Duplique un projet, ses lots et leurs bordereaux sous un nouveau numéro de marché"""
+    projet = get_object_or_404(Projet, id=projet_id)
+    if request.method != "POST":
+        return JsonResponse({'status': 'error', 'message': "Méthode non autorisée"}, status=405)
+    
+    numero = (request.POST.get('numero') or '').strip()
+    if not numero:
+        return JsonResponse({'status': 'error', 'message': "Le numéro du nouveau marché est obligatoire"}, status=400)
+    try:
+        copie = cloner_projet(projet, numero, request.POST.get('nom') or None, utilisateur=request.user)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'ok', 'projet_id': copie.id}, status=201)
+
 #------------------ Pages statiques ------------------
 def apropos(request):
     return render(request, 'projets/apropos.html')
@@ -889,6 +931,8 @@ class ListeTachesView(LoginRequiredMixin, ListView):
         else:
             context['responsables'] = User.objects.filter(projets__in=user.projets.all()).distinct()
         
+        # Compteurs de la liste filtrée en une requête
+        context['compteurs'] = compter_taches(self.object_list)
         return context
 class ListeTachesView1(LoginRequiredMixin, ListView):
     model = Tache
@@ -1170,17 +1214,19 @@ def base_donnees(request):
 def dashboard_projet(request, projet_id):
     projet = get_object_or_404(Projet, id=projet_id)
     lots = projet.lots.all()
-    mnt = 0
-    for lot in lots:
-       mnt += lot.montant_total_ttc
+    # Montant TTC du marché: sous-totaux des lignes racines de tous les lots en une requête
+    mnt_ht = LigneBordereau.objects.filter(lot__projet=projet, parent__isnull=True).aggregate(
+        total=Sum('sous_total_marche'))['total'] or Decimal('0.00')
+    mnt = mnt_ht * Decimal('1.20')
     mnt_txt = "{:,.2f}".format(mnt).replace(",", " ") if mnt else "0.00"
     
     # Données pour les décomptes
     decomptes = Decompte.objects.filter(attachement__projet=projet)
-    total_decomptes = decomptes.count()
-    decomptes_payes = decomptes.filter(statut='PAYE').count()
-    decomptes_emis = decomptes.filter(statut='EMIS').count()
-    decomptes_retard = decomptes.filter(statut='EN_RETARD').count()
+    compteurs = CompteursProjet(projet.id).calculer()
+    total_decomptes = compteurs['decomptes']
+    decomptes_payes = compteurs['decomptes_PAYE']
+    decomptes_emis = compteurs['decomptes_EMIS']
+    decomptes_retard = compteurs['decomptes_EN_RETARD']
     decomptes_recents = decomptes.order_by('-date_emission')[:5]  # 5 plus récents
     attachements = Attachement.objects.filter(projet=projet)
     documents_administratifs = DocumentAdministratif.objects.filter(projet=projet)
@@ -1197,6 +1243,7 @@ def dashboard_projet(request, projet_id):
         'decomptes_emis': decomptes_emis,
         'decomptes_retard': decomptes_retard,
         'decomptes_recents': decomptes_recents,
+        'situation_financiere': GrandLivreProjet.lire(projet.id),
         'attachements': attachements,
         'documents_administratifs': documents_administratifs,
         'ordre_services': ordre_services,
@@ -1209,31 +1256,15 @@ def dashboard_projet(request, projet_id):
 @chef_projet_required
 def saisie_bordereau(request, projet_id, lot_id):
     lot = get_object_or_404(LotProjet, id=lot_id, projet_id=projet_id)
-    lot_root = lot.to_line_tree()
-    # Création du JSON   
-    data = [
-        {
-            'id': ligne.id,
-            'numero': ligne.numero,
-            'designation': ligne.designation,
-            'unite': ligne.unite, # if not ligne.est_titre else '',
-            'quantite': float(ligne.quantite), # if not ligne.est_titre else 0,
-            'prix_unitaire': float(ligne.pu), # if not ligne.est_titre else 0,
-            'montant': float(ligne.amount()),
-            'niveau': ligne.level(), #) ligne.niveau,
-            'est_titre': ligne.has_children(),  
-            'parent_id': ligne.parent.id if ligne.parent else None,
-            '_expanded': False,
-        }
-        for ligne in lot_root.get_descendants()
-    ]
-    
-    json_str = json.dumps(data, ensure_ascii=False)
+    # Seule la première plage est intégrée à la page, la grille charge la suite par l'API de plages
+    plage = lire_plage(lot, 0, TAILLE_PLAGE)
+    json_str = json.dumps(plage['lignes'], ensure_ascii=False)
         
     return render(request, 'projets/lots/saisie_bordereau.html', {
         'lot': lot,
-        'root': lot_root,
         'lignes': json_str,
+        'total_lignes': plage['total'],
+        'taille_plage': TAILLE_PLAGE,
     })
 
 def export_excel(request, projet_id):
@@ -1249,78 +1280,24 @@ def sauvegarder_lignes_bordereau(request, lot_id):
             body = json.loads(request.body)
 
             lot = get_object_or_404(LotProjet, id=lot_id)
+            # La grille complète remplace le bordereau: elle doit avoir été lue sur sa dernière révision
+            revision = body.get('revision') if isinstance(body, dict) else None
+            if revision is None:
+                return JsonResponse({'status': 'error', 'message': "La révision du bordereau est requise"}, status=400)
             
-            # Récupérer les lignes existantes
-            lignes_existantes = {ligne.id: ligne for ligne in LigneBordereau.objects.filter(lot=lot)}
-            id_mapping = {}
-            lignes_existantes_utilisees = set()
-
-            lignes = {}
-            for index, row in enumerate(body):
-                ligne_id = row.get('id')
-                if ligne_id and ligne_id in lignes_existantes:
-                    # Mettre à jour une ligne existante
-                    ligne = lignes_existantes[ligne_id]
-                    ligne.numero = row.get('numero', '')
-                    ligne.designation = row.get('designation', '')
-                    ligne.unite = row.get('unite', '')
-                    ligne.quantite = Decimal(str(row.get('quantite', 0)))
-                    ligne.prix_unitaire = Decimal(str(row.get('prix_unitaire', 0)))
-                    ligne.niveau = row.get('niveau', 0)
-                    ligne.est_titre = row.get('est_titre', False)
-                    ligne.ordre_affichage = index
-                    ligne.montant_calcule = row.get('montant', 0)
-                    
-                    lignes_existantes_utilisees.add(ligne_id)
-                    
-                    lignes[ligne_id] = ligne
-                    id_mapping[ligne_id] = ligne.id
-                else:
-                    # Créer une nouvelle ligne
-                    ligne = LigneBordereau(
-                        lot=lot,
-                        numero=row.get('numero', ''),
-                        designation=row.get('designation', ''),
-                        unite=row.get('unite', ''),
-                        quantite=Decimal(str(row.get('quantite', 0))),
-                        prix_unitaire=Decimal(str(row.get('prix_unitaire', 0))),
-                        niveau=row.get('niveau', 0),
-                        est_titre=row.get('est_titre', False),
-                        ordre_affichage=index,
-                        montant_calcule=row.get('montant', 0)
-                    )
-                    lignes[ligne_id] = ligne
-                    
             try:
-                # Gerer les relations parent-enfant et Enregistrer 
-
-                for index, row in enumerate(body):
-                    ligne_id = row.get('id')
-                    parent_id = row.get('parent_id')    
-                    ligne: LigneBordereau = lignes[ligne_id]
-                    # Assigner le parent, None si aucun parent n'est trouvé (niveau 0)
-                    if parent_id and parent_id in lignes:
-                        ligne.parent = lignes[parent_id]
-                    else:
-                        ligne.parent = None
-                    # Enregistrer la ligne
-                    ligne.save()
-                    id_mapping[ligne_id] = ligne.id
-
-                # Supprimer les lignes non utilisées
-                lignes_a_supprimer = set(lignes_existantes.keys()) - lignes_existantes_utilisees
-                
-                if lignes_a_supprimer:
-                    LigneBordereau.objects.filter(id__in=lignes_a_supprimer).delete()
-                    
+                # Diff avec les lignes existantes et écriture ensembliste dans une transaction
+                id_mapping = BordereauSaver(lot).sauvegarder(body.get('lignes') or [], revision=revision)
 
                 # Retourner les nouveaux id et les anciens id
-                
                 return JsonResponse({'success': True, 
                                     'message': 'Lignes sauvegardées avec succès.', 
                                     'status': 'ok',
                                     'lignes': id_mapping,
+                                    'revision': lot.revision,
                                     }, status=200)
+            except ConflitRevision as e:
+                return JsonResponse({'status': 'conflit', 'message': str(e), 'revision': e.revision}, status=409)
             except Exception as e:
                 print(e)
                 return JsonResponse({'error': str(e)}, status=400)
@@ -1332,6 +1309,36 @@ def sauvegarder_lignes_bordereau(request, lot_id):
                 'message': f"Erreur lors de la sauvegarde: {str(e)}",
                 'traceback': traceback.format_exc()
             }, status=500)
+@chef_projet_required
+def patcher_lignes_bordereau(request, lot_id):
+    """Applique une liste d'opérations ligne à ligne sur une révision donnée du bordereau"""
+    if request.method != "POST":
+        return JsonResponse({'status': 'error', 'message': "Méthode non autorisée"}, status=405)
+    
+    lot = get_object_or_404(LotProjet, id=lot_id)
+    try:
+        body = json.loads(request.body)
+        resultat = BordereauPatcher(lot).appliquer(body.get('revision'), body.get('operations') or [])
+    except ConflitRevision as e:
+        return JsonResponse({'status': 'conflit', 'message': str(e), 'revision': e.revision}, status=409)
+    except (ValueError, KeyError, TypeError) as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    return JsonResponse({'status': 'ok', **resultat}, status=200)
+@login_required
+def plage_lignes_bordereau(request, lot_id):
+    """Retourne les lignes [debut, fin) de l'arbre aplati d'un lot pour le défilement virtuel de la grille"""
+    lot = get_object_or_404(LotProjet, id=lot_id)
+    try:
+        debut = max(int(request.GET.get('debut', 0)), 0)
+        fin = int(request.GET.get('fin', debut + TAILLE_PLAGE))
+        profondeur_max = request.GET.get('profondeur_max')
+        profondeur_max = int(profondeur_max) if profondeur_max not in (None, '') else None
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': "Paramètres de plage invalides"}, status=400)
+    
+    fin = min(max(fin, debut), debut + TAILLE_PLAGE_MAX)
+    return JsonResponse({'status': 'ok', **lire_plage(lot, debut, fin, profondeur_max)}, status=200)
 #------------------ Gestion du profil ------------------
 
 def serve_avatar(request, filename):
@@ -1751,6 +1758,37 @@ def supprimer_lot(request, projet_id, lot_id):
     lot.delete()
     return redirect('projets:lots_projet', projet_id=projet_id)
 @chef_projet_required
+def importer_bordereau_excel(request, projet_id, lot_id):
+    """Importe le bordereau d'un lot depuis un fichier Excel (ajout ou remplacement des lignes)"""
+    lot = get_object_or_404(LotProjet, id=lot_id, projet_id=projet_id)
+    if request.method != "POST":
+        return redirect('projets:lots_projet', projet_id=projet_id)
+    
+    fichier = request.FILES.get('fichier')
+    if not fichier:
+        messages.error(request, "Aucun fichier sélectionné.")
+        return redirect('projets:lots_projet', projet_id=projet_id)
+    
+    importer = ExcelImporter(lot, remplacer=request.POST.get('remplacer') == 'on')
+    if importer.remplacer and importer.saisies_existantes():
+        messages.error(request, f"Remplacement refusé pour le lot {lot.nom}: {importer.REMPLACEMENT_IMPOSSIBLE}")
+        return redirect('projets:lots_projet', projet_id=projet_id)
+    try:
+        nombre_lignes = importer.importer(fichier, request.POST.get('feuille') or None)
+    except ValueError as e:
+        messages.error(request, f"Import impossible: {e}")
+        return redirect('projets:lots_projet', projet_id=projet_id)
+    
+    messages.success(request, f"{nombre_lignes} lignes importées dans le lot {lot.nom}.")
+    return redirect('projets:saisie_bordereau', projet_id=projet_id, lot_id=lot.id)
+@chef_projet_required
+def dupliquer_lot(request, projet_id, lot_id):
+    lot = get_object_or_404(LotProjet, id=lot_id, projet_id=projet_id)
+    if request.method == "POST":
+        copie = cloner_lot(lot)
+        messages.success(request, f"Lot dupliqué: {copie.nom}.")
+    return redirect('projets:lots_projet', projet_id=projet_id)
+@chef_projet_required
 def lots_projet(request, projet_id):
     projet = get_object_or_404(Projet, id=projet_id)
 
@@ -1765,53 +1803,68 @@ def lots_projet(request, projet_id):
     return render(request, 'projets/lots/lots_projet.html', {'projet': projet, 'lots': lots})    
 @login_required
 def lots_details(request, projet_id):
+    """
+    Bordereau détaillé des lots du projet, une plage de lignes par lot (lire_plage): ?lot=&debut= fait
+    défiler le lot choisi, ?profondeur= limite les niveaux affichés. Les totaux viennent des sous-totaux
+    enregistrés des lignes racines, sans parcourir les lignes.
+    """
     projet = get_object_or_404(Projet, id=projet_id)
     can_editer = request.user.is_superuser
+    try:
+        lot_courant = int(request.GET.get('lot', 0))
+        debut_courant = max(int(request.GET.get('debut', 0)), 0)
+        profondeur = request.GET.get('profondeur')
+        profondeur = int(profondeur) if profondeur not in (None, '') else None
+    except ValueError:
+        lot_courant, debut_courant, profondeur = 0, 0, None
     # Récupérer tous les lots du projet
     lots = LotProjet.objects.filter(projet=projet).order_by('id')
+    totaux = dict(LigneBordereau.objects.filter(lot__projet=projet, niveau=0).values('lot_id').annotate(
+        total=Sum('sous_total_marche')
+    ).values_list('lot_id', 'total'))
     lots_data = []
     montant_total = 0
     total_lignes = 0
-    from projets.manager import LigneHierarchique
     
     for lot in lots:
-        
-        # Récupérer les lignes du bordereau pour ce lot
-        lignes = LigneBordereau.objects.filter(lot=lot).order_by('id')
-        # Calculer le total du lot
-        total_lot = sum(
-            (ligne.quantite or 0) * (ligne.prix_unitaire or 0) 
-            for ligne in lignes
-        )
+        total_lot = totaux.get(lot.id) or 0
         if total_lot == 0:
             continue
         
-        # Construire la hiérarchie
-        lines_root = LigneHierarchique({'id': 0, lot.nom: 'root'})
-        lines_root.build_tree(lignes, lines_root)
-        
-        # Exporter en tableau pour le template
-        lignes_table = lines_root.export_to_table()
+        debut = debut_courant if lot.id == lot_courant else 0
+        plage = lire_plage(lot, debut, debut + TAILLE_PLAGE, profondeur)
+        lignes_table = [{
+            **ligne,
+            'level': ligne['niveau'],
+            'has_children': ligne['est_titre'],
+            'is_parent': ligne['est_titre'],
+        } for ligne in plage['lignes']]
 
         lots_data.append({
             'lot': lot,
             'id': lot.id,
             'nom': lot.nom,
             'description': lot.description,
-            'lignes_table': lignes_table,  # Pour affichage en tableau avec niveaux
+            'lignes_table': lignes_table,  # Plage affichée, avec niveaux
             'total_lot': total_lot,
+            'nombre_lignes': plage['total'],
+            'debut': plage['debut'] + 1 if lignes_table else 0,
+            'fin': plage['fin'],
+            'precedent': max(debut - TAILLE_PLAGE, 0) if debut > 0 else None,
+            'suivant': plage['fin'] if plage['fin'] < plage['total'] else None,
         })
         
         montant_total += total_lot
-        total_lignes += len(lignes_table)
+        total_lignes += plage['total']
     
     context = {
         'projet': projet,
         'can_editer': can_editer,
-        'lots': lots_data,  # Contient déjà lot, lignes_hierarchiques, lignes_table, total_lot
+        'lots': lots_data,  # Contient déjà lot, lignes_table (plage), total_lot, pagination
         'montant_total': montant_total,
         'total_lots': len(lots_data),
         'total_lignes': total_lignes,
+        'profondeur': profondeur,
     }
     return render(request, 'projets/lots/lots_details.html', context)
    
@@ -2142,21 +2195,22 @@ def ajouter_fichier_suivi(request, projet_id, suivi_id):
 @login_required
 def liste_attachements(request, projet_id):
     projet = get_object_or_404(Projet, id=projet_id)
-    attachements = Attachement.objects.filter(projet=projet).order_by('id')
+    attachements = Attachement.objects.filter(projet=projet).select_related('decompte').order_by('id')
     
     context = {
         'projet': projet,
         'attachements': attachements,
+        'compteurs': CompteursProjet(projet.id).calculer(),
     }
     return render(request, 'projets/decomptes/liste_attachements.html', context)
 @login_required
 def ajouter_attachement(request, projet_id):
     projet = get_object_or_404(Projet, id=projet_id)
     
-    # Récupérer toutes les lignes de bordereau du projet
-    lignes_bordereau = LigneBordereau.objects.filter(
-        lot__projet=projet
-    ).select_related('lot').order_by('lot__id', 'id')
+    # Lignes de bordereau du projet et quantité du dernier attachement de chacune, en une requête
+    lignes_bordereau = LigneBordereau.avec_quantite_realisee(
+        LigneBordereau.objects.filter(lot__projet=projet)
+    ).order_by('lot__id', 'id')
 
     if request.method == 'POST':
         form = AttachementForm(request.POST, request.FILES)
@@ -2173,39 +2227,13 @@ def ajouter_attachement(request, projet_id):
                 else:
                     attachement.fichier = fichier
                 attachement.modifie_par = request.user
-                attachement.save()
-                
-                lignes_data_json = request.POST.get('lignes_attachement')
-                if lignes_data_json:
-                    lignes_data = json.loads(lignes_data_json)
+                with transaction.atomic():
+                    attachement.save()
                     
-                    # Retirer les titres de la fin
-                    while lignes_data and lignes_data[-1].get('is_title'):
-                        lignes_data.pop()
-                        
-                    for ligne_data in lignes_data:
-                        # Convertir en Decimal pour éviter les problèmes de type
-                        quantite_realisee = Decimal(str(ligne_data.get('quantite_realisee', 0)))
-                        ligne_bordereau_id = ligne_data['id']
-                        ligne_bordereau = LigneBordereau.objects.get(id=ligne_bordereau_id)
-                        
-                        is_title = ligne_bordereau.is_title
-                        
-                        # SAUVEGARDER TOUTES LES LIGNES (titres inclus)
-                        if quantite_realisee > 0 or is_title:
-                            quantite_cumulee = quantite_realisee
-
-                            LigneAttachement.objects.create(
-                                attachement=attachement,
-                                ligne_lot=ligne_bordereau,
-                                numero=ligne_bordereau.numero,
-                                designation=ligne_bordereau.designation,
-                                unite=ligne_bordereau.unite,
-                                prix_unitaire=ligne_bordereau.prix_unitaire,
-                                quantite_initiale=ligne_bordereau.quantite,
-                                quantite_realisee=quantite_realisee if not is_title else Decimal('0'),
-                                quantite_cumulee=quantite_cumulee,
-                            )
+                    lignes_data_json = request.POST.get('lignes_attachement')
+                    if lignes_data_json:
+                        # Lignes de bordereau et cumuls antérieurs en deux requêtes, un seul bulk_create
+                        AttachementSaver(attachement).creer(json.loads(lignes_data_json))
                 
                 messages.success(request, "Attachement créé avec succès !")
                 return redirect('projets:liste_attachements', projet_id=projet.id)
@@ -2233,7 +2261,7 @@ def ajouter_attachement(request, projet_id):
         # Ajouter la ligne aux données pour Handsontable
         ligne_dict = {
             'id': ligne.id,
-            'parent_id': ligne.parent.id if ligne.parent else None,
+            'parent_id': ligne.parent_id,
             'numero': ligne.numero,
             'niveau': ligne.niveau,
             'designation': ligne.designation,
@@ -2302,9 +2330,7 @@ def modifier_attachement(request, attachement_id):
     projet = attachement.projet
     
     # Récupérer toutes les lignes de bordereau du projet
-    lignes_bordereau = LigneBordereau.objects.filter(
-        lot__projet=projet
-    ).select_related('lot').order_by('lot__id', 'id')
+    lignes_bordereau = LigneBordereau.objects.filter(lot__projet=projet).order_by('lot__id', 'id')
     
     if request.method == 'POST':
         form = AttachementForm(request.POST, request.FILES, instance=attachement)
@@ -2313,43 +2339,12 @@ def modifier_attachement(request, attachement_id):
 
                 attachement.modifie_par = request.user
                 attachement = form.save(commit=False)
-                attachement.save()
-
-                # Supprimer les anciennes lignes de cet attachement
-                LigneAttachement.objects.filter(attachement=attachement).delete()
+                with transaction.atomic():
+                    attachement.save()
 
-                lignes_data_json = request.POST.get('lignes_attachement')
-                if lignes_data_json:
-                    lignes_data = json.loads(lignes_data_json)
-                    
-                    # Retirer les titres de la fin (lignes orphelines)
-                    while lignes_data and lignes_data[-1].get('is_title'):
-                        lignes_data.pop()
-                    
-                    for ligne_data in lignes_data:
-                        # Convertir en Decimal pour éviter les problèmes de type
-                        quantite_realisee = Decimal(str(ligne_data.get('quantite_realisee', 0)))
-                        
-                        ligne_bordereau_id = ligne_data['id']
-                        ligne_bordereau = LigneBordereau.objects.get(id=ligne_bordereau_id)
-                        
-                        is_title = ligne_bordereau.is_title
-                        
-                        # SAUVEGARDER TOUTES LES LIGNES (titres inclus)
-                        if quantite_realisee > 0 or is_title:
-                            quantite_cumulee = quantite_realisee
-
-                            LigneAttachement.objects.create(
-                                attachement=attachement,
-                                ligne_lot=ligne_bordereau,
-                                numero=ligne_bordereau.numero,
-                                designation=ligne_bordereau.designation,
-                                unite=ligne_bordereau.unite,
-                                prix_unitaire=ligne_bordereau.prix_unitaire,
-                                quantite_initiale=ligne_bordereau.quantite,
-                                quantite_realisee=quantite_realisee if not is_title else Decimal('0'),
-                                quantite_cumulee=quantite_cumulee,
-                            )
+                    lignes_data_json = request.POST.get('lignes_attachement')
+                    # Diff avec les lignes existantes: mises à jour, insertions et suppressions ensemblistes
+                    AttachementSaver(attachement).modifier(json.loads(lignes_data_json) if lignes_data_json else [])
                 messages.success(request, "Attachement modifié avec succès !")
                 return redirect('projets:liste_attachements', projet_id=projet.id)
                 
@@ -2363,20 +2358,20 @@ def modifier_attachement(request, attachement_id):
     lignes_data = []
     # recuperer l'attachement qui un id avant attachement_id
     attachement_avant = attachement.get_previous_attachement()
+    # Quantités des deux attachements en deux requêtes (et non deux par ligne)
+    quantites, quantites_avant = AttachementSaver(attachement).quantites_grille(attachement_avant)
     for ligne in lignes_bordereau:
-        ligne_att_avant = LigneAttachement.objects.filter(attachement=attachement_avant, ligne_lot=ligne).first()
-        ligne_cet_att = LigneAttachement.objects.filter(attachement=attachement, ligne_lot=ligne).first()
         if ligne.is_title:
             quantite_realisee_attachement_avant = None
             quantite_realisee = None
         else:
-            quantite_realisee = ligne_cet_att.quantite_realisee if ligne_cet_att else None
-            quantite_realisee_attachement_avant = ligne_att_avant.quantite_realisee if ligne_att_avant else None
+            quantite_realisee = quantites.get(ligne.id)
+            quantite_realisee_attachement_avant = quantites_avant.get(ligne.id)
         
         # Ajouter la ligne aux données pour Handsontable
         ligne_dict = {
             'id': ligne.id,
-            'parent_id': ligne.parent.id if ligne.parent else None,
+            'parent_id': ligne.parent_id,
             'numero': ligne.numero,
             'niveau': ligne.niveau,
             'designation': ligne.designation,
@@ -2446,7 +2441,7 @@ def detail_attachement(request, attachement_id):
     for lot in lots:
         
         # Récupérer les lignes d'attachement pour ce lot
-        lignes = LigneAttachement.objects.filter(attachement=attachement, ligne_lot__lot=lot).order_by('id')
+        lignes = LigneAttachement.objects.filter(attachement=attachement, ligne_lot__lot=lot).select_related('ligne_lot').order_by('id')
         # Calculer le total du lot
         total_lot = sum(
             (ligne.quantite_realisee or 0) * (ligne.prix_unitaire or 0) 
@@ -2462,8 +2457,8 @@ def detail_attachement(request, attachement_id):
             montant_ligne = (ligne.quantite_realisee or 0) * (ligne.prix_unitaire or 0) if is_detail else 0
 
             lignes_data.append({
-                'id': ligne.ligne_lot.id,
-                'parent_id': ligne.ligne_lot.parent.id if ligne.ligne_lot.parent else None,
+                'id': ligne.ligne_lot_id,
+                'parent_id': ligne.ligne_lot.parent_id,
                 'numero': ligne.numero,
                 'designation': ligne.designation,
                 'unite': ligne.unite,
@@ -2898,21 +2893,12 @@ def liste_decomptes(request, projet_id):
         decomptes = decomptes.order_by(sort_field)
     elif sort_field in ['-numero', '-date_emission', '-date_echeance', '-statut', '-montant_net_a_payer']:
         decomptes = decomptes.order_by(sort_field)
-    dernier_decompte = Decompte.objects.filter(attachement__projet=projet).order_by('-id').first() # Dernier Decompte
-
-    # Calcul des totaux
-    total_ht = dernier_decompte.montant_ht if dernier_decompte else 0
-    total_ttc = dernier_decompte.montant_ttc if dernier_decompte else 0
-    total_net = dernier_decompte.montant_net_a_payer if dernier_decompte else 0
-    payes_count = decomptes.filter(statut='PAYE').count()
-    
-    # Compteurs par statut pour les filtres
-    decomptes_payes = Decompte.objects.filter(attachement__projet=projet, statut='PAYE')
-    decomptes_emis = Decompte.objects.filter(attachement__projet=projet, statut='EMIS')
-    decomptes_valides = Decompte.objects.filter(attachement__projet=projet, statut='VALIDE')
-    decomptes_brouillons = Decompte.objects.filter(attachement__projet=projet, statut='BROUILLON')
+    # Compteurs par statut, attachements sans décompte et montants du dernier décompte en une requête
+    compteurs = CompteursProjet(projet.id).calculer()
+    # Cumuls facturés et net à payer lus dans la situation financière du projet
+    situation_financiere = GrandLivreProjet.lire(projet.id)
     
-    # Attachements sans décompte (pour le compteur)
+    # Attachements sans décompte (pour le formulaire)
     attachements_sans_decompte = Attachement.objects.filter(projet=projet, decompte__isnull=True)
     
     # Gestion du formulaire
@@ -3011,20 +2997,26 @@ def liste_decomptes(request, projet_id):
             print(form.errors)
             messages.error(request, "Veuillez corriger les erreurs dans le formulaire.")
     
-    attachements_disponibles_count = attachements_sans_decompte.count()
+    attachements_disponibles_count = compteurs['attachements_sans_decompte']
+
+    # Montants de situation de tous les décomptes affichés en une requête
+    calculateur = DecompteCalculator(decomptes)
+    decomptes = calculateur.calculer()
 
     context = {
         'projet': projet,
         'decomptes': decomptes,
+        'decomptes_situation_totaux': calculateur.totaux,
         'search_query': search_query,
-        'decomptes_total_ht': total_ht,
-        'decomptes_total_ttc': total_ttc,
-        'decomptes_total_net': total_net,
-        'decomptes_payes_count': payes_count,
-        'decomptes_payes': decomptes_payes,
-        'decomptes_emis': decomptes_emis,
-        'decomptes_valides': decomptes_valides,
-        'decomptes_brouillons': decomptes_brouillons,
+        'decomptes_total_ht': situation_financiere.montant_ht_cumule,
+        'decomptes_total_ttc': situation_financiere.montant_ttc_cumule,
+        'decomptes_total_net': situation_financiere.net_a_payer_cumule,
+        'decomptes_payes_count': compteurs['decomptes_PAYE'],
+        'decomptes_count': compteurs['decomptes'],
+        'decomptes_payes': compteurs['decomptes_PAYE'],
+        'decomptes_emis': compteurs['decomptes_EMIS'],
+        'decomptes_valides': compteurs['decomptes_VALIDE'],
+        'decomptes_brouillons': compteurs['decomptes_BROUILLON'],
         'attachements_disponibles_count': attachements_disponibles_count,
         'form': form,
         'decompte_a_modifier': decompte_a_modifier,
@@ -3062,14 +3054,15 @@ def supprimer_decompte(request, decompte_id):
     return render(request, 'projets/supprimer_decompte.html', context)
 def detail_decompte(request, decompte_id):
     """Vue pour afficher le détail d'un décompte"""
-    decompte = get_object_or_404(Decompte, id=decompte_id)
+    decompte = get_object_or_404(Decompte.objects.select_related('attachement__projet'), id=decompte_id)
     projet = decompte.attachement.projet
     
     
-    montant_s_ht = float(decompte.attachement.total_montant_ht) if decompte.attachement.total_montant_ht else 0.0
+    # Montants enregistrés sur l'attachement (aucune agrégation de ses lignes)
+    montant_s_ht = float(decompte.attachement.montant_ht_cumule)
     revision_prix = float(decompte.montant_revision_prix) if decompte.montant_revision_prix else 0.0
     montant_s_revise = montant_s_ht + revision_prix
-    montant_ht_precedent = float(decompte.attachement.montant_ht_attachement_precedent) if decompte.attachement.montant_ht_attachement_precedent else 0.0
+    montant_ht_precedent = float(decompte.attachement.montant_ht_precedent)
     montant_t_ht = montant_s_revise - montant_ht_precedent
     tva = montant_t_ht * (float(decompte.taux_tva) or 0) / 100
     montant_t_ttc = montant_t_ht + tva
@@ -3078,10 +3071,15 @@ def detail_decompte(request, decompte_id):
     autres = float(decompte.autres_retenues) if decompte.autres_retenues else 0.0 if decompte.autres_retenues else 0.0
     net_a_payer = montant_t_ttc - rg - ras - autres
     est_revise = revision_prix != 0
+    # Récapitulatif par nature (requête groupée) et résumé enregistré par Decompte.save / LigneDecompte.save
+    recapitulatif = RecapitulatifDecomptes(Decompte.objects.filter(pk=decompte.pk)).groupes()
+    resume = ResumeDecompte.objects.filter(decompte=decompte).first()
     # Calcul des pourcentages pour l'affichage
     context = {
         'decompte': decompte,
         'projet': projet,
+        'recapitulatif': recapitulatif,
+        'resume': resume,
         'est_revise': est_revise,
         'montant_s_ht': montant_s_ht,
         'revision_prix': revision_prix,
@@ -3119,7 +3117,6 @@ def calcul_retard_decompte(request, decompte_id):
 def fiche_controle(request, projet_id):
     projet = get_object_or_404(Projet, id=projet_id)
     attachements = Attachement.objects.filter(projet=projet).order_by('-date_etablissement')
-    from projets.manager import LigneHierarchique
     attachement_courant = None
     donnees_controle = []
     total_general = {
@@ -3135,97 +3132,8 @@ def fiche_controle(request, projet_id):
         attachement_courant = get_object_or_404(Attachement, id=attachement_id, projet=projet)
         attachement_precedent = attachement_courant.get_previous_attachement()
         
-        # Récupérer tous les lots et lignes de bordereau
-        lots = LotProjet.objects.filter(projet=projet).order_by('id')
-        
-        for lot in lots:
-            lignes_bordereau = LigneBordereau.objects.filter(lot=lot).order_by('id')
-            lignes_controle = []
-
-            total_lot = {
-                'montant_marche': 0,
-                'montant_partiel': 0,
-                'montant_s': 0,
-                'delta_montant': 0, 
-            }
-            
-            for ligne_bordereau in lignes_bordereau:
-                if ligne_bordereau.montant_realise == 0:
-                    continue
-                if ligne_bordereau.is_title:
-                    ligne_controle = {
-                    'numero': ligne_bordereau.numero or '',
-                    'designation': ligne_bordereau.designation,
-                    'is_title': True,
-                    'can_be_hidden': False
-                }
-                    lignes_controle.append(ligne_controle)
-                    continue  # Ignorer les lignes titre
-                
-                # Données MARCHÉ
-                quantite_marche = ligne_bordereau.quantite
-                montant_marche = ligne_bordereau.montant
-                
-                # Données RÉALISATION - Attachement courant
-                ligne_courante = LigneAttachement.objects.filter(attachement=attachement_courant, ligne_lot=ligne_bordereau).first()
-                quantite_s = ligne_courante.quantite_realisee if ligne_courante else Decimal('0')
-                montant_s = quantite_s * ligne_bordereau.prix_unitaire
-                
-                # Données RÉALISATION - Attachement précédent
-                quantite_s1 = Decimal('0')
-                if attachement_precedent:
-                    ligne_precedente = LigneAttachement.objects.filter(attachement=attachement_precedent, 
-                                                                       ligne_lot=ligne_bordereau).first()
-                    quantite_s1 = ligne_precedente.quantite_realisee if ligne_precedente else Decimal('0')
-                
-                # Calculs intermédiaires
-                quantite_partiel = quantite_s - quantite_s1
-                montant_partiel = quantite_partiel * ligne_bordereau.prix_unitaire
-                
-                # Calculs DELTA
-                delta_quantite = quantite_marche - quantite_s
-                delta_montant =  montant_marche - montant_s
-                
-                # Pourcentage réalisé
-                pourcentage_realise = (quantite_s / quantite_marche * 100) if quantite_marche > 0 else Decimal('0')
-                
-                ligne_controle = {
-                    'numero': ligne_bordereau.numero,
-                    'designation': ligne_bordereau.designation,
-                    'unite': ligne_bordereau.unite,
-                    'quantite_marche': quantite_marche,
-                    'montant_marche': montant_marche,
-                    'quantite_s1': quantite_s1,
-                    'quantite_partiel': quantite_partiel,
-                    'montant_partiel': montant_partiel,
-                    'quantite_s': quantite_s,
-                    'montant_s': montant_s,
-                    'delta_quantite': delta_quantite,
-                    'delta_montant': delta_montant,
-                    'pourcentage_realise': pourcentage_realise,
-                    'is_title': False,
-                    'can_be_hidden': True if montant_s == 0 else False
-                }
-                
-                lignes_controle.append(ligne_controle)
-                
-                # Totaux lot
-                for key in total_lot:
-                    if key in ligne_controle:
-                        total_lot[key] += ligne_controle[key]
-            total_lot['pourcentage_realise'] = (total_lot['montant_s'] / total_lot['montant_marche'] * 100) if total_lot['montant_marche'] > 0 else Decimal('0')
-
-            if lignes_controle:
-                donnees_controle.append({'lot': lot, 'lignes': lignes_controle, 'total_lot': total_lot})
-                
-                # Totaux généraux
-                for key in total_general:
-                    if key in total_lot:
-                        total_general[key] += total_lot[key]
-                
-                # Construire la hiérarchie                
-                
-        total_general['pourcentage_realise'] = (total_general['montant_s'] / total_general['montant_marche'] * 100) if total_general['montant_marche'] > 0 else Decimal('0')
+        # Bordereau et quantités S / S-1 de tout le projet en trois requêtes, résultat mis en cache
+        donnees_controle, total_general = FicheControle(projet, attachement_courant, attachement_precedent).calculer()
     
     context = {
         'projet': projet,
@@ -3238,6 +3146,66 @@ def fiche_controle(request, projet_id):
     
     return render(request, 'projets/decomptes/fiche_controle.html', context)
 
+LIMITE_LIGNES_COMPARAISON = 2000
+
+@login_required
+def comparer_attachements(request, projet_id):
+    """
+    Compare un attachement à un autre attachement du projet ou au marché (reference=marche), tous lots confondus.
+    Par défaut la référence est l'attachement précédent. ?format=csv exporte toutes les lignes en flux.
+    """
+    projet = get_object_or_404(Projet, id=projet_id)
+    attachements = Attachement.objects.filter(projet=projet).order_by('-date_etablissement', '-id')
+    comparee = reference = None
+    comparaison = None
+    lignes = []
+    nb_ecarts = 0
+    totaux_lots = []
+
+    comparee_id = request.GET.get('comparee')
+    reference_id = request.GET.get('reference', '')
+    if comparee_id:
+        comparee = get_object_or_404(Attachement, id=comparee_id, projet=projet)
+        if reference_id == 'marche':
+            reference = None
+        elif reference_id:
+            reference = get_object_or_404(Attachement, id=reference_id, projet=projet)
+        else:
+            reference = comparee.get_previous_attachement()
+            reference_id = str(reference.id) if reference else 'marche'
+
+        if request.GET.get('format') == 'csv':
+            comparaison = ComparaisonAttachements(projet, comparee, reference)
+            libelle_reference = reference.numero if reference else 'marche'
+            response = StreamingHttpResponse(comparaison.lignes_csv(), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = (
+                f'attachment; filename="comparaison_{projet.numero}_{comparee.numero}_{libelle_reference}.csv"'
+            )
+            return response
+
+        # Toutes les lignes sont parcourues pour les totaux, seules les premières lignes en écart sont affichées
+        comparaison = ComparaisonAttachements(projet, comparee, reference, ecarts_seulement=True)
+        for ligne in comparaison.lignes():
+            nb_ecarts += 1
+            if nb_ecarts <= LIMITE_LIGNES_COMPARAISON:
+                lignes.append(ligne)
+        totaux_lots = list(comparaison.totaux_lots.values())
+
+    context = {
+        'projet': projet,
+        'attachements': attachements,
+        'comparee': comparee,
+        'reference': reference,
+        'reference_id': reference_id,
+        'lignes': lignes,
+        'totaux_lots': totaux_lots,
+        'total': comparaison.total if comparaison else None,
+        'nb_ecarts': nb_ecarts,
+        'tronque': nb_ecarts > len(lignes),
+        'limite': LIMITE_LIGNES_COMPARAISON,
+    }
+    return render(request, 'projets/decomptes/comparaison_attachements.html', context)
+
 # ------------------------ API pour les lignes d'attachement ------------------------
 def get_lignes_attachement(request, attachement_id):
     """API pour récupérer les lignes d'un attachement en JSON"""